@@ -0,0 +1,139 @@
+# Benchmark of concurrent games writing to one database file, with and without the database writer.
+#
+# Sets up --games games and plays them at the same time, one thread per game, through GameState: each turn the player
+# passes go or pays rent, and the turn ends with a flush and next_player (net worth log included). In 'direct' mode every
+# thread commits on a pooled connection of its own, as the request handlers did before the writer; in 'writer' mode
+# the turn ends go through writer.py, which group-commits the turns of all games. Reports the turns per second and the
+# p50/p99 time of a turn end for each number of games, and the mean number of turns the writer committed together.
+#
+# Usage: python benchmarks/concurrent_games.py [--games 1,2,4,8,16] [--turns 200] [--players 4] [--synchronous NORMAL]
+
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from monopoly_companion import create_app
+from monopoly_companion.db import close_pools, get_db, get_pool, init_db, next_player
+from monopoly_companion.game_state import get_game_state
+from monopoly_companion.writer import close_writers, get_writer
+
+def setup_game(app, no_of_players):
+    client = app.test_client()
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': str(no_of_players), 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_' + str(player) + '_name': 'Player ' + str(player) for player in range(1, no_of_players + 1)})
+    with client.session_transaction() as session:
+        game_id = session['game_id']
+    with app.app_context():
+        return game_id, get_game_state(get_db(), game_id, app.config['DATABASE']).players
+
+def play(app, mode, game_id, player_dict, turns, seed, start, latencies, errors):
+    config = app.config
+    pool = get_pool(config)
+    db = pool.acquire()
+    state = get_game_state(db, game_id, config['DATABASE'])
+    players = sorted(player_dict, key=lambda player_id: player_dict[player_id][1])
+    names = [state.properties[slot]['property_name'] for slot in range(len(state.property_ids))]
+    rng = random.Random(seed)
+    order, turn = 1, 1
+    start.wait()
+    try:
+        for _ in range(turns):
+            player_id = int(players[order - 1])
+            if rng.random() < 0.5:
+                state.go(player_id, turn)
+            else:
+                state.rent(player_id, rng.choice(names), turn, rng.randint(2, 12))
+            state.update_turn(turn, player_id)
+
+            began = time.perf_counter()
+            if mode == 'direct':
+                state.flush(db)
+                order, turn = next_player(db, game_id, order, len(players), turn)
+            else:
+                current_order, current_turn = order, turn
+                order, turn = state.commit(config, lambda db: next_player(db, game_id, current_order, len(players), current_turn, commit=False))
+            latencies.append(time.perf_counter() - began)
+    except Exception as error:
+        errors.append(error)
+    finally:
+        pool.release(db)
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def run(mode, no_of_games, args):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': path,
+        'PROJECTION_ROLLOUTS': 0,
+        'DATABASE_SYNCHRONOUS': args.synchronous,
+        'DATABASE_POOL_SIZE': no_of_games + 2,
+    })
+    with app.app_context():
+        init_db()
+    games = [setup_game(app, args.players) for _ in range(no_of_games)]
+
+    start = threading.Event()
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(target=play, args=(app, mode, game_id, player_dict, args.turns, game_id, start, latencies, errors))
+        for game_id, player_dict in games
+    ]
+    for thread in threads:
+        thread.start()
+    began = time.perf_counter()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    writer = get_writer(app.config)
+    groups, committed = writer.groups, writer.committed
+    close_writers()
+    close_pools()
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+    return {
+        'turns_per_second': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else float('nan'),
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else float('nan'),
+        'group': committed / groups if mode == 'writer' and groups else None,
+        'errors': len(errors),
+        'error': str(errors[0]) if errors else '',
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', default='1,2,4,8,16')
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--synchronous', default='NORMAL')
+    args = parser.parse_args()
+
+    print("concurrent games, " + str(args.turns) + " turns each, " + str(args.players) + " players, synchronous " + args.synchronous)
+    print("  {:<7} {:>6} {:>10} {:>9} {:>9} {:>7} {:>7}".format('mode', 'games', 'turns/s', 'p50 ms', 'p99 ms', 'group', 'errors'))
+    for no_of_games in [int(games) for games in args.games.split(',')]:
+        for mode in ['direct', 'writer']:
+            result = run(mode, no_of_games, args)
+            print("  {:<7} {:>6} {:>10.0f} {:>9.2f} {:>9.2f} {:>7} {:>7} {}".format(
+                mode, no_of_games, result['turns_per_second'], result['p50_ms'], result['p99_ms'],
+                '' if result['group'] is None else '{:.1f}'.format(result['group']), result['errors'], result['error']
+            ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Benchmark of setting up a new game: version selection (create_game) and player registration.
+#
+# Sets up --games games through the Flask test client and reports the median time of each step and the number of
+# SQL statements each step ran on its request connection.
+#
+# Usage: python benchmarks/game_setup.py [--games 200] [--players 4]
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from monopoly_companion import create_app
+from monopoly_companion.db import close_pools, get_pool, init_db
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--players', type=int, default=4)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({'TESTING': True, 'DATABASE': path, 'PROJECTION_ROLLOUTS': 0})
+    with app.app_context():
+        init_db()
+
+    # the pool hands out its most recently returned connection, which is the request's, so this one traced
+    # connection serves every request below
+    statements = []
+    pool = get_pool(app.config)
+    db = pool.connect()
+    db.set_trace_callback(statements.append)
+    pool.release(db)
+
+    client = app.test_client()
+    client.get('/game-setup/')
+    registration = {'player_' + str(player) + '_name': 'Player ' + str(player) for player in range(1, args.players + 1)}
+    timings = {'create_game': [], 'player_registration': []}
+    counts = {'create_game': [], 'player_registration': []}
+
+    for _ in range(args.games):
+        for step, url, data in [
+            ('create_game', '/game-setup/', {'game_version': 'Monopoly NL', 'no_of_players': str(args.players), 'double_go': 'on'}),
+            ('player_registration', '/game-setup/player_registration/', registration),
+        ]:
+            statements.clear()
+            start = time.perf_counter()
+            response = client.post(url, data=data)
+            timings[step].append(time.perf_counter() - start)
+            counts[step].append(len(statements))
+            assert response.status_code == 302, response.status_code
+
+    close_pools()
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+    print("game setup, " + str(args.games) + " games, " + str(args.players) + " players")
+    for step in timings:
+        print("  {:<20} {:>7.2f} ms median {:>5.0f} statements".format(step, statistics.median(timings[step]) * 1000, statistics.median(counts[step])))
+    print("  {:<20} {:>7.2f} ms median".format('total', statistics.median(a + b for a, b in zip(*timings.values())) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Benchmark of the bulk import of played-game logs.
+#
+# Writes a seeded log of --games games of --turns turns (pass go, purchase property, rent) as CSV or JSON Lines,
+# imports it with importer.import_file into a fresh database and reports the games per minute, the actions per
+# second and the SQL statements per game.
+#
+# Usage: python benchmarks/import_games.py [--games 1000] [--turns 30] [--players 4] [--format csv] [--batch-size 200] [--seed 1]
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from monopoly_companion import create_app
+from monopoly_companion.db import close_pools, get_db, get_game_template, init_db
+from monopoly_companion.importer import LOG_COLUMNS, import_file
+
+def game_log(key, property_names, players, turns, rng):
+    # each turn a player passes go one time in six, buys a property from the bank one time in three while any are
+    # left, and otherwise pays rent half of the time on a property another player owns
+    owners = {}
+    for turn in range(1, turns + 1):
+        for player in players:
+            row = {'game': key, 'game_version': 'Monopoly NL', 'turn': turn, 'player': player}
+            if rng.random() < 1 / 6:
+                yield dict(row, action='pass go')
+            for_sale = [name for name in property_names if name not in owners]
+            rented = [name for name in owners if owners[name] != player]
+            if for_sale and rng.random() < 1 / 3:
+                name = rng.choice(for_sale)
+                owners[name] = player
+                yield dict(row, action='purchase property', property=name)
+            elif rented and rng.random() < 0.5:
+                yield dict(row, action='rent', property=rng.choice(rented), dice_roll=rng.randint(2, 12))
+
+def write_log(path, fmt, property_names, args):
+    rng = random.Random(args.seed)
+    players = ['Player ' + str(player) for player in range(1, args.players + 1)]
+    actions = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, LOG_COLUMNS) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writeheader()
+        for game in range(1, args.games + 1):
+            for row in game_log(str(game), property_names, players, args.turns, rng):
+                actions += 1
+                if writer is not None:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(row) + '\n')
+    return actions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--turns', type=int, default=30)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--format', default='csv', choices=['csv', 'jsonl'])
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    fd, log = tempfile.mkstemp(suffix='.' + args.format)
+    os.close(fd)
+    app = create_app({'TESTING': True, 'DATABASE': path, 'PROJECTION_ROLLOUTS': 0})
+    with app.app_context():
+        init_db()
+        db = get_db()
+        actions = write_log(log, args.format, get_game_template(db, 1, path).property_names, args)
+
+        statements = []
+        db.set_trace_callback(statements.append)
+        start = time.perf_counter()
+        importer = import_file(db, log, args.format, args.batch_size, path)
+        elapsed = time.perf_counter() - start
+        db.set_trace_callback(None)
+
+    close_pools()
+    for file in [log, path, path + '-wal', path + '-shm']:
+        if os.path.exists(file):
+            os.unlink(file)
+
+    assert not importer.errors, importer.errors[:3]
+    print("import, " + str(args.games) + " games of " + str(args.turns) + " turns, " + str(args.players) + " players, " + str(actions) + " actions, " + args.format)
+    print("  {:>10.0f} games per minute".format(len(importer.games) / elapsed * 60))
+    print("  {:>10.0f} actions per second".format(importer.actions / elapsed))
+    print("  {:>10.1f} statements per game".format(len(statements) / len(importer.games)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Benchmark of the delta-encoded net_worth_log against the previous full copy per round.
+#
+# Plays a seeded 500-turn, 8-player game through GameState and, at every round rollover, writes both the
+# delta log (db.log_net_worth) and a full copy of net_worth into a dense comparison table. Reports the rows
+# and bytes of each, and the time to read the dense per-turn series back from each.
+#
+# Usage: python benchmarks/net_worth_log.py [--turns 500] [--players 8] [--seed 1]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from monopoly_companion import create_app
+from monopoly_companion.db import close_pools, get_db, get_net_worth_series, init_db, next_player
+from monopoly_companion.game_state import get_game_state
+
+def setup_game(app, no_of_players):
+    client = app.test_client()
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': str(no_of_players), 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_' + str(player) + '_name': 'Player ' + str(player) for player in range(1, no_of_players + 1)})
+    with client.session_transaction() as session:
+        game_id = session['game_id']
+    with app.app_context():
+        return game_id, get_game_state(get_db(), game_id, app.config['DATABASE']).players
+
+def play(db, state, player_dict, turns, dense_log):
+    # roughly one lap of the board every six turns: pass go, pay rent or buy a property from the bank
+    players = sorted(player_dict, key=lambda player_id: player_dict[player_id][1])
+    property_names = list(state.property_by_name)
+    for turn in range(1, turns + 1):
+        for order, player_id in enumerate(players, start=1):
+            roll = random.random()
+            if roll < 0.17:
+                state.go(player_id, turn)
+            elif roll < 0.45:
+                state.rent(player_id, random.choice(property_names), turn, random.randint(2, 12))
+            elif roll < 0.55:
+                available = [name for name in property_names if state.owner[state.property_by_name[name]] == 1]
+                if available:
+                    state.purchase_property(player_id, random.choice(available), turn)
+            state.update_turn(turn, player_id)
+            state.flush(db)
+            if order == len(players):
+                db.execute(dense_log, (turn, state.game_id))
+            next_player(db, state.game_id, order, len(players), turn)
+
+def table_size(db, table):
+    rows = db.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+    # table and index pages, from the dbstat virtual table
+    size = db.execute(
+        "SELECT IFNULL(SUM(pgsize), 0) FROM dbstat WHERE name IN (SELECT name FROM sqlite_schema WHERE tbl_name = ?)",
+        (table,)
+    ).fetchone()[0]
+    return rows, size
+
+def read_dense(db, game_id):
+    series = {}
+    for row in db.execute(
+        "SELECT player_id, turn, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth FROM net_worth_log_dense WHERE game_id = ? ORDER BY player_id, turn",
+        (game_id,)
+    ):
+        series.setdefault(row['player_id'], []).append(list(row)[1:])
+    return series
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=500)
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app({'TESTING': True, 'DATABASE': path})
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.executescript(
+            """
+            CREATE TABLE net_worth_log_dense AS SELECT * FROM net_worth_log WHERE 0;
+            CREATE INDEX net_worth_log_dense_game_turn ON net_worth_log_dense (game_id, turn);
+            """
+        )
+
+    game_id, player_dict = setup_game(app, args.players)
+
+    with app.app_context():
+        db = get_db()
+        # the previous log_net_worth: copy every net_worth row of the game at every round
+        dense_log = """
+            INSERT INTO net_worth_log_dense (game_id, net_worth_time, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth)
+            SELECT game_id, net_worth_time, ?, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth FROM net_worth
+            WHERE game_id = ?
+            """
+        db.execute(dense_log, (0, game_id))
+        db.commit()
+
+        state = get_game_state(db, game_id, path)
+        play(db, state, player_dict, args.turns, dense_log)
+        db.commit()
+
+        delta_rows, delta_bytes = table_size(db, 'net_worth_log')
+        dense_rows, dense_bytes = table_size(db, 'net_worth_log_dense')
+
+        assert get_net_worth_series(db, game_id) == read_dense(db, game_id)
+
+        repeat = 20
+        delta_time = min(timeit.repeat(lambda: get_net_worth_series(db, game_id), number=1, repeat=repeat))
+        dense_time = min(timeit.repeat(lambda: read_dense(db, game_id), number=1, repeat=repeat))
+
+    close_pools()
+    os.unlink(path)
+
+    print("net_worth_log, " + str(args.turns) + " turns, " + str(args.players) + " players (+ bank and free parking)")
+    print("  full copy:   {:>7} rows {:>9} bytes   series read {:.2f} ms".format(dense_rows, dense_bytes, dense_time * 1000))
+    print("  delta log:   {:>7} rows {:>9} bytes   series read {:.2f} ms".format(delta_rows, delta_bytes, delta_time * 1000))
+    print("  saving:      {:>6.1f}% rows {:>7.1f}% bytes".format(100 * (1 - delta_rows / dense_rows), 100 * (1 - delta_bytes / dense_bytes)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Benchmark of worker start-up: cold import of the package, app creation, init-db and the first request.
+#
+# Each measurement runs in a fresh interpreter so nothing is already imported or cached. Reports the median of
+# the runs, the slowest imported modules, and fails if a heavy library (pandas, numpy, scipy, pyarrow) was
+# imported on the way to the first response, or if --budget seconds are exceeded.
+#
+# Usage: python benchmarks/startup.py [--runs 5] [--budget 1.0]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# modules that must only be imported by the features that need them
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy', 'pyarrow']
+
+# run in a fresh interpreter; prints the timings as JSON
+STARTUP = """
+import json, os, sys, time
+start = time.perf_counter()
+import monopoly_companion
+imported = time.perf_counter()
+app = monopoly_companion.create_app({'TESTING': True, 'DATABASE': sys.argv[1], 'PROJECTION_ROLLOUTS': 0})
+created = time.perf_counter()
+from monopoly_companion.db import close_pools, init_db
+with app.app_context():
+    init_db()
+initialized = time.perf_counter()
+response = app.test_client().get('/welcome/')
+assert response.status_code == 200, response.status_code
+responded = time.perf_counter()
+close_pools()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'init_db': initialized - created,
+    'first_request': responded - initialized,
+    'total': responded - start,
+    'heavy_modules': sorted(name for name in sys.modules if name in HEAVY_MODULES),
+}))
+"""
+
+def run_once(heavy_modules):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        output = subprocess.run(
+            [sys.executable, '-c', 'HEAVY_MODULES = ' + repr(heavy_modules) + STARTUP, path],
+            cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout
+    finally:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    return json.loads(output.splitlines()[-1])
+
+def slowest_imports(count=10):
+    # cumulative import time of each module imported directly by the package, from python -X importtime
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import monopoly_companion'],
+        cwd=ROOT, check=True, capture_output=True, text=True
+    ).stderr
+    # each module is listed after the modules it imported, indented two more spaces than its importer
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == 'monopoly_companion':
+                return sorted(imports, reverse=True)[:count]
+            imports = []
+        elif depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return []
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None, help="fail if the median time to the first response exceeds this many seconds")
+    args = parser.parse_args()
+
+    runs = [run_once(HEAVY_MODULES) for _ in range(args.runs)]
+
+    print("start-up, median of " + str(args.runs) + " fresh interpreters")
+    for step in ['import', 'create_app', 'init_db', 'first_request', 'total']:
+        print("  {:<14} {:>8.1f} ms".format(step, statistics.median(run[step] for run in runs) * 1000))
+    print("slowest imports of the package (cumulative)")
+    for cumulative, name in slowest_imports():
+        print("  {:<30} {:>8.1f} ms".format(name, cumulative / 1000))
+
+    failures = []
+    heavy = sorted(set(name for run in runs for name in run['heavy_modules']))
+    if heavy:
+        failures.append("imported on the way to the first response: " + ", ".join(heavy))
+    total = statistics.median(run['total'] for run in runs)
+    if args.budget is not None and total > args.budget:
+        failures.append("{:.3f} s to the first response is over the budget of {:.3f} s".format(total, args.budget))
+    for failure in failures:
+        print("FAIL " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
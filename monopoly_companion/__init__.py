@@ -7,6 +7,39 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'monopoly_companion.sqlite'),
+        # seconds an unflushed game state may wait before it is written to the database mid-turn
+        STATE_FLUSH_INTERVAL=5.0,
+        # pooled connections kept per worker, busy timeout in seconds, and the PRAGMA synchronous level used with WAL
+        DATABASE_POOL_SIZE=8,
+        DATABASE_TIMEOUT=5.0,
+        DATABASE_SYNCHRONOUS='NORMAL',
+        DATABASE_CACHED_STATEMENTS=256,
+        # jobs that may wait for the database writer of each worker, and the most jobs it commits in one transaction
+        WRITER_QUEUE_SIZE=1000,
+        WRITER_GROUP_SIZE=100,
+        # threads per worker that log the net worth and start the projection after "Next player" has responded
+        # (0 to do it within the request)
+        TURN_END_WORKERS=2,
+        # games and turns per game of the property simulation served by the API, the most turns a request may ask for,
+        # and its worker processes (None for one per CPU)
+        SIMULATION_GAMES=10000,
+        SIMULATION_TURNS=100,
+        SIMULATION_MAX_TURNS=10000000,
+        SIMULATION_WORKERS=None,
+        # rollouts and turns of the win projection started after every next_player (0 rollouts to turn it off),
+        # its time budget in seconds, rollouts per batch and worker processes (None for one per CPU)
+        PROJECTION_ROLLOUTS=2000,
+        PROJECTION_TURNS=50,
+        PROJECTION_TIME_BUDGET=10.0,
+        PROJECTION_BATCH_SIZE=250,
+        PROJECTION_WORKERS=None,
+        # sessions kept in memory per worker; the cookie only carries a signed token, the data is stored in game_session
+        SESSION_CACHE_SIZE=1024,
+        # record the SQL of every request (response headers, /debug/profile and the monopoly_companion.profiling log),
+        # the times a statement shape may run in one request before it is flagged, and the requests kept for the page
+        SQL_PROFILE=False,
+        SQL_PROFILE_REPEAT_THRESHOLD=5,
+        SQL_PROFILE_HISTORY=200,
     )
 
     if test_config is None:
@@ -25,6 +58,27 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import sessions
+    sessions.init_app(app)
+
+    from . import profiling
+    profiling.init_app(app)
+
+    from . import export
+    export.init_app(app)
+
+    from . import simulation
+    simulation.init_app(app)
+
+    from . import markov
+    markov.init_app(app)
+
+    from . import importer
+    importer.init_app(app)
+
+    from . import versions
+    versions.init_app(app)
+
     from . import welcome
     app.register_blueprint(welcome.bp)
 
@@ -34,6 +88,7 @@ def create_app(test_config=None):
     from . import gameplay
     app.register_blueprint(gameplay.bp)
 
-    return app
+    from . import api
+    app.register_blueprint(api.bp)
 
-app = create_app()
+    return app
@@ -0,0 +1,89 @@
+import sqlite3
+from monopoly_companion.game_state import StaleGameState
+from monopoly_companion.scoreboard import delta
+
+# this module applies an ordered batch of gameplay actions to a game as a single unit. Every action is applied in
+# memory, and the resulting rows (with any changes still unflushed from before) are written by one flush, which the
+# database writer runs in a savepoint of its own. If any action is invalid or the write fails, nothing of the batch
+# reaches the database and the in-memory state is returned to where it was before the batch, so either every action
+# happens or none does.
+
+class ActionError(Exception):
+    # an action of a batch could not be applied; index is its position in the batch
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+        self.message = message
+
+def go(state, player_id, turn, action):
+    return state.go(player_id, turn, bool(action.get('landed_on', False)))
+
+def rent(state, player_id, turn, action):
+    rent_due, comment = state.rent(player_id, action['property_name'], turn, action.get('dice_roll'))
+    if rent_due is None:
+        raise ValueError(comment)
+    return comment
+
+def purchase_property(state, player_id, turn, action):
+    return state.purchase_property(player_id, action['property_name'], turn)
+
+def undo(state, player_id, turn, action):
+    return state.undo_action(turn)
+
+# handlers by action name; None for actions the game does not support yet
+ACTIONS = {
+    'go': go,
+    'rent': rent,
+    'purchase_property': purchase_property,
+    'undo': undo,
+    'build': None,
+    'mortgage': None,
+    'tax': None,
+}
+
+def apply_actions(config, state, actions, player_id, turn):
+    # apply a batch of actions ({'action': name, ...parameters}, optionally with its own player_id and turn) and
+    # commit them together through the database writer of config. Returns the comment of each action, the journaled
+    # events and the change in the state snapshot. Raises ActionError, after rolling everything back, if an action or
+    # the write fails; any other error is raised after the same rollback.
+    with state.lock:
+        savepoint = state.savepoint()
+        before = savepoint[0]
+        unflushed = len(state.pending_transactions)
+        first_sequence = state.next_sequence
+
+        comments = []
+        try:
+            for index, action in enumerate(actions):
+                if not isinstance(action, dict):
+                    raise ActionError(index, "Expected an object with an action name")
+                handler = ACTIONS.get(action.get('action'))
+                if handler is None:
+                    if action.get('action') in ACTIONS:
+                        raise ActionError(index, str(action['action']) + " is not supported yet")
+                    raise ActionError(index, "Unknown action " + str(action.get('action')))
+                try:
+                    comments.append(handler(state, int(action.get('player_id', player_id)), int(action.get('turn', turn)), action))
+                except KeyError as error:
+                    raise ActionError(index, "Unknown or missing " + str(error))
+                except (TypeError, ValueError) as error:
+                    raise ActionError(index, str(error))
+
+            events = state.pending_transactions[unflushed:]
+            try:
+                state.commit(config)
+            except (StaleGameState, sqlite3.Error) as error:
+                raise ActionError(len(comments), str(error))
+        except BaseException:
+            # whatever failed, including an unexpected error or a full writer queue, none of the batch is kept
+            state.rollback(savepoint)
+            raise
+
+        changes = delta(before, state.snapshot())
+    return {
+        'first_sequence': first_sequence,
+        'sequence': state.next_sequence - 1,
+        'comments': comments,
+        'events': events,
+        'delta': changes,
+    }
@@ -0,0 +1,207 @@
+import tempfile
+from monopoly_companion.actions import ActionError, apply_actions
+from flask import Blueprint, Response, abort, current_app, jsonify, request, send_file, stream_with_context
+from monopoly_companion.db import get_db, get_player_rollup, get_property_rollup
+from monopoly_companion.export import EXPORT_COLUMNS, FORMATS, MIMETYPES, stream_csv, write_export
+from monopoly_companion.game_state import StaleGameState, get_game_state, loaded_game_state
+from monopoly_companion.markov import get_landing_probabilities
+from monopoly_companion.projection import cancel_projection, get_projection, start_projection
+from monopoly_companion.replay import seek
+from monopoly_companion.scoreboard import publish_scoreboard, stream
+from monopoly_companion.simulation import PLAYERS, SEED, get_simulation
+from monopoly_companion.versions import check_revision
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# this blueprint contains the JSON endpoints used by charts and other clients.
+
+def flush_game(db, game_id):
+    # write the actions of a game still held in memory, revalued first if another process reloaded the board of its
+    # version, or respond 404 if there is no such game. A game this worker has not loaded is only read from the
+    # database, so reading archived games does not fill the registry of loaded games.
+    state = loaded_game_state(game_id, current_app.config['DATABASE'])
+    if state is None:
+        if db.execute("SELECT 1 FROM game WHERE game_id = ?", (game_id,)).fetchone() is None:
+            abort(404)
+        return
+    check_revision(db, state.game_version_id, current_app.config['DATABASE'])
+    try:
+        state.commit(current_app.config)
+    except StaleGameState:
+        # the database already holds what another worker wrote; the actions held here are dropped with the state
+        pass
+    return
+
+@bp.route("/games/<int:game_id>/state", methods=("GET",))
+def game_state(game_id):
+    # state of a game after the given turn or event sequence number, or the latest state if neither is given
+    db = get_db()
+    turn = request.args.get('turn', type=int)
+    sequence = request.args.get('sequence', type=int)
+
+    # write any actions still held in memory so the journal is complete
+    flush_game(db, game_id)
+
+    try:
+        state = seek(db, game_id, turn, sequence)
+    except ValueError as error:
+        abort(404, str(error))
+
+    return jsonify(state.snapshot())
+
+@bp.route("/games/<int:game_id>/export/<table>.<fmt>", methods=("GET",))
+def export_game(game_id, table, fmt):
+    # download one game's statistics. CSV is streamed chunk by chunk; the binary formats are written to a
+    # spooled temporary file first (their writers need a seekable file) and sent from there.
+    if table not in EXPORT_COLUMNS or fmt not in FORMATS:
+        abort(404)
+
+    db = get_db()
+    flush_game(db, game_id)
+
+    download_name = table + '_' + str(game_id) + '.' + fmt
+
+    if fmt == 'csv':
+        return Response(
+            stream_with_context(stream_csv(db, table, game_id)),
+            mimetype=MIMETYPES[fmt],
+            headers={'Content-Disposition': 'attachment; filename=' + download_name}
+        )
+
+    f = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    try:
+        write_export(db, table, fmt, f, game_id)
+    except ImportError as error:
+        f.close()
+        abort(501, fmt + " export needs an optional dependency: " + str(error))
+    f.seek(0)
+
+    return send_file(f, mimetype=MIMETYPES[fmt], as_attachment=True, download_name=download_name)
+
+@bp.route("/game-versions/<int:game_version_id>/simulation", methods=("GET",))
+def simulation(game_version_id):
+    # landing frequency, expected rent, payback period and ROI per property and rent level for a game version,
+    # simulated once per set of parameters and then served from the cache
+    config = current_app.config
+    games = request.args.get('games', config['SIMULATION_GAMES'], type=int)
+    turns = request.args.get('turns', config['SIMULATION_TURNS'], type=int)
+    players = request.args.get('players', PLAYERS, type=int)
+    seed = request.args.get('seed', SEED, type=int)
+
+    if games < 1 or turns < 1 or players < 2:
+        abort(400, "games and turns must be positive and players at least 2")
+    if games * turns > config['SIMULATION_MAX_TURNS']:
+        abort(400, "At most " + str(config['SIMULATION_MAX_TURNS']) + " simulated turns per request")
+
+    try:
+        result = get_simulation(get_db(), game_version_id, games, turns, players, seed, config['SIMULATION_WORKERS'], config['DATABASE'])
+    except ImportError as error:
+        abort(501, "Simulation needs an optional dependency: " + str(error))
+    except ValueError as error:
+        abort(404, str(error))
+
+    return jsonify(result)
+
+@bp.route("/game-versions/<int:game_version_id>/landing-probabilities", methods=("GET",))
+def landing_probabilities(game_version_id):
+    # exact landing probability per roll and per turn, and mean dice roll, of every square of a game version
+    try:
+        probabilities = get_landing_probabilities(get_db(), game_version_id, current_app.config['DATABASE'], current_app.config)
+    except ImportError as error:
+        abort(501, "Solving the board needs an optional dependency: " + str(error))
+    except ValueError as error:
+        abort(404, str(error))
+
+    return jsonify([
+        {'board_position': square, 'probability_per_roll': per_roll, 'probability_per_turn': per_turn, 'mean_dice_roll': mean_dice_roll}
+        for square, (per_roll, per_turn, mean_dice_roll) in sorted(probabilities.items())
+    ])
+
+@bp.route("/games/<int:game_id>/projection", methods=("GET",))
+def projection(game_id):
+    # the latest win projection of a game, refined as batches of rollouts finish. A new projection is started when
+    # there is none or the game has changed since it was forked (player_id sets who moves first, turns the horizon).
+    config = current_app.config
+    db = get_db()
+    flush_game(db, game_id)
+
+    turns = request.args.get('turns', config['PROJECTION_TURNS'], type=int)
+    player_id = request.args.get('player_id', type=int)
+    sequence = db.execute(
+        "SELECT IFNULL(MAX(sequence), 0) FROM transactions WHERE game_id = ?",
+        (game_id,)
+    ).fetchone()[0]
+
+    projection = get_projection(game_id, config['DATABASE'])
+    if projection is None or projection.sequence != sequence or projection.turns != turns or player_id not in (None, projection.player_ids[0]):
+        try:
+            projection = start_projection(
+                db, game_id, player_id, config['PROJECTION_ROLLOUTS'], turns, config['PROJECTION_TIME_BUDGET'],
+                config['PROJECTION_BATCH_SIZE'], config['PROJECTION_WORKERS'], database=config['DATABASE'], config=config
+            )
+        except ImportError as error:
+            abort(501, "Projection needs an optional dependency: " + str(error))
+        except ValueError as error:
+            abort(404, str(error))
+
+    return jsonify(projection.result())
+
+@bp.route("/games/<int:game_id>/projection", methods=("DELETE",))
+def delete_projection(game_id):
+    # cancel the running projection of a game
+    projection = cancel_projection(game_id, current_app.config['DATABASE'])
+    if projection is None:
+        abort(404)
+    return jsonify(projection.result())
+
+@bp.route("/games/<int:game_id>/rollup/<kind>", methods=("GET",))
+def rollup(game_id, kind):
+    # per-turn statistics of the players or properties of a game, optionally for one player_id or property_id
+    # and a range of turns, read straight from the rollup tables
+    if kind not in ('players', 'properties'):
+        abort(404)
+
+    db = get_db()
+    flush_game(db, game_id)
+
+    first_turn = request.args.get('first_turn', 0, type=int)
+    last_turn = request.args.get('last_turn', type=int)
+    if kind == 'players':
+        rows = get_player_rollup(db, game_id, request.args.get('player_id', type=int), first_turn, last_turn)
+    else:
+        rows = get_property_rollup(db, game_id, request.args.get('property_id', type=int), first_turn, last_turn)
+
+    return jsonify([dict(row) for row in rows])
+
+@bp.route("/games/<int:game_id>/scoreboard/stream", methods=("GET",))
+def scoreboard_stream(game_id):
+    # Server-Sent Events with the live scoreboard of a game: the full scoreboard on connect, then only changed fields
+    return Response(
+        stream(game_id, current_app.config['DATABASE']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route("/games/<int:game_id>/actions", methods=("POST",))
+def actions(game_id):
+    # apply an ordered batch of actions in one transaction, e.g.
+    # {"player_id": 3, "turn": 4, "actions": [{"action": "go"}, {"action": "rent", "property_name": "Brink"}]}.
+    # Returns the comments, journaled events and state delta, or the failing action with nothing applied.
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('actions'), list) or 'player_id' not in body or 'turn' not in body:
+        abort(400, "Expected a JSON object with player_id, turn and a list of actions")
+
+    db = get_db()
+    try:
+        state = get_game_state(db, game_id, current_app.config['DATABASE'])
+    except KeyError:
+        abort(404)
+    check_revision(db, state.game_version_id, current_app.config['DATABASE'])
+
+    try:
+        result = apply_actions(current_app.config, state, body['actions'], body['player_id'], body['turn'])
+    except ActionError as error:
+        return jsonify({'error': error.message, 'action': error.index}), 400
+
+    publish_scoreboard(state, body['player_id'], body['turn'], current_app.config['DATABASE'])
+    return jsonify(result)
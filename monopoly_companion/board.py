@@ -0,0 +1,101 @@
+import hashlib
+import json
+
+# this module describes the board of a game version: which property sits on each of the BOARD_SIZE squares
+# (from the property table's board_position column) and where the standard special squares and card decks are.
+# It is shared by the Monte Carlo simulator and the Markov chain solver.
+
+BOARD_SIZE = 40
+
+GO = 0
+JAIL = 10
+GO_TO_JAIL = 30
+
+# a player in jail leaves on a double or, paying the fine, after this many turns
+JAIL_TURNS = 3
+
+CHANCE_SQUARES = [7, 22, 36]
+COMMUNITY_CHEST_SQUARES = [2, 17, 33]
+TAX_SQUARES = {4: 'income_tax', 38: 'luxury_tax'}
+FREE_PARKING = 20
+
+# card decks as a list of movements: a square number, 'jail', 'back_3', 'nearest_station', 'nearest_utility' or None (no movement)
+CHANCE_CARDS = [GO, 24, 11, 'nearest_utility', 'nearest_station', 'nearest_station', 'back_3', 'jail', 39, 5, None, None, None, None, None, None]
+COMMUNITY_CHEST_CARDS = [GO, 'jail', None, None, None, None, None, None, None, None, None, None, None, None, None, None]
+
+class Board:
+    __slots__ = ('game_version_id', 'property_ids', 'property_types', 'property_names', 'chance_cards', 'community_chest_cards')
+
+    def __init__(self, game_version_id, chance_cards=CHANCE_CARDS, community_chest_cards=COMMUNITY_CHEST_CARDS):
+        self.game_version_id = game_version_id
+        self.property_ids = [None] * BOARD_SIZE
+        self.property_types = [None] * BOARD_SIZE
+        self.property_names = [None] * BOARD_SIZE
+        self.chance_cards = list(chance_cards)
+        self.community_chest_cards = list(community_chest_cards)
+
+    @classmethod
+    def load(cls, db, game_version_id, chance_cards=CHANCE_CARDS, community_chest_cards=COMMUNITY_CHEST_CARDS):
+        board = cls(game_version_id, chance_cards, community_chest_cards)
+        rows = db.execute(
+            "SELECT property_id, property_name, property_type, board_position FROM property WHERE game_version_id = ?",
+            (game_version_id,)
+        ).fetchall()
+
+        if not rows:
+            raise ValueError("Game version " + str(game_version_id) + " has no properties")
+
+        for row in rows:
+            if row['board_position'] is None:
+                raise ValueError(row['property_name'] + " has no board_position")
+            position = row['board_position']
+            board.property_ids[position] = row['property_id']
+            board.property_types[position] = row['property_type']
+            board.property_names[position] = row['property_name']
+        return board
+
+    def positions(self, property_type):
+        return [position for position in range(BOARD_SIZE) if self.property_types[position] == property_type]
+
+    def nearest(self, square, property_type):
+        # first square of a property type at or after square, going round the board
+        positions = self.positions(property_type)
+        for step in range(BOARD_SIZE):
+            if (square + step) % BOARD_SIZE in positions:
+                return (square + step) % BOARD_SIZE
+        return None
+
+    def card_destination(self, square, card):
+        # the square a card drawn on square sends the player to, or None if the player stays. 'jail' sends the player
+        # to GO_TO_JAIL, so it is handled exactly like landing there.
+        if card is None:
+            return None
+        if card == 'jail':
+            return GO_TO_JAIL
+        if card == 'back_3':
+            return (square - 3) % BOARD_SIZE
+        if card == 'nearest_station':
+            return self.nearest(square, 'Station')
+        if card == 'nearest_utility':
+            return self.nearest(square, 'Utility')
+        return card
+
+    def card_passes_go(self, square, card):
+        # whether following a card moves the player forward past (or onto) GO
+        if card is None or card in ('jail', 'back_3'):
+            return False
+        return self.card_destination(square, card) < square
+
+    def card_table(self):
+        # for every square, (destination, passes_go) for each card that can be drawn there: a list of BOARD_SIZE lists,
+        # empty for squares without a card deck
+        table = [[] for square in range(BOARD_SIZE)]
+        for squares, cards in ((CHANCE_SQUARES, self.chance_cards), (COMMUNITY_CHEST_SQUARES, self.community_chest_cards)):
+            for square in squares:
+                table[square] = [(self.card_destination(square, card), self.card_passes_go(square, card)) for card in cards]
+        return table
+
+    def layout(self):
+        # short fingerprint of the squares and card decks, which identifies results computed for this board
+        description = json.dumps([self.property_types, self.card_table()])
+        return hashlib.sha1(description.encode('utf8')).hexdigest()[:16]
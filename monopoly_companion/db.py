@@ -1,15 +1,101 @@
+import atexit
+import csv
+import io
+import queue
 import sqlite3
+import threading
 import click
-from flask import current_app, g, session
-import pandas as pd
+from flask import current_app, g
+
+class ConnectionPool:
+    # long-lived, tuned connections to one database file. get_db checks a connection out for the
+    # duration of an app context and close_db hands it back, so the open cost and each connection's
+    # prepared statement cache survive between requests.
+    def __init__(self, database, size=8, timeout=5.0, synchronous='NORMAL', cached_statements=256, factory=sqlite3.Connection):
+        self.database = database
+        self.factory = factory
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        db = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=self.factory
+        )
+        db.row_factory = sqlite3.Row
+        # WAL lets readers carry on while a game commits, the busy timeout waits for the write lock instead of failing
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = " + self.synchronous)
+        db.execute("PRAGMA busy_timeout = " + str(int(self.timeout * 1000)))
+        return db
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, db):
+        # never hand an open transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        try:
+            self.idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(config):
+    # one pool per database file in this worker
+    with _pools_lock:
+        pool = _pools.get(config['DATABASE'])
+        if pool is None:
+            factory = sqlite3.Connection
+            if config.get('SQL_PROFILE'):
+                from monopoly_companion.profiling import ProfilingConnection
+                factory = ProfilingConnection
+            pool = ConnectionPool(
+                config['DATABASE'],
+                size=config.get('DATABASE_POOL_SIZE', 8),
+                timeout=config.get('DATABASE_TIMEOUT', 5.0),
+                synchronous=config.get('DATABASE_SYNCHRONOUS', 'NORMAL'),
+                cached_statements=config.get('DATABASE_CACHED_STATEMENTS', 256),
+                factory=factory
+            )
+            _pools[config['DATABASE']] = pool
+    return pool
+
+@atexit.register
+def close_pools():
+    # closing the last connection checkpoints the WAL back into the database file
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+    return
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool(current_app.config).acquire()
+        # with SQL_PROFILE the statements of the request are recorded in its profile
+        if 'sql_profile' in g:
+            g.db.profile = g.sql_profile
 
     return g.db
 
@@ -17,7 +103,9 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        if getattr(db, 'profile', None) is not None:
+            db.profile = None
+        get_pool(current_app.config).release(db)
 
 def init_db():
     db = get_db()
@@ -25,388 +113,266 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    init_data(db)
+
 @click.command('init-db')
 def init_db_command():
     """Clear the existing data and create new tables"""
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('delete-game')
+@click.argument('game_id', type=int)
+def delete_game_command(game_id):
+    """Delete a single game and all of its rows"""
+    delete_game(get_db(), game_id)
+    click.echo('Deleted game ' + str(game_id) + '.')
+
+@click.command('rebuild-rollups')
+@click.argument('game_id', type=int, required=False)
+def rebuild_rollups_command(game_id):
+    """Regenerate the per-turn rollups of one game, or every game if no GAME_ID is given, from the journal"""
+    db = get_db()
+    if game_id is None:
+        game_ids = [row['game_id'] for row in db.execute("SELECT game_id FROM game ORDER BY game_id")]
+    else:
+        game_ids = [game_id]
+    for game_id in game_ids:
+        rebuild_rollups(db, game_id)
+    click.echo('Rebuilt the rollups of ' + str(len(game_ids)) + ' game(s).')
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(delete_game_command)
+    app.cli.add_command(rebuild_rollups_command)
     
+# cells of the reference CSVs that are loaded as NULL
+NULL_VALUES = {'', 'null'}
+
 def init_data(db):
-    db.executescript(
-        """
-        DELETE FROM action_type;
-        DELETE FROM game_version;
-        DELETE FROM players;
-        DELETE FROM property;
-        DELETE FROM special_counter;
-        DELETE FROM net_worth;
-        DELETE FROM net_worth_log;
-        DELETE FROM transactions;
-        DELETE FROM property_ownership;
-        VACUUM;
-        """
-    )
-    df_tables = ['action_type', 'game_version', 'players', 'property']
-    for df in df_tables:
-        data = pd.read_csv(current_app.open_resource('static/' + df + '.csv'))
-        data.to_sql(df, con=db, if_exists="append", index=False)
+    # load the reference tables shared by all games. Only called from init_db, games are created and deleted individually.
+    # Each CSV is inserted with one executemany; the column affinity of schema.sql turns the numeric text into numbers.
+    for table in ['action_type', 'game_version', 'players', 'property']:
+        with current_app.open_resource('static/' + table + '.csv') as f:
+            rows = csv.reader(io.TextIOWrapper(f, encoding='utf-8', newline=''))
+            columns = next(rows)
+            db.executemany(
+                "INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")",
+                ([None if value in NULL_VALUES else value for value in row] for row in rows if row)
+            )
 
     db.commit()
-    session.clear()
     return
 
-def init_property_ownership(db, game_version_id):
-    properties = db.execute(
-        "SELECT * FROM property WHERE game_version_id = ?",
-        (game_version_id,)
-        ).fetchall()
-    
-    # commented out because syntax could be useful in another case but we already delete property_ownership data in init_data
-    # ownership_not_empty = db.execute(
-    #     "SELECT EXISTS (SELECT 1 FROM property_ownership)"
-    #     ).fetchall()
-    # print(ownership_not_empty[0][0])
-    # if ownership_not_empty[0][0] == 1:
-    #     db.execute(
-    #         "DELETE FROM property_ownership"
-    #     )
-    property_names = []
-
-    for prop in properties:
+def create_game(db, game_version_id, no_of_players, double_go, database=None, commit=True):
+    # add a row to the game table and set up its property ownership. Returns the new game_id, which scopes all game data.
+    game_id = db.execute(
+        "INSERT INTO game (game_version_id, no_of_players, double_go) VALUES (?, ?, ?)",
+        (game_version_id, no_of_players, double_go)
+    ).lastrowid
+
+    init_property_ownership(db, game_id, get_game_template(db, game_version_id, database))
+    if commit:
+        db.commit()
+    return game_id
+
+def delete_game(db, game_id):
+    # remove every row belonging to one game. Each table is indexed on game_id, so this only touches that game's rows.
+    for table in ['state_checkpoint', 'player_turn_rollup', 'property_turn_rollup', 'transactions', 'net_worth_log', 'net_worth', 'special_counter', 'city_ownership', 'property_ownership', 'players', 'game']:
         db.execute(
-            "INSERT INTO property_ownership VALUES (?, 1, FALSE, 0, 0, 0, FALSE)",
-            (prop['property_id'],)
+            "DELETE FROM " + table + " WHERE game_id = ?",
+            (game_id,)
         )
 
-        property_names.append(prop['property_name'])
-
     db.commit()
-
-    update_number_owned(db)
-    update_max_number_owned(db)
-
-    session['property_names'] = property_names
-    return 
-
-def init_special_counter(db, player_id):
-    # fill the special_counter table with a row for the player, but leave all values at 0. This is called in a loop through all players in player registration
-
-    db.execute(
-        """
-        INSERT INTO special_counter (turn, player_id, jail_counter, free_parking_counter, income_tax_counter, luxury_tax_counter, land_on_start_counter, chance_counter, community_chest_counter)
-        VALUES (0, ?, 0, 0, 0, 0, 0, 0, 0)
-        """,
-        (player_id,)
-    )
-
     return
 
-def update_max_number_owned(db):
-    # update the "max_number_owned" field in the property_ownership table to enable comparison to number owned to determine "monopoly" column
-    # only needs to be called once at the beginning
-    cities = db.execute(
-        """
-        SELECT DISTINCT city from property 
-        """
-    ).fetchall()
-    
-    for row in cities:
-        db.execute(
-            """
-            UPDATE property_ownership
-            SET max_number_owned = 
-                (SELECT 
-                COUNT(property.property_id) AS max_number_owned_in_city
-                from 
-                property
-                WHERE
-                property.city = ?)
-            WHERE property_id IN 
-                (SELECT
-                property_id
-                FROM
-                property
-                WHERE
-                property.city = ?)
-            """,
-            (row['city'], row['city'])
-        )
+class GameTemplate:
+    # the rows every new game of a game version starts with, read from the reference tables once per version.
+    # At the start the bank owns every property, unmortgaged and unimproved, so its property values are fixed per version.
+    __slots__ = ('game_version_id', 'total_cash', 'starting_cash_balance', 'property_ids', 'property_names', 'city_counts', 'bank_property_value')
+
+    @classmethod
+    def compile(cls, db, game_version_id):
+        template = cls()
+        template.game_version_id = game_version_id
+        template.total_cash, template.starting_cash_balance = db.execute(
+            "SELECT total_cash, starting_cash_balance FROM game_version WHERE game_version_id = ?",
+            (game_version_id,)
+        ).fetchone()
+
+        properties = db.execute(
+            "SELECT property_id, property_name, city, price FROM property WHERE game_version_id = ? ORDER BY property_id",
+            (game_version_id,)
+        ).fetchall()
+        template.property_ids = [prop['property_id'] for prop in properties]
+        template.property_names = [prop['property_name'] for prop in properties]
+
+        city_counts = {}
+        for prop in properties:
+            city_counts[prop['city']] = city_counts.get(prop['city'], 0) + 1
+        template.city_counts = list(city_counts.items())
+
+        # net property value, improvement value and gross property value, as GameState.property_values computes them
+        total_price = sum(prop['price'] for prop in properties)
+        template.bank_property_value = (total_price, 0, total_price)
+        return template
+
+def placeholders(rows, row):
+    # the VALUES list of a multi-row INSERT, so a whole set of rows is written by one statement
+    return ", ".join([row] * rows)
+
+def insert_rows(db, insert, row, rows):
+    # write rows (tuples matching the placeholders of row) with a single multi-row INSERT; nothing to do for no rows
+    if rows:
+        db.execute(insert + " VALUES " + placeholders(len(rows), row), [value for values in rows for value in values])
+    return
 
-    db.commit()
+_game_templates = {}
+_game_templates_lock = threading.Lock()
+
+def get_game_template(db, game_version_id, database=None):
+    # return the template of a game version, reading it on first use
+    with _game_templates_lock:
+        template = _game_templates.get((database, game_version_id))
+        if template is None:
+            template = GameTemplate.compile(db, game_version_id)
+            _game_templates[(database, game_version_id)] = template
+    return template
+
+def invalidate_game_template(game_version_id, database=None):
+    # drop a template so it is read again from the reference tables on next use
+    with _game_templates_lock:
+        _game_templates.pop((database, game_version_id), None)
     return
 
-def update_number_owned(db):
-    # get a joined table containing owner id-city combos with counts
-    city_ownership = db.execute(
-        """
-        SELECT 
-        property_ownership.owner_player_id,
-        property.city,
-        COUNT(property.property_id) AS number_owned_in_city
-        from 
-        property_ownership 
-        LEFT JOIN 
-        property
-        ON
-        property_ownership.property_id = property.property_id
-        GROUP BY
-        property.city,
-        property_ownership.owner_player_id;
-        """
+def init_property_ownership(db, game_id, template):
+    # copy the template's ownership rows into the new game in one statement: the bank owns every property
+    insert_rows(
+        db,
+        "INSERT INTO property_ownership (game_id, property_id, owner_player_id, mortgaged, houses, hotels)",
+        "(?, ?, 1, FALSE, 0, 0)",
+        [(game_id, property_id) for property_id in template.property_ids]
     )
 
-    # for each row in the owner-city combo table, 
-    # collect the variables we need for update and update the ownership table. 
-    # This requires us to check which properties are in the cities, since ownership table doesn't have a city field. 
-    for city_owner_combo in city_ownership:
-        number_owned = city_owner_combo['number_owned_in_city']
-        owner_id = city_owner_combo['owner_player_id']
-        city = city_owner_combo['city']
-        
-        db.execute(
-            """
-            UPDATE 
-            property_ownership
-            SET 
-            number_owned = ?
-            WHERE
-            owner_player_id = ? 
-            AND 
-            property_id IN 
-                (SELECT
-                property_id
-                FROM
-                property
-                WHERE
-                property.city = ?)
-            """,
-            (number_owned, owner_id, city,)
-        )
-        
-    db.commit()
-
+    init_city_ownership(db, game_id, template)
     return 
 
-def starting_cash(no_of_players, player_names, total_cash, starting_cash_per_player):
-    # at the beginning of the game, calculate the starting cash values of the bank, based on number of players and starting cash per player  
-    # create a dictionary with keys = player_ids and value a list with name and starting cash
-    player_names_incl_static = ["Bank", "Free Parking"] + player_names    
-    player_starting_cash = {}
-    
-    bank_starting_cash = total_cash - (starting_cash_per_player * no_of_players)
-
-    for player in player_names_incl_static:
-        player_id = player_names_incl_static.index(player)+1
-        if player == "Bank":
-            player_starting_cash[1] = ["Bank", bank_starting_cash]
-        elif player == "Free Parking":
-            player_starting_cash[2] = ["Free Parking", 0]
-        else:
-            player_starting_cash[player_names_incl_static.index(player)+1] = [player, starting_cash_per_player] 
+def register_players(db, game_id, template, player_names):
+    # add the players of a new game, in the order given, with their starting net worth and special counters.
+    # Each table is written with a single multi-row INSERT. Returns a dictionary with key = player_id and value [name, player_order].
+    rows = db.execute(
+        "INSERT INTO players (game_id, player_name, player_order) VALUES " + placeholders(len(player_names), "(?, ?, ?)") + " RETURNING player_id, player_order",
+        [value for order, player_name in enumerate(player_names, start=1) for value in (game_id, player_name, order)]
+    ).fetchall()
+    player_ids = {row['player_order']: row['player_id'] for row in rows}
+    player_dict = {player_ids[order]: [player_name, order] for order, player_name in enumerate(player_names, start=1)}
 
-    return player_starting_cash
+    player_starting_cash = starting_cash(player_dict, template.total_cash, template.starting_cash_balance)
+    property_values = {1: template.bank_property_value}
 
-def get_gross_property_value(db):
-    # get all rows with player_id and sum of property price (value) owned by that player
+    insert_rows(
+        db,
+        "INSERT INTO net_worth (game_id, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value)",
+        "(?, 0, ?, ?, ?, ?, ?)",
+        [(game_id, player_id, player_starting_cash[player_id][1]) + property_values.get(player_id, (0, 0, 0)) for player_id in player_starting_cash]
+    )
+    insert_rows(
+        db,
+        "INSERT INTO special_counter (game_id, turn, player_id, jail_counter, free_parking_counter, income_tax_counter, luxury_tax_counter, land_on_start_counter, chance_counter, community_chest_counter)",
+        "(?, 0, ?, 0, 0, 0, 0, 0, 0, 0)",
+        [(game_id, player_id) for player_id in player_starting_cash]
+    )
 
-    gross_property_value = db.execute(
-        """
-        SELECT
-        players.player_id,
-        IFNULL(SUM(property.price), 0) AS gross_property_value
-        from 
-        players
-        LEFT JOIN 
-        property_ownership
-        ON
-        players.player_id = property_ownership.owner_player_id
-        LEFT JOIN
-        property
-        ON
-        property_ownership.property_id = property.property_id
-        GROUP BY
-        property_ownership.owner_player_id
-        ORDER BY 
-        players.player_id ASC 
-        """
-    ).fetchall()
+    log_net_worth(db, game_id, 0)
+    return player_dict
 
-    return gross_property_value
+def init_city_ownership(db, game_id, template):
+    # seed the ownership index: at the start the bank owns every property, so each city has one row with number_owned = max_number_owned
+    insert_rows(
+        db,
+        "INSERT INTO city_ownership (game_id, city, owner_player_id, number_owned, max_number_owned)",
+        "(?, ?, 1, ?, ?)",
+        [(game_id, city, number_owned, number_owned) for city, number_owned in template.city_counts]
+    )
+    return
 
-def get_mortgaged_property_value(db):
-    # get all rows with player_id and sum of mortgage_value field for all owned property that is currently mortgaged 
-    mortgaged_property_value = db.execute(
+def update_city_ownership(db, game_id, city_owner_counts):
+    # write (city, owner_player_id, number_owned, max_number_owned) counters to the ownership index
+    db.executemany(
         """
-        SELECT
-        players.player_id,
-        IFNULL(SUM(property.mortgage_value), 0) AS mortgaged_property_value
-        FROM 
-        players
-        LEFT JOIN 
-        property_ownership
-        ON
-        players.player_id = property_ownership.owner_player_id
-        LEFT JOIN
-        property
-        ON
-        property_ownership.property_id = property.property_id
-        WHERE 
-        property_ownership.mortgaged = TRUE        
-        GROUP BY
-        property_ownership.owner_player_id
-        ORDER BY 
-        players.player_id ASC 
-        """
-    ).fetchall()
-
-    return mortgaged_property_value
+        INSERT INTO city_ownership (game_id, city, owner_player_id, number_owned, max_number_owned)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (game_id, city, owner_player_id) DO UPDATE SET number_owned = excluded.number_owned
+        """,
+        [(game_id, city, owner_player_id, number_owned, max_number_owned) for city, owner_player_id, number_owned, max_number_owned in city_owner_counts]
+    )
+    return
 
-def get_unmortgaged_property_value(db):
-    # get all rows with player_id and sum of price field for all owned property that is not currently mortgaged 
-    unmortgaged_property_value = db.execute(
-        """
-        SELECT
-        players.player_id,
-        IFNULL(SUM(property.price), 0) AS unmortgaged_property_value
-        FROM 
-        players
-        LEFT JOIN 
-        property_ownership
-        ON
-        players.player_id = property_ownership.owner_player_id
-        LEFT JOIN
-        property
-        ON
-        property_ownership.property_id = property.property_id
-        WHERE 
-        property_ownership.mortgaged = FALSE        
-        GROUP BY
-        property_ownership.owner_player_id
-        ORDER BY 
-        players.player_id ASC 
+def revalue_games(db, game_version_id):
+    # revalue the property holdings in the net_worth rows of every game of a version at its current prices, the same way
+    # as GameState.property_values, after its board was reloaded. Players without properties keep their values of 0.
+    db.execute(
         """
-    ).fetchall()
-
-    return unmortgaged_property_value
-
-def get_property_value(db, player_names):
-    # create a dictionary with key = player_id and values being a list of player name and 
-    # sum of the results of the mortgaged_property_value and unmortgaged_property_value functions 
+        UPDATE net_worth SET
+        net_property_value = holdings.net_property_value,
+        improvement_value = holdings.improvement_value,
+        gross_property_value = holdings.gross_property_value
+        FROM
+            (SELECT
+            property_ownership.game_id,
+            property_ownership.owner_player_id AS player_id,
+            SUM(CASE WHEN property_ownership.mortgaged THEN property.mortgage_value ELSE property.price END) AS net_property_value,
+            SUM(CASE WHEN property_ownership.hotels = 1 THEN 5 * IFNULL(property.house_cost, 0) ELSE property_ownership.houses * IFNULL(property.house_cost, 0) END) AS improvement_value,
+            SUM(property.price) AS gross_property_value
+            FROM property_ownership
+            JOIN property
+            ON property_ownership.property_id = property.property_id
+            WHERE property.game_version_id = ?
+            GROUP BY property_ownership.game_id, property_ownership.owner_player_id) AS holdings
+        WHERE net_worth.game_id = holdings.game_id
+        AND net_worth.player_id = holdings.player_id
+        """,
+        (game_version_id,)
+    )
+    return
 
-    property_value = {}
-    
-    player_names_incl_static = ["Bank", "Free Parking"] + player_names
-    mortgaged_property_value = get_mortgaged_property_value(db)
-    unmortgaged_property_value = get_unmortgaged_property_value(db)
-    gross_property_value = get_gross_property_value(db)
-    improvement_value = get_improvement_value(db)
-        
-    for player in player_names_incl_static:
-        property_value[player_names_incl_static.index(player)+1] = [0, 0, 0, 0, 0, 0]
-        property_value[player_names_incl_static.index(player)+1][0] = player
-
-    for row in mortgaged_property_value:
-        property_value[row['player_id']][1] = row['mortgaged_property_value']
-
-    for row in unmortgaged_property_value:
-        property_value[row['player_id']][2] = row['unmortgaged_property_value']
+def starting_cash(player_dict, total_cash, starting_cash_per_player):
+    # at the beginning of the game, calculate the starting cash values of the bank, based on number of players and starting cash per player  
+    # create a dictionary with keys = player_ids and value a list with name and starting cash
+    player_starting_cash = {}
     
-    for key in property_value.keys():
-        property_value[key][3] = property_value[key][1] + property_value[key][2]
-
-    for row in gross_property_value:
-        property_value[row['player_id']][4] = row['gross_property_value']
-
-    for row in improvement_value:
-        property_value[row['player_id']][5] = row['improvement_value']
+    bank_starting_cash = total_cash - (starting_cash_per_player * len(player_dict))
 
-    return property_value
+    player_starting_cash[1] = ["Bank", bank_starting_cash]
+    player_starting_cash[2] = ["Free Parking", 0]
+    for player_id in player_dict:
+        player_starting_cash[int(player_id)] = [player_dict[player_id][0], starting_cash_per_player] 
 
-def get_improvement_value(db):
-    # get all rows with player_id and the sum of the value of all houses and hotels on property owned by that player
-    improvement_values = db.execute(
-        """
-        SELECT
-        players.player_id,
-        IFNULL(CASE WHEN property_ownership.hotels = 1 THEN SUM(5* property.house_cost) ELSE SUM(property_ownership.houses * property.house_cost) END, 0) AS improvement_value
-        FROM 
-        players
-        LEFT JOIN 
-        property_ownership
-        ON
-        players.player_id = property_ownership.owner_player_id
-        LEFT JOIN
-        property
-        ON
-        property_ownership.property_id = property.property_id
-        GROUP BY
-        players.player_id
-        ORDER BY 
-        players.player_id ASC 
-        """
-    ).fetchall()
+    return player_starting_cash
 
-    return improvement_values
+def next_player(db, game_id, current_player_order, no_of_players, turn, commit=True):
+    # increment the current_player_order up to the no_of_players, at which point it restarts at order 1 and increments turn
+    # (commit=False leaves the commit to the caller, e.g. the database writer)
 
-def get_net_worth(db):
-    # get net_worth rows for all players to represent current net_worth
-    current_net_worth_table = db.execute(
-        """
-        SELECT 
-        net_worth_id,
-        net_worth_time,
-        player_id,
-        cash_balance,
-        net_property_value,
-        improvement_value,
-        gross_property_value,
-        net_worth
-        FROM
-        net_worth
-        """
-    ).fetchall()
+    if current_player_order == no_of_players:
+        log_net_worth(db, game_id, turn) # think about how to unlog net_worth when previous_player or undo_action
+    current_player_order, turn = following_player(current_player_order, no_of_players, turn)
     
+    if commit:
+        db.commit()
+    return current_player_order, turn
 
-    try:
-        for row in current_net_worth_table:
-            session['net_worths'][str(row['player_id'])][0] = row['cash_balance']
-            session['net_worths'][str(row['player_id'])][1] = row['net_property_value']
-            session['net_worths'][str(row['player_id'])][2] = row['improvement_value']
-            session['net_worths'][str(row['player_id'])][3] = row['gross_property_value']
-            session['net_worths'][str(row['player_id'])][4] = row['net_worth']
-    except:
-        session['net_worths'] = {}
-        for row in current_net_worth_table:
-            session['net_worths'][str(row['player_id'])] = [0, 0, 0, 0, 0]
-            session['net_worths'][str(row['player_id'])][0] = row['cash_balance']
-            session['net_worths'][str(row['player_id'])][1] = row['net_property_value']
-            session['net_worths'][str(row['player_id'])][2] = row['improvement_value']
-            session['net_worths'][str(row['player_id'])][3] = row['gross_property_value']
-            session['net_worths'][str(row['player_id'])][4] = row['net_worth']
-        
-    return current_net_worth_table, session['net_worths']
-
-def update_net_worth_turn(db):
-    db.execute("UPDATE net_worth SET turn = ? WHERE player_id IN (1, 2, ?)",
-               (session['current_turn'], session['current_player_id'])
-               )
-    return
-
-def next_player(db, current_player_order, no_of_players, turn):
-    # increment the current_player_order up to the no_of_players, at which point it restarts at order 1 and increments turn
+def following_player(current_player_order, no_of_players, turn):
+    # increment the current_player_order up to the no_of_players, at which point it restarts at order 1 and increments turn,
+    # without logging the net worth (gameplay leaves that to the turn end pipeline)
 
     if current_player_order == no_of_players:
-        current_player_order = 1 
+        current_player_order = 1
         turn += 1
-        log_net_worth(db) # think about how to unlog net_worth when previous_player or undo_action
     else:
         current_player_order += 1
-    
-    db.commit()
     return current_player_order, turn
 
 def previous_player(current_player_order, no_of_players, turn):
@@ -419,240 +385,249 @@ def previous_player(current_player_order, no_of_players, turn):
         current_player_order -= 1
     return current_player_order, turn
 
-def undo_action():
-    return
-
 # this section contains the functions for action-type database updates. This will make the code in index() easier to understand.
-def log_net_worth(db):
+def log_net_worth(db, game_id, turn, balances=None):
     # add rows to net_worth_log table that contain the most recent net_worth data. This is to be used whenever a turn ends.
-    
-    # copy all data from net_worth to log_net_worth 
-    db.execute(
-        """
-        INSERT INTO net_worth_log (net_worth_time, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth)
-        SELECT net_worth_time, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth FROM net_worth
-        """
-    )
-    return
+    # balances are the (player_id, net_worth_time, cash_balance, net_property_value, improvement_value, gross_property_value)
+    # rows of the end of the turn, for callers that log a turn after it ended; the net_worth rows are used if not given.
+    if balances is None:
+        source = "SELECT player_id, net_worth_time, cash_balance, net_property_value, improvement_value, gross_property_value FROM net_worth WHERE game_id = ?"
+        parameters = [game_id]
+    elif balances:
+        source = "VALUES " + placeholders(len(balances), "(?, ?, ?, ?, ?, ?)")
+        parameters = [value for balance in balances for value in balance]
+    else:
+        return
+    balance = "WITH balance (player_id, net_worth_time, cash_balance, net_property_value, improvement_value, gross_property_value) AS (" + source + ")"
 
-def record_transaction(db, turn, party_player_id, counterparty_player_id, action_type_id, property_id=None, cash_received=None, cash_paid=None, asset_value_received=None, asset_value_paid=None):
+    # the log is delta-encoded: a player's net_worth row is only copied when it differs from that player's last logged row.
+    # get_net_worth_series fills in the turns in between.
     db.execute(
-        """
-        INSERT INTO transactions (turn, party_player_id, counterparty_player_id, action_type_id, property_id, cash_received, cash_paid, asset_value_received, asset_value_paid)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        balance + """
+        INSERT INTO net_worth_log (game_id, net_worth_time, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth)
+        SELECT ?, balance.net_worth_time, ?, balance.player_id, balance.cash_balance, balance.net_property_value, balance.improvement_value, balance.gross_property_value,
+        balance.cash_balance + balance.net_property_value + balance.improvement_value
+        FROM balance
+        LEFT JOIN net_worth_log AS last_log
+        ON last_log.net_worth_log_id =
+            (SELECT MAX(net_worth_log_id)
+            FROM net_worth_log
+            WHERE net_worth_log.game_id = ?
+            AND net_worth_log.player_id = balance.player_id)
+        WHERE (last_log.net_worth_log_id IS NULL
+            OR last_log.cash_balance != balance.cash_balance
+            OR last_log.net_property_value != balance.net_property_value
+            OR last_log.improvement_value != balance.improvement_value
+            OR last_log.gross_property_value != balance.gross_property_value)
         """,
-        (turn, party_player_id, counterparty_player_id, action_type_id, property_id, cash_received, cash_paid, asset_value_received, asset_value_paid)
+        parameters + [game_id, turn, game_id]
     )
-    return
-
-def purchase_property(db, current_player_id, property_name, turn):
-    # buy property from the bank
-
-    # get the price
-    property_id, price = db.execute(
-        "SELECT property_id, price FROM property WHERE property_name = ?",
-        (property_name,)
-    ).fetchone()
 
-    # update net_worth with subtracted price from player cash and added price to net and gross property values 
+    # the end of turn balances of every player also go into the per-turn rollup
     db.execute(
-        """
-        UPDATE net_worth
-        SET cash_balance = cash_balance - ?,
-            net_property_value = net_property_value + ?,
-            gross_property_value = gross_property_value + ?
-        WHERE player_id = ?;
+        balance + """
+        INSERT INTO player_turn_rollup (game_id, player_id, turn, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth)
+        SELECT ?, player_id, ?, cash_balance, net_property_value, improvement_value, gross_property_value, cash_balance + net_property_value + improvement_value
+        FROM balance
+        WHERE true
+        ON CONFLICT (game_id, player_id, turn) DO UPDATE SET
+        cash_balance = excluded.cash_balance,
+        net_property_value = excluded.net_property_value,
+        improvement_value = excluded.improvement_value,
+        gross_property_value = excluded.gross_property_value,
+        net_worth = excluded.net_worth
         """,
-        (price, price, price, current_player_id)
+        parameters + [game_id, turn]
     )
+    return
 
-    db.execute(
-        """
-        UPDATE net_worth
-        SET cash_balance = cash_balance + ?,
-            net_property_value = net_property_value - ?,
-            gross_property_value = gross_property_value - ?
-        WHERE player_id = ?
-        """,
-        (price, price, price, 1)
-    )
-    
-    # assign ownership to player    
-    db.execute(
+def get_net_worth_series(db, game_id, last_turn=None):
+    # rebuild the dense per-turn series from the delta-encoded net_worth_log.
+    # Returns a dictionary with key = player_id and value a list with one
+    # [turn, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth] row for every turn from 0 to last_turn
+    rows = db.execute(
         """
-        UPDATE property_ownership
-        SET owner_player_id = ?
-        WHERE property_id = ?
+        SELECT player_id, turn, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth
+        FROM net_worth_log
+        WHERE game_id = ?
+        ORDER BY player_id, net_worth_log_id
         """,
-        (current_player_id, property_id)
-    )
-    update_number_owned(db)
-    
-    # add the transaction to transactions table
-    record_transaction(db, turn, current_player_id, 1, 1, property_id, None, price, price, None)
-    db.commit()
-    comment = str(property_name) + " purchased for " + str(price) + "." 
-    return comment
-
-def trade_property():
-    # trade property (has more requirements, leave till end)
-    return
-
-def rent(db, current_player_id, property_name, turn, dice_roll=None):
-    # pay rent to owner on property
+        (game_id,)
+    ).fetchall()
 
-    # get rent due (consider mortgaged, monopoly, houses, and hotels)
-    property_details = db.execute(
-        "SELECT * FROM property LEFT JOIN property_ownership on property.property_id = property_ownership.property_id WHERE property.property_name = ?",
-        (property_name,)
-    ).fetchone()
+    if last_turn is None:
+        last_turn = max([row['turn'] for row in rows], default=0)
+
+    series = {}
+    for row in rows:
+        player_series = series.setdefault(row['player_id'], [])
+        if row['turn'] > last_turn:
+            continue
+        # carry the previous values forward over the turns in which nothing changed
+        while player_series and player_series[-1][0] < row['turn'] - 1:
+            player_series.append([player_series[-1][0] + 1] + player_series[-1][1:])
+        values = [row['turn'], row['cash_balance'], row['net_property_value'], row['improvement_value'], row['gross_property_value'], row['net_worth']]
+        if player_series and player_series[-1][0] == row['turn']:
+            player_series[-1] = values
+        else:
+            player_series.append(values)
 
-    if property_details['owner_player_id'] == 1:
-        rent_due = 0
-        comment = "Property owned by bank! No rent due."
-    
-    elif property_details['owner_player_id'] == int(current_player_id):
-        rent_due = 0
-        comment = "Property owned by current player! No rent due."
+    for player_series in series.values():
+        while player_series and player_series[-1][0] < last_turn:
+            player_series.append([player_series[-1][0] + 1] + player_series[-1][1:])
 
-    elif property_details['mortgaged'] == True:
-        rent_due = 0
-        comment = "Property mortgaged! No rent due."
-    
-    elif property_details['hotels'] == 1:
-        rent_due = property_details['rent_hotel']
-        comment = "Property with Hotel: " + str(rent_due) + " due."
-
-    elif property_details['houses'] > 0:
-        if property_details['houses'] == 1:
-            rent_due = property_details['rent_one_house']
-            comment = "Property with one house: " + str(rent_due) + " due."
-        if property_details['houses'] == 2:
-            rent_due = property_details['rent_two_houses']
-            comment = "Property with two houses: " + str(rent_due) + " due."            
-        if property_details['houses'] == 3:
-            rent_due = property_details['rent_three_houses']
-            comment = "Property with three houses: " + str(rent_due) + " due."  
-        if property_details['houses'] == 4:
-            rent_due = property_details['rent_four_houses']
-            comment = "Property with four houses: " + str(rent_due) + " due."    
-
-    elif property_details['monopoly'] and property_details['property_type'] == "Street":
-        rent_due = property_details['rent_monopoly']
-        comment = "Property in a Monopoly: " + str(rent_due) + " due."
-    
-    elif property_details['property_type'] == "Station" and property_details['number_owned'] > 1:
-        if property_details['number_owned'] == 2:
-            rent_due = property_details['rent_two_owned']
-            comment = "Two stations owned: " + str(rent_due) + " due."
-        elif property_details['number_owned'] == 3:
-            rent_due = property_details['rent_three_owned']
-            comment = "Three stations owned: " + str(rent_due) + " due."
-        elif property_details['number_owned'] == 4:
-            rent_due = property_details['rent_four_owned']
-            comment = "Four stations owned: " + str(rent_due) + " due."
-        
-    elif property_details['property_type'] == "Utility":
-        try:
-            if property_details['number_owned'] == 1:
-                rent_multiplier = property_details['rent_multiplier_one_owned']
-                rent_due = rent_multiplier * dice_roll
-                comment = "With one utility owned, the rent multiplier is " + str(rent_multiplier) + ". Rent due: " + str(rent_due) + "."
-            else:
-                rent_multiplier = property_details['rent_multiplier_two_owned']
-                rent_due = rent_multiplier * dice_roll
-                comment = "With two utilities owned, the rent multiplier is " + str(rent_multiplier) + ". Rent due: " + str(rent_due) + "."
-        except TypeError:
-            comment = "Please provide dice roll to calculate rent!"
-            return None, comment
-
-    else:
-        rent_due = property_details['rent_basic']
-        comment = "Rent due: " + str(rent_due) + "."
+    return series
 
-    # update net_worth with cash exchange
-    db.execute(
+def record_transactions(db, transactions):
+    # append events to the journal, used by the game state flush. Each event is a dictionary of transactions columns
+    # that already carries its sequence number and transaction_time.
+    db.executemany(
         """
-        UPDATE net_worth
-        SET cash_balance = CASE
-            WHEN player_id = ? THEN cash_balance + ?
-            WHEN player_id = ? THEN cash_balance - ?
-            END
-        WHERE player_id IN (?,?)
+        INSERT INTO transactions (game_id, sequence, transaction_time, turn, party_player_id, counterparty_player_id, action_type_id, property_id, cash_received, cash_paid, asset_value_received, asset_value_paid, counter_name, reverses_sequence)
+        VALUES (:game_id, :sequence, :transaction_time, :turn, :party_player_id, :counterparty_player_id, :action_type_id, :property_id, :cash_received, :cash_paid, :asset_value_received, :asset_value_paid, :counter_name, :reverses_sequence)
         """,
-        (property_details['owner_player_id'], rent_due, current_player_id, rent_due, property_details['owner_player_id'], current_player_id)
+        transactions
     )
-    
-    # add the transaction to transactions table
-    record_transaction(db, turn, current_player_id, property_details['owner_player_id'], 2, property_details['property_id'], cash_paid=rent_due)
-    db.commit()
+    update_rollups(db, transactions)
+    return
 
-    return rent_due, comment
+# this section contains the per-turn rollups of the journal. Each event is added to player_turn_rollup and
+# property_turn_rollup when it is written and log_net_worth adds the end of turn balances, so statistics over
+# time are read from a range of the rollup's primary key instead of scanning transactions and net_worth_log.
+PLAYER_ROLLUP_COLUMNS = ['events', 'cash_received', 'cash_paid', 'rent_received', 'rent_paid', 'go_income', 'chance_income', 'community_chest_income', 'tax_paid', 'properties_bought', 'jail_count']
+PROPERTY_ROLLUP_COLUMNS = ['landings', 'rent_income', 'ownership_changes']
+BALANCE_COLUMNS = ['cash_balance', 'net_property_value', 'improvement_value', 'gross_property_value', 'net_worth']
+
+# action_type_id of the events with a column of their own (see static/action_type.csv)
+PURCHASE_PROPERTY = 1
+RENT = 2
+GO = (3, 4)
+CHANCE = 10
+COMMUNITY_CHEST = 11
+JAIL = 13
+TAX = (15, 16)
+
+def rollup_increments(transactions):
+    # add up a batch of events into increments per (game_id, player_id, turn) and (game_id, property_id, turn).
+    # An undo event has received and paid swapped, so it is counted as its original with the opposite sign.
+    players = {}
+    properties = {}
+    for event in transactions:
+        sign = 1
+        received = event['cash_received'] or 0
+        paid = event['cash_paid'] or 0
+        if event['reverses_sequence'] is not None:
+            sign = -1
+            received, paid = paid, received
+
+        party = players.setdefault((event['game_id'], event['party_player_id'], event['turn']), dict.fromkeys(PLAYER_ROLLUP_COLUMNS, 0))
+        counterparty = players.setdefault((event['game_id'], event['counterparty_player_id'], event['turn']), dict.fromkeys(PLAYER_ROLLUP_COLUMNS, 0))
+        party['events'] += sign
+        party['cash_received'] += sign * received
+        party['cash_paid'] += sign * paid
+        counterparty['cash_received'] += sign * paid
+        counterparty['cash_paid'] += sign * received
+
+        action_type_id = event['action_type_id']
+        if action_type_id == RENT:
+            party['rent_paid'] += sign * (paid - received)
+            counterparty['rent_received'] += sign * (paid - received)
+        elif action_type_id in GO:
+            party['go_income'] += sign * (received - paid)
+        elif action_type_id == CHANCE:
+            party['chance_income'] += sign * (received - paid)
+        elif action_type_id == COMMUNITY_CHEST:
+            party['community_chest_income'] += sign * (received - paid)
+        elif action_type_id in TAX:
+            party['tax_paid'] += sign * (paid - received)
+        elif action_type_id == PURCHASE_PROPERTY:
+            party['properties_bought'] += sign
+        elif action_type_id == JAIL:
+            party['jail_count'] += sign
+
+        if event['property_id'] is not None:
+            prop = properties.setdefault((event['game_id'], event['property_id'], event['turn']), dict.fromkeys(PROPERTY_ROLLUP_COLUMNS, 0))
+            if action_type_id == RENT:
+                prop['landings'] += sign
+                prop['rent_income'] += sign * (paid - received)
+            if event['asset_value_received'] or event['asset_value_paid']:
+                prop['ownership_changes'] += sign
+
+    return players, properties
+
+def update_rollups(db, transactions):
+    # add a batch of journal events to the rollup tables
+    players, properties = rollup_increments(transactions)
+    db.executemany(
+        "INSERT INTO player_turn_rollup (game_id, player_id, turn, " + ", ".join(PLAYER_ROLLUP_COLUMNS) + ") VALUES (?, ?, ?" + ", ?" * len(PLAYER_ROLLUP_COLUMNS) + ")"
+        + " ON CONFLICT (game_id, player_id, turn) DO UPDATE SET " + ", ".join(column + " = " + column + " + excluded." + column for column in PLAYER_ROLLUP_COLUMNS),
+        [key + tuple(increments[column] for column in PLAYER_ROLLUP_COLUMNS) for key, increments in players.items()]
+    )
+    db.executemany(
+        "INSERT INTO property_turn_rollup (game_id, property_id, turn, " + ", ".join(PROPERTY_ROLLUP_COLUMNS) + ") VALUES (?, ?, ?" + ", ?" * len(PROPERTY_ROLLUP_COLUMNS) + ")"
+        + " ON CONFLICT (game_id, property_id, turn) DO UPDATE SET " + ", ".join(column + " = " + column + " + excluded." + column for column in PROPERTY_ROLLUP_COLUMNS),
+        [key + tuple(increments[column] for column in PROPERTY_ROLLUP_COLUMNS) for key, increments in properties.items()]
+    )
+    return
 
-def go(db, landed_on=False):
-    # pass or land on go
-   
-    # if player lands on and double_go rule in effect, increase player's cash balance by 2*game_version.go_value and increment special counter
-    if landed_on and session['double_go']:
-        double_go_value = session['go_value']*2
-        db.execute(
-            """
-            UPDATE net_worth
-            SET cash_balance = 
-                CASE 
-                    WHEN player_id = ? THEN cash_balance + ?
-                    WHEN player_id = 1 THEN cash_balance - ?
-                END
-            WHERE player_id IN (1, ?)
-            """,
-            (session['current_player_id'], double_go_value, double_go_value, session['current_player_id'])
-            )
-        # increment special counter 
+def rebuild_rollups(db, game_id, chunk_size=10000):
+    # regenerate both rollup tables of a game from its journal and net_worth_log
+    for table in ['player_turn_rollup', 'property_turn_rollup']:
         db.execute(
-            """
-            UPDATE special_counter
-            SET turn = ?,
-                land_on_start_counter = land_on_start_counter + 1
-            WHERE player_id = ?
-            """,
-            (session['current_turn'], session['current_player_id'])
+            "DELETE FROM " + table + " WHERE game_id = ?",
+            (game_id,)
         )
 
-        # record transaction 
-        record_transaction(db, session['current_turn'], session['current_player_id'], 1, 4, cash_received=double_go_value)
-
-    # if player passes (or lands and double_go rule not in effect), only increase player's cash balance by game_version.go_value
-    else:
-        db.execute(
-            """
-            UPDATE net_worth
-            SET cash_balance = 
-                CASE 
-                    WHEN player_id = ? THEN cash_balance + ?
-                    WHEN player_id = 1 THEN cash_balance - ?
-                END
-            WHERE player_id IN (1, ?)
-            """,
-            (session['current_player_id'], session['go_value'], session['go_value'], session['current_player_id'])
-            )
-        
-        # record transaction
-        record_transaction(db, session['current_turn'], session['current_player_id'], 1, 3, cash_received=session['go_value'])
-        
-        # increment special counter if landed on go
-        if landed_on:
-            db.execute(
-                """
-                UPDATE special_counter
-                SET turn = ?,
-                    land_on_start_counter = land_on_start_counter + 1
-                WHERE player_id = ?
-                """,
-                (session['current_turn'], session['current_player_id'])
-            )    
+    cursor = db.execute(
+        "SELECT * FROM transactions WHERE game_id = ? ORDER BY sequence",
+        (game_id,)
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        update_rollups(db, rows)
+
+    db.executemany(
+        "INSERT INTO player_turn_rollup (game_id, player_id, turn, " + ", ".join(BALANCE_COLUMNS) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        + " ON CONFLICT (game_id, player_id, turn) DO UPDATE SET " + ", ".join(column + " = excluded." + column for column in BALANCE_COLUMNS),
+        [(game_id, player_id) + tuple(values) for player_id, series in get_net_worth_series(db, game_id).items() for values in series]
+    )
     db.commit()
     return
 
+def get_player_rollup(db, game_id, player_id=None, first_turn=0, last_turn=None):
+    # per-turn statistics of one or every player of a game, ordered by player and turn
+    sql = "SELECT * FROM player_turn_rollup WHERE game_id = ?"
+    parameters = [game_id]
+    if player_id is not None:
+        sql += " AND player_id = ?"
+        parameters.append(player_id)
+    sql += " AND turn >= ?"
+    parameters.append(first_turn)
+    if last_turn is not None:
+        sql += " AND turn <= ?"
+        parameters.append(last_turn)
+    return db.execute(sql + " ORDER BY player_id, turn", parameters).fetchall()
+
+def get_property_rollup(db, game_id, property_id=None, first_turn=0, last_turn=None):
+    # per-turn statistics of one or every property of a game, ordered by property and turn
+    sql = "SELECT * FROM property_turn_rollup WHERE game_id = ?"
+    parameters = [game_id]
+    if property_id is not None:
+        sql += " AND property_id = ?"
+        parameters.append(property_id)
+    sql += " AND turn >= ?"
+    parameters.append(first_turn)
+    if last_turn is not None:
+        sql += " AND turn <= ?"
+        parameters.append(last_turn)
+    return db.execute(sql + " ORDER BY property_id, turn", parameters).fetchall()
+
+def trade_property():
+    # trade property (has more requirements, leave till end)
+    return
+
 def build():
     # build a house or hotel
     return
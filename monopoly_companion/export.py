@@ -0,0 +1,227 @@
+import csv
+import io
+import os
+import tempfile
+import zipfile
+import click
+from monopoly_companion.db import get_db
+
+# this module exports game statistics. Rows are read from SQLite in chunks of CHUNK_SIZE and written out one chunk
+# at a time, so memory use stays flat however long the game is or however many games are exported.
+# Parquet and Arrow IPC need pyarrow and .npz needs numpy; both are optional and only imported when used.
+
+CHUNK_SIZE = 10000
+
+FORMATS = ['csv', 'parquet', 'arrow', 'npz']
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'npz': 'application/octet-stream',
+}
+
+# columns of each export as (name, type), where type is 'int', 'nullable_int' or 'str'
+EXPORT_COLUMNS = {
+    'transactions': [
+        ('game_id', 'int'), ('transaction_id', 'int'), ('sequence', 'int'), ('transaction_time', 'str'), ('turn', 'int'),
+        ('party_player_id', 'int'), ('counterparty_player_id', 'int'), ('action_type_id', 'int'), ('property_id', 'nullable_int'),
+        ('cash_received', 'nullable_int'), ('cash_paid', 'nullable_int'), ('asset_value_received', 'nullable_int'), ('asset_value_paid', 'nullable_int'),
+        ('counter_name', 'str'), ('reverses_sequence', 'nullable_int'),
+    ],
+    'net_worth_log': [
+        ('game_id', 'int'), ('net_worth_log_id', 'int'), ('net_worth_time', 'str'), ('turn', 'int'), ('player_id', 'int'),
+        ('cash_balance', 'int'), ('net_property_value', 'int'), ('improvement_value', 'int'), ('gross_property_value', 'int'), ('net_worth', 'int'),
+    ],
+    'special_counter': [
+        ('game_id', 'int'), ('special_counter_id', 'int'), ('counter_time', 'str'), ('turn', 'int'), ('player_id', 'int'),
+        ('jail_counter', 'nullable_int'), ('free_parking_counter', 'nullable_int'), ('income_tax_counter', 'nullable_int'), ('luxury_tax_counter', 'nullable_int'),
+        ('land_on_start_counter', 'nullable_int'), ('chance_counter', 'nullable_int'), ('community_chest_counter', 'nullable_int'),
+    ],
+    'ownership_history': [
+        ('game_id', 'int'), ('sequence', 'int'), ('transaction_time', 'str'), ('turn', 'int'), ('property_id', 'int'),
+        ('from_player_id', 'int'), ('to_player_id', 'int'), ('asset_value', 'int'),
+    ],
+}
+
+EXPORT_SOURCES = {
+    'transactions': ("SELECT {columns} FROM transactions", "ORDER BY game_id, sequence"),
+    'net_worth_log': ("SELECT {columns} FROM net_worth_log", "ORDER BY game_id, net_worth_log_id"),
+    'special_counter': ("SELECT {columns} FROM special_counter", "ORDER BY game_id, player_id"),
+    # every change of owner recorded in the journal: the property moves to the party when asset_value_received is set
+    'ownership_history': (
+        """
+        SELECT {columns} FROM
+            (SELECT
+            game_id,
+            sequence,
+            transaction_time,
+            turn,
+            property_id,
+            CASE WHEN asset_value_received IS NOT NULL THEN counterparty_player_id ELSE party_player_id END AS from_player_id,
+            CASE WHEN asset_value_received IS NOT NULL THEN party_player_id ELSE counterparty_player_id END AS to_player_id,
+            IFNULL(asset_value_received, asset_value_paid) AS asset_value
+            FROM transactions
+            WHERE property_id IS NOT NULL AND (asset_value_received IS NOT NULL OR asset_value_paid IS NOT NULL))
+        """,
+        "ORDER BY game_id, sequence"
+    ),
+}
+
+def column_expression(name, kind):
+    # timestamps are exported as the text SQLite stores rather than converted by PARSE_DECLTYPES
+    if kind == 'str':
+        return "CAST(" + name + " AS TEXT) AS " + name
+    return name
+
+def export_query(table, game_id=None, columns=None, ordered=True):
+    # SQL and parameters for one export, for a single game or (game_id None) every game in the database.
+    # columns replaces the exported columns, e.g. with an aggregate (then pass ordered=False).
+    select, order_by = EXPORT_SOURCES[table]
+    if columns is None:
+        columns = [column_expression(name, kind) for name, kind in EXPORT_COLUMNS[table]]
+    sql = select.format(columns=", ".join(columns))
+    parameters = ()
+    if game_id is not None:
+        sql += " WHERE game_id = ?"
+        parameters = (game_id,)
+    if ordered:
+        sql += " " + order_by
+    return sql, parameters
+
+def iter_chunks(db, table, game_id=None, chunk_size=CHUNK_SIZE, columns=None):
+    # yield lists of at most chunk_size rows (as tuples) from one export
+    sql, parameters = export_query(table, game_id, columns)
+    cursor = db.execute(sql, parameters)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+
+def stream_csv(db, table, game_id=None, chunk_size=CHUNK_SIZE):
+    # yield the export as CSV text, one chunk at a time
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, kind in EXPORT_COLUMNS[table]])
+    for rows in iter_chunks(db, table, game_id, chunk_size):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def arrow_schema(table):
+    import pyarrow as pa
+
+    types = {'int': pa.int64(), 'nullable_int': pa.int64(), 'str': pa.string()}
+    return pa.schema([pa.field(name, types[kind], nullable=(kind != 'int')) for name, kind in EXPORT_COLUMNS[table]])
+
+def arrow_batches(db, table, game_id=None, chunk_size=CHUNK_SIZE):
+    import pyarrow as pa
+
+    schema = arrow_schema(table)
+    for rows in iter_chunks(db, table, game_id, chunk_size):
+        columns = list(zip(*rows))
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+def write_parquet(db, table, f, game_id=None, chunk_size=CHUNK_SIZE):
+    import pyarrow.parquet as pq
+
+    with pq.ParquetWriter(f, arrow_schema(table)) as writer:
+        for batch in arrow_batches(db, table, game_id, chunk_size):
+            writer.write_batch(batch)
+
+def write_arrow(db, table, f, game_id=None, chunk_size=CHUNK_SIZE):
+    import pyarrow as pa
+
+    with pa.ipc.new_file(f, arrow_schema(table)) as writer:
+        for batch in arrow_batches(db, table, game_id, chunk_size):
+            writer.write_batch(batch)
+
+def write_npz(db, table, f, game_id=None, chunk_size=CHUNK_SIZE):
+    # one .npy array per column. Each column is streamed straight into its zip member after a header written from the row count,
+    # so only one chunk of one column is in memory at a time. Nullable integers are stored as float64 with NaN for NULL,
+    # strings as fixed-width unicode sized from the longest value. The sizing queries and the column reads share one read
+    # transaction, so rows written meanwhile (by a live game) cannot make a header disagree with the data after it.
+    import numpy as np
+
+    began = not db.in_transaction
+    if began:
+        db.execute("BEGIN")
+    try:
+        sql, parameters = export_query(table, game_id, ['COUNT(*)'], ordered=False)
+        row_count = db.execute(sql, parameters).fetchone()[0]
+
+        with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, kind in EXPORT_COLUMNS[table]:
+                if kind == 'int':
+                    dtype = np.dtype(np.int64)
+                elif kind == 'nullable_int':
+                    dtype = np.dtype(np.float64)
+                else:
+                    sql, parameters = export_query(table, game_id, ['MAX(LENGTH(' + name + '))'], ordered=False)
+                    longest = db.execute(sql, parameters).fetchone()[0] or 1
+                    dtype = np.dtype('<U' + str(longest))
+
+                with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(member, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (row_count,)})
+                    for rows in iter_chunks(db, table, game_id, chunk_size, [column_expression(name, kind)]):
+                        values = [row[0] for row in rows]
+                        if kind == 'nullable_int':
+                            values = [np.nan if value is None else value for value in values]
+                        elif kind == 'str':
+                            values = ['' if value is None else value for value in values]
+                        member.write(np.asarray(values, dtype=dtype).tobytes())
+    finally:
+        if began:
+            db.commit()
+
+WRITERS = {
+    'parquet': write_parquet,
+    'arrow': write_arrow,
+    'npz': write_npz,
+}
+
+def write_export(db, table, fmt, f, game_id=None, chunk_size=CHUNK_SIZE):
+    # write one export in any of FORMATS to a binary file object
+    if table not in EXPORT_COLUMNS:
+        raise ValueError("Unknown export " + str(table))
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format " + str(fmt))
+
+    if fmt == 'csv':
+        for text in stream_csv(db, table, game_id, chunk_size):
+            f.write(text.encode('utf8'))
+    else:
+        WRITERS[fmt](db, table, f, game_id, chunk_size)
+
+@click.command('export-game')
+@click.argument('game_id', type=int, required=False)
+@click.option('--table', type=click.Choice(list(EXPORT_COLUMNS)), default='transactions', help='Statistics to export.')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', help='Output format.')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Output file (defaults to <table>[_<game_id>].<format>).')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows read from the database at a time.')
+def export_game_command(game_id, table, fmt, output, chunk_size):
+    """Export game statistics for one game, or every game if no GAME_ID is given"""
+    if output is None:
+        output = table + ('' if game_id is None else '_' + str(game_id)) + '.' + fmt
+
+    # write next to the target and rename, so a failed export never leaves a partial file behind
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_export(get_db(), table, fmt, f, game_id, chunk_size)
+        os.replace(partial, output)
+    except ImportError as error:
+        os.unlink(partial)
+        raise click.ClickException(fmt + " export needs an optional dependency: " + str(error))
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+    click.echo('Exported ' + table + ' to ' + output + '.')
+
+def init_app(app):
+    app.cli.add_command(export_game_command)
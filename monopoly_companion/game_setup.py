@@ -1,5 +1,9 @@
-from flask import Blueprint, flash, g, redirect, render_template, request, session, url_for
-from monopoly_companion.db import get_db, init_property_ownership, init_special_counter, starting_cash, get_property_value, get_net_worth, log_net_worth
+from flask import Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
+from monopoly_companion.db import get_db, create_game, get_game_template, register_players
+from monopoly_companion.game_state import GameState
+from monopoly_companion.rent import get_rent_table
+from monopoly_companion.versions import check_revisions
+from monopoly_companion.writer import write
 
 bp = Blueprint('game_setup', __name__, url_prefix='/game-setup', static_folder='static')
 
@@ -12,13 +16,8 @@ def index():
         game_versions = db.execute(
             "SELECT * FROM game_version"
         ).fetchall()
-
-        game_version_names = []
-
-        for game_version in game_versions:
-            game_version_names.append(game_version['game_version_name'])
-        
-        session['game_version_names'] = game_version_names
+        # drop what this worker cached of versions whose boards were reloaded since
+        check_revisions(db, game_versions, current_app.config['DATABASE'])
 
     elif request.method == "POST":
         game_version_name = request.form['game_version']
@@ -39,31 +38,39 @@ def index():
         if game_version is None:
             error = 'Game version not found'
         else:
-            session.clear()
-            session['game_version_id'] = game_version['game_version_id']
-            session['go_value'] = game_version['go_value']
-            session['no_of_players'] = no_of_players
+            check_revisions(db, [game_version], current_app.config['DATABASE'])
+            double_go = bool(request.form.get('double_go'))
+            game_version_id = game_version['game_version_id']
+            database = current_app.config['DATABASE']
 
-            if request.form.get('double_go'):
-                session['double_go'] = True
-            else:
-                session['double_go'] = False
-
-            init_property_ownership(db, session['game_version_id'])
+            # the session only identifies the game, its version and players are read from the game row from here on.
+            # Like every game write, the new game is written by the database writer.
+            session.clear()
+            session['game_id'] = write(current_app.config, lambda db: create_game(db, game_version_id, no_of_players, double_go, database, commit=False))
+            # compile (or reuse) the rent table for this version before play starts
+            get_rent_table(db, game_version['game_version_id'], current_app.config['DATABASE'])
 
             return redirect(url_for('game_setup.player_registration'))
 
         flash(error)
+        game_versions = db.execute(
+            "SELECT * FROM game_version"
+        ).fetchall()
 
-    return render_template("game_setup/index.html",game_version_names=session['game_version_names'])
+    game_version_names = [game_version['game_version_name'] for game_version in game_versions]
+    return render_template("game_setup/index.html",game_version_names=game_version_names)
 
 @bp.route("/player_registration/", methods=("GET","POST"))
 def player_registration():
-    no_of_players = session['no_of_players']
+    db = get_db()
+    game = db.execute(
+        "SELECT game_version_id, no_of_players FROM game WHERE game_id = ?",
+        (session['game_id'],)
+    ).fetchone()
+    no_of_players = game['no_of_players']
     player_names = []
 
     if request.method == "POST":
-        db = get_db()
         error = None
 
         for player in range(1, no_of_players+1):
@@ -76,47 +83,20 @@ def player_registration():
                 player_names.append(player_name)
         
         if error is None:
-            player_dict = {}
-            for player in player_names:
-                db.execute(
-                    "INSERT INTO players(player_name, player_order) VALUES (?, ?)",
-                    (player, player_names.index(player)+1)
-                )
-                player_dict[int(player_names.index(player)+3)] = [player, player_names.index(player)+1]
-
-            total_cash, starting_cash_per_player = db.execute(
-                "SELECT total_cash, starting_cash_balance FROM game_version where rowid = ?",
-                (session['game_version_id'],)
-            ).fetchone()
-
-            player_starting_cash = starting_cash(no_of_players, player_names, total_cash, starting_cash_per_player)
-
-            property_values = get_property_value(db, player_names)
-
-            player_names_incl_static = ["Bank", "Free Parking"] + player_names
-
-            for player in player_names_incl_static:
-                player_id = player_names_incl_static.index(player)+1
-                cash_balance = player_starting_cash[player_id][1]
-                net_property_value = property_values[player_id][3]
-                gross_property_value = property_values[player_id][4]
-                improvement_value = property_values[player_id][5]
-                db.execute(
-                    """
-                    INSERT INTO net_worth (turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value) 
-                    VALUES (0, ?, ?, ?, ?, ?)
-                    """,
-                    (player_id, cash_balance, net_property_value, improvement_value, gross_property_value)
-                )
-                init_special_counter(db, player_id)
+            game_id = session['game_id']
+            database = current_app.config['DATABASE']
+            # the players, their starting net worth and counters are copied from the game version's template in bulk
+            template = get_game_template(db, game['game_version_id'], database)
 
-            log_net_worth(db)
-            db.commit()
+            def register(db):
+                player_dict = register_players(db, game_id, template, player_names)
+                # starting checkpoint for seeking back through the game, committed in the same transaction as the players
+                GameState.load(db, game_id, database, journal=False).checkpoint(db)
+                return player_dict
 
-            current_net_worth_table, current_net_worths = get_net_worth(db)
+            player_dict = write(current_app.config, register)
 
-            session['player_dict'] = player_dict
-            session['current_player_id'] = 3
+            session['current_player_id'] = min(player_dict)
             session['game_started'] = 1
             session['current_turn'] = 1
 
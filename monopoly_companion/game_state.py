@@ -0,0 +1,781 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from monopoly_companion.db import record_transactions, update_city_ownership
+from monopoly_companion.rent import HOTEL_LEVEL, MONOPOLY_LEVEL, STATION, STREET, UTILITY, get_rent_table
+from monopoly_companion.writer import write
+
+# this module holds the authoritative in-memory state of every running game in this worker.
+# Gameplay actions are applied to a GameState in memory and the changed rows are written to SQLite
+# in one batched transaction at the end of each player's turn (or once FLUSH_INTERVAL seconds have passed), through
+# the database writer of the worker (see writer.py).
+#
+# A game is meant to be played through one worker process at a time (route a game's requests to the same worker).
+# Should two processes hold the same game anyway, the flush of a state finds events in the database it has not seen,
+# as their sequence numbers run ahead of it, and raises StaleGameState instead of overwriting the other process's
+# balances. The state is dropped, so the next request loads the game afresh; the changes of the stale state are lost.
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5.0
+
+# a checkpoint of the full state is saved once this many events have been journaled since the last one
+CHECKPOINT_INTERVAL = 50
+
+RENT_COMMENTS = {
+    (STREET, 0): "Rent due: {}.",
+    (STREET, MONOPOLY_LEVEL): "Property in a Monopoly: {} due.",
+    (STREET, 2): "Property with one house: {} due.",
+    (STREET, 3): "Property with two houses: {} due.",
+    (STREET, 4): "Property with three houses: {} due.",
+    (STREET, 5): "Property with four houses: {} due.",
+    (STREET, HOTEL_LEVEL): "Property with Hotel: {} due.",
+    (STATION, 0): "Rent due: {}.",
+    (STATION, 1): "Two stations owned: {} due.",
+    (STATION, 2): "Three stations owned: {} due.",
+    (STATION, 3): "Four stations owned: {} due.",
+    (UTILITY, 0): "With one utility owned, the rent multiplier is {}. Rent due: {}.",
+    (UTILITY, 1): "With two utilities owned, the rent multiplier is {}. Rent due: {}.",
+}
+
+TRANSACTION_COLUMNS = ['game_id', 'sequence', 'transaction_time', 'turn', 'party_player_id', 'counterparty_player_id', 'action_type_id', 'property_id', 'cash_received', 'cash_paid', 'asset_value_received', 'asset_value_paid', 'counter_name', 'reverses_sequence']
+
+COUNTER_COLUMNS = ['jail_counter', 'free_parking_counter', 'income_tax_counter', 'luxury_tax_counter', 'land_on_start_counter', 'chance_counter', 'community_chest_counter']
+
+class StaleGameState(Exception):
+    # another process wrote events of the game after this state was loaded or last flushed
+    def __init__(self, game_id, sequence, stored_sequence):
+        super().__init__("Game " + str(game_id) + " was changed by another worker: event " + str(stored_sequence) + " is stored, this worker expected " + str(sequence))
+        self.game_id = game_id
+
+class GameState:
+    __slots__ = (
+        'game_id', 'game_version_id', 'go_value', 'double_go', 'database',
+        # names and turn order of the game's players by str(player_id): [player_name, player_order]
+        'players',
+        # players: slot per player_id, each list below is indexed by slot
+        'player_ids', 'player_slot', 'turn', 'cash', 'net_property', 'improvement', 'gross', 'counters',
+        # properties: slot per property_id, each list below is indexed by slot
+        'property_ids', 'property_slot', 'property_by_name', 'properties', 'rent_table',
+        'owner', 'mortgaged', 'houses', 'hotels',
+        # ownership index: (owner_player_id, city) -> number of properties owned in that city, and city -> number of properties
+        'city_owned', 'city_size',
+        # cached result of property_values(), cleared whenever ownership, mortgage or improvement state changes
+        'valuation',
+        # event journal: next sequence number of the game and the events that can still be undone, newest last
+        'next_sequence', 'undo_stack', 'checkpoint_sequence',
+        # write-behind bookkeeping
+        'dirty_players', 'dirty_properties', 'dirty_counters', 'dirty_city_owned', 'pending_transactions', 'last_flush', 'lock',
+    )
+
+    def __init__(self, game_id, game_version_id, go_value, double_go, database=None):
+        self.game_id = game_id
+        self.game_version_id = game_version_id
+        self.go_value = go_value
+        self.double_go = bool(double_go)
+        self.database = database
+
+        self.players = {}
+        self.player_ids = []
+        self.player_slot = {}
+        self.turn = []
+        self.cash = []
+        self.net_property = []
+        self.improvement = []
+        self.gross = []
+        self.counters = []
+
+        self.property_ids = []
+        self.property_slot = {}
+        self.property_by_name = {}
+        self.properties = []
+        self.rent_table = None
+        self.owner = []
+        self.mortgaged = []
+        self.houses = []
+        self.hotels = []
+
+        self.city_owned = {}
+        self.city_size = {}
+        self.valuation = None
+
+        self.next_sequence = 1
+        self.undo_stack = []
+        self.checkpoint_sequence = None
+
+        self.dirty_players = set()
+        self.dirty_properties = set()
+        self.dirty_counters = set()
+        self.dirty_city_owned = set()
+        self.pending_transactions = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, db, game_id, database=None, journal=True):
+        # build the state of one game from its rows in game, net_worth, special_counter and property_ownership.
+        # journal=False skips reading the undo stack, for states that are only used to replay history.
+        game = db.execute(
+            """
+            SELECT game.game_id, game.game_version_id, game.double_go, game_version.go_value
+            FROM game
+            JOIN game_version
+            ON game.game_version_id = game_version.game_version_id
+            WHERE game.game_id = ?
+            """,
+            (game_id,)
+        ).fetchone()
+
+        if game is None:
+            raise KeyError("Game " + str(game_id) + " not found")
+
+        state = cls(game['game_id'], game['game_version_id'], game['go_value'], game['double_go'], database)
+        state.rent_table = get_rent_table(db, game['game_version_id'], database)
+
+        for row in db.execute(
+            "SELECT player_id, player_name, player_order FROM players WHERE game_id = ? ORDER BY player_order",
+            (game_id,)
+        ):
+            state.players[str(row['player_id'])] = [row['player_name'], row['player_order']]
+
+        for row in db.execute(
+            "SELECT * FROM net_worth WHERE game_id = ? ORDER BY player_id",
+            (game_id,)
+        ):
+            state.player_slot[row['player_id']] = len(state.player_ids)
+            state.player_ids.append(row['player_id'])
+            state.turn.append(row['turn'])
+            state.cash.append(row['cash_balance'])
+            state.net_property.append(row['net_property_value'])
+            state.improvement.append(row['improvement_value'])
+            state.gross.append(row['gross_property_value'])
+            state.counters.append([0] * len(COUNTER_COLUMNS))
+
+        for row in db.execute(
+            "SELECT * FROM special_counter WHERE game_id = ?",
+            (game_id,)
+        ):
+            state.counters[state.player_slot[row['player_id']]] = [row[column] for column in COUNTER_COLUMNS]
+
+        for row in db.execute(
+            """
+            SELECT *
+            FROM property_ownership
+            JOIN property
+            ON property_ownership.property_id = property.property_id
+            WHERE property_ownership.game_id = ?
+            ORDER BY property_ownership.property_id
+            """,
+            (game_id,)
+        ):
+            slot = len(state.property_ids)
+            state.property_slot[row['property_id']] = slot
+            state.property_by_name[row['property_name']] = slot
+            state.property_ids.append(row['property_id'])
+            state.properties.append(row)
+            state.owner.append(row['owner_player_id'])
+            state.mortgaged.append(bool(row['mortgaged']))
+            state.houses.append(row['houses'])
+            state.hotels.append(row['hotels'])
+
+        for row in db.execute(
+            "SELECT city, owner_player_id, number_owned, max_number_owned FROM city_ownership WHERE game_id = ?",
+            (game_id,)
+        ):
+            state.city_owned[(row['owner_player_id'], row['city'])] = row['number_owned']
+            state.city_size[row['city']] = row['max_number_owned']
+
+        state.next_sequence = db.execute(
+            "SELECT IFNULL(MAX(sequence), 0) + 1 FROM transactions WHERE game_id = ?",
+            (game_id,)
+        ).fetchone()[0]
+        state.checkpoint_sequence = db.execute(
+            "SELECT MAX(sequence) FROM state_checkpoint WHERE game_id = ?",
+            (game_id,)
+        ).fetchone()[0]
+
+        if not journal:
+            return state
+
+        # events that have not been reversed yet, so undo can pop the last one without searching the journal
+        for row in db.execute(
+            """
+            SELECT *
+            FROM transactions
+            WHERE game_id = ?
+            AND reverses_sequence IS NULL
+            AND NOT EXISTS
+                (SELECT 1
+                FROM transactions AS reversal
+                WHERE reversal.game_id = transactions.game_id
+                AND reversal.reverses_sequence = transactions.sequence)
+            ORDER BY sequence
+            """,
+            (game_id,)
+        ):
+            state.undo_stack.append({column: row[column] for column in TRANSACTION_COLUMNS})
+
+        return state
+
+    def number_owned(self, slot):
+        # number of properties in this property's city held by its owner (stations and utilities are cities of their own)
+        return self.city_owned.get((self.owner[slot], self.properties[slot]['city']), 0)
+
+    def monopoly(self, slot):
+        return self.number_owned(slot) == self.city_size[self.properties[slot]['city']]
+
+    def net_worth(self, player_slot):
+        return self.cash[player_slot] + self.net_property[player_slot] + self.improvement[player_slot]
+
+    def property_values(self):
+        # per player_id: [mortgaged property value, unmortgaged property value, net property value, gross property value, improvement value],
+        # computed in one pass over the properties and cached until invalidate_valuation is called.
+        if self.valuation is None:
+            valuation = {player_id: [0, 0, 0, 0, 0] for player_id in self.player_ids}
+            for slot, prop in enumerate(self.properties):
+                values = valuation[self.owner[slot]]
+                if self.mortgaged[slot]:
+                    values[0] += prop['mortgage_value']
+                else:
+                    values[1] += prop['price']
+                values[3] += prop['price']
+                if self.hotels[slot] == 1:
+                    values[4] += 5 * prop['house_cost']
+                else:
+                    values[4] += self.houses[slot] * (prop['house_cost'] or 0)
+            for values in valuation.values():
+                values[2] = values[0] + values[1]
+            self.valuation = valuation
+        return self.valuation
+
+    def snapshot(self):
+        # the full state as a JSON-serialisable dictionary, used for checkpoints and the state API
+        players = {}
+        for slot, player_id in enumerate(self.player_ids):
+            players[str(player_id)] = {
+                'turn': self.turn[slot],
+                'cash_balance': self.cash[slot],
+                'net_property_value': self.net_property[slot],
+                'improvement_value': self.improvement[slot],
+                'gross_property_value': self.gross[slot],
+                'net_worth': self.net_worth(slot),
+                'counters': dict(zip(COUNTER_COLUMNS, self.counters[slot])),
+            }
+
+        properties = {}
+        for slot, property_id in enumerate(self.property_ids):
+            properties[str(property_id)] = {
+                'property_name': self.properties[slot]['property_name'],
+                'owner_player_id': self.owner[slot],
+                'mortgaged': self.mortgaged[slot],
+                'houses': self.houses[slot],
+                'hotels': self.hotels[slot],
+            }
+
+        return {
+            'game_id': self.game_id,
+            'sequence': self.next_sequence - 1,
+            'turn': max(self.turn) if self.turn else 0,
+            'players': players,
+            'properties': properties,
+        }
+
+    def restore(self, snapshot):
+        # overwrite the state with a snapshot taken from this game
+        for player_id, player in snapshot['players'].items():
+            slot = self.player_slot[int(player_id)]
+            self.turn[slot] = player['turn']
+            self.cash[slot] = player['cash_balance']
+            self.net_property[slot] = player['net_property_value']
+            self.improvement[slot] = player['improvement_value']
+            self.gross[slot] = player['gross_property_value']
+            self.counters[slot] = [player['counters'][column] for column in COUNTER_COLUMNS]
+
+        self.city_owned = {}
+        for property_id, prop in snapshot['properties'].items():
+            slot = self.property_slot[int(property_id)]
+            self.owner[slot] = prop['owner_player_id']
+            self.mortgaged[slot] = prop['mortgaged']
+            self.houses[slot] = prop['houses']
+            self.hotels[slot] = prop['hotels']
+            key = (self.owner[slot], self.properties[slot]['city'])
+            self.city_owned[key] = self.city_owned.get(key, 0) + 1
+
+        self.next_sequence = snapshot['sequence'] + 1
+        self.invalidate_valuation()
+
+    def savepoint(self):
+        # everything rollback needs to put the state back as it is now, including which changes are still unflushed
+        with self.lock:
+            return (
+                self.snapshot(), list(self.undo_stack), self.checkpoint_sequence,
+                (set(self.dirty_players), set(self.dirty_properties), set(self.dirty_counters), set(self.dirty_city_owned), list(self.pending_transactions)),
+            )
+
+    def rollback(self, savepoint):
+        # discard every event applied since the savepoint, along with its unflushed changes
+        snapshot, undo_stack, checkpoint_sequence, (dirty_players, dirty_properties, dirty_counters, dirty_city_owned, pending_transactions) = savepoint
+        with self.lock:
+            self.restore(snapshot)
+            self.undo_stack = undo_stack
+            self.checkpoint_sequence = checkpoint_sequence
+            self.dirty_players = set(dirty_players)
+            self.dirty_properties = set(dirty_properties)
+            self.dirty_counters = set(dirty_counters)
+            self.dirty_city_owned = set(dirty_city_owned)
+            self.pending_transactions = list(pending_transactions)
+
+    def checkpoint(self, db):
+        # save the current (flushed) state so seeks only replay the events journaled after it
+        snapshot = self.snapshot()
+        db.execute(
+            "INSERT OR REPLACE INTO state_checkpoint (game_id, sequence, turn, state) VALUES (?, ?, ?, ?)",
+            (self.game_id, snapshot['sequence'], snapshot['turn'], json.dumps(snapshot))
+        )
+        self.checkpoint_sequence = snapshot['sequence']
+
+    def invalidate_valuation(self):
+        # call after any change to ownership, mortgages, houses or hotels
+        self.valuation = None
+
+    def reload_properties(self, properties, rent_table):
+        # swap in the property rows ({property_id: row}) and rent table of a game version whose board was reloaded with
+        # new prices or rents, and revalue every player's properties at the new prices
+        with self.lock:
+            self.properties = [properties[property_id] for property_id in self.property_ids]
+            self.rent_table = rent_table
+            self.invalidate_valuation()
+            for player_id, values in self.property_values().items():
+                slot = self.player_slot[player_id]
+                if (self.net_property[slot], self.improvement[slot], self.gross[slot]) != (values[2], values[4], values[3]):
+                    self.net_property[slot] = values[2]
+                    self.improvement[slot] = values[4]
+                    self.gross[slot] = values[3]
+                    self.dirty_players.add(slot)
+
+    def net_worths(self):
+        # [cash, net property, improvement, gross property, net worth] by str(player_id)
+        net_worths = {}
+        for slot, player_id in enumerate(self.player_ids):
+            net_worths[str(player_id)] = [self.cash[slot], self.net_property[slot], self.improvement[slot], self.gross[slot], self.net_worth(slot)]
+        return net_worths
+
+    def balances(self):
+        # the (player_id, net_worth_time, cash_balance, net_property_value, improvement_value, gross_property_value) rows
+        # of every player as they are now, for db.log_net_worth
+        now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self.lock:
+            return [(self.player_ids[slot], now, self.cash[slot], self.net_property[slot], self.improvement[slot], self.gross[slot]) for slot in range(len(self.player_ids))]
+
+    def expected_rents(self, landing_probabilities):
+        # [property_name, owner_player_id, rent an opponent is expected to pay per roll] for every owned, unmortgaged
+        # property, given the landing probabilities of markov.get_landing_probabilities. Utilities use the mean dice roll.
+        expected = []
+        with self.lock:
+            for slot, property_id in enumerate(self.property_ids):
+                if self.owner[slot] == 1 or self.mortgaged[slot]:
+                    continue
+                probability_per_roll, probability_per_turn, mean_dice_roll = landing_probabilities[self.properties[slot]['board_position']]
+                level = self.rent_table.rent_level(property_id, self.houses[slot], self.hotels[slot], self.monopoly(slot), self.number_owned(slot))
+                rent_due = self.rent_table.rent(property_id, level, mean_dice_roll)
+                expected.append([self.properties[slot]['property_name'], self.owner[slot], probability_per_roll * rent_due])
+        return expected
+
+    def transfer_cash(self, from_player_id, to_player_id, amount):
+        from_slot = self.player_slot[int(from_player_id)]
+        to_slot = self.player_slot[int(to_player_id)]
+        self.cash[from_slot] -= amount
+        self.cash[to_slot] += amount
+        self.dirty_players.add(from_slot)
+        self.dirty_players.add(to_slot)
+
+    def transfer_property(self, slot, to_player_id):
+        # move a property (at its price) between two players and update the two affected ownership counters
+        price = self.properties[slot]['price']
+        from_slot = self.player_slot[self.owner[slot]]
+        to_slot = self.player_slot[int(to_player_id)]
+
+        self.net_property[from_slot] -= price
+        self.gross[from_slot] -= price
+        self.net_property[to_slot] += price
+        self.gross[to_slot] += price
+        self.dirty_players.add(from_slot)
+        self.dirty_players.add(to_slot)
+
+        city = self.properties[slot]['city']
+        self.city_owned[(self.owner[slot], city)] -= 1
+        self.dirty_city_owned.add((self.owner[slot], city))
+
+        self.owner[slot] = int(to_player_id)
+        self.city_owned[(self.owner[slot], city)] = self.city_owned.get((self.owner[slot], city), 0) + 1
+        self.dirty_city_owned.add((self.owner[slot], city))
+        self.dirty_properties.add(slot)
+        self.invalidate_valuation()
+
+    def increment_counter(self, player_id, counter, turn, change=1):
+        slot = self.player_slot[int(player_id)]
+        self.counters[slot][COUNTER_COLUMNS.index(counter)] += change
+        self.turn[slot] = turn
+        self.dirty_counters.add(slot)
+
+    def apply_event(self, event):
+        # apply one journal event to the state. See the transactions table in schema.sql for the meaning of each column.
+        for player_id in (event['party_player_id'], event['counterparty_player_id']):
+            self.turn[self.player_slot[player_id]] = event['turn']
+
+        cash = (event['cash_received'] or 0) - (event['cash_paid'] or 0)
+        if cash:
+            self.transfer_cash(event['counterparty_player_id'], event['party_player_id'], cash)
+
+        if event['property_id'] is not None:
+            slot = self.property_slot[event['property_id']]
+            if event['asset_value_received']:
+                self.transfer_property(slot, event['party_player_id'])
+            elif event['asset_value_paid']:
+                self.transfer_property(slot, event['counterparty_player_id'])
+
+        if event['counter_name']:
+            change = -1 if event['reverses_sequence'] is not None else 1
+            self.increment_counter(event['party_player_id'], event['counter_name'], event['turn'], change)
+
+    def record_transaction(self, turn, party_player_id, counterparty_player_id, action_type_id, property_id=None, cash_received=None, cash_paid=None, asset_value_received=None, asset_value_paid=None, counter_name=None, reverses_sequence=None):
+        # apply an event and append it to the journal, stamped now so the write-behind flush keeps the action time
+        event = {
+            'game_id': self.game_id,
+            'sequence': self.next_sequence,
+            'transaction_time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+            'turn': turn,
+            'party_player_id': int(party_player_id),
+            'counterparty_player_id': int(counterparty_player_id),
+            'action_type_id': action_type_id,
+            'property_id': property_id,
+            'cash_received': cash_received,
+            'cash_paid': cash_paid,
+            'asset_value_received': asset_value_received,
+            'asset_value_paid': asset_value_paid,
+            'counter_name': counter_name,
+            'reverses_sequence': reverses_sequence,
+        }
+        self.next_sequence += 1
+        self.apply_event(event)
+        self.pending_transactions.append(event)
+        if reverses_sequence is None:
+            self.undo_stack.append(event)
+        return event
+
+    def update_turn(self, turn, current_player_id):
+        # equivalent of the old update_net_worth_turn: stamp the turn on the bank, free parking and current player
+        for player_id in (1, 2, int(current_player_id)):
+            slot = self.player_slot[player_id]
+            self.turn[slot] = turn
+            self.dirty_players.add(slot)
+
+    # gameplay actions. These mirror the action functions that used to run directly against the database.
+    def purchase_property(self, current_player_id, property_name, turn):
+        # buy property from the bank
+        with self.lock:
+            slot = self.property_by_name[property_name]
+            property_id = self.property_ids[slot]
+            price = self.properties[slot]['price']
+
+            self.record_transaction(turn, current_player_id, 1, 1, property_id, None, price, price, None)
+            comment = str(property_name) + " purchased for " + str(price) + "."
+        return comment
+
+    def rent(self, current_player_id, property_name, turn, dice_roll=None):
+        # pay rent to owner on property
+        with self.lock:
+            slot = self.property_by_name[property_name]
+            property_id = self.property_ids[slot]
+            owner_player_id = self.owner[slot]
+
+            # get rent due (consider mortgaged, monopoly, houses, and hotels) from the compiled rent table
+            if owner_player_id == 1:
+                rent_due = 0
+                comment = "Property owned by bank! No rent due."
+
+            elif owner_player_id == int(current_player_id):
+                rent_due = 0
+                comment = "Property owned by current player! No rent due."
+
+            elif self.mortgaged[slot]:
+                rent_due = 0
+                comment = "Property mortgaged! No rent due."
+
+            else:
+                level = self.rent_table.rent_level(property_id, self.houses[slot], self.hotels[slot], self.monopoly(slot), self.number_owned(slot))
+                kind = self.rent_table.kinds[property_id]
+                try:
+                    rent_due = self.rent_table.rent(property_id, level, dice_roll)
+                except TypeError:
+                    comment = "Please provide dice roll to calculate rent!"
+                    return None, comment
+
+                if kind == UTILITY:
+                    comment = RENT_COMMENTS[(kind, level)].format(self.rent_table.rents[property_id][level], rent_due)
+                else:
+                    comment = RENT_COMMENTS[(kind, level)].format(rent_due)
+
+            # exchange the cash and add the transaction
+            self.record_transaction(turn, current_player_id, owner_player_id, 2, property_id, cash_paid=rent_due)
+
+        return rent_due, comment
+
+    def go(self, current_player_id, turn, landed_on=False):
+        # pass or land on go
+        with self.lock:
+            # if player lands on and double_go rule in effect, the player receives 2*game_version.go_value
+            if landed_on and self.double_go:
+                double_go_value = self.go_value*2
+                self.record_transaction(turn, current_player_id, 1, 4, cash_received=double_go_value, counter_name='land_on_start_counter')
+
+            # if player passes (or lands and double_go rule not in effect), only increase player's cash balance by game_version.go_value
+            # and count the landing if there was one
+            elif landed_on:
+                self.record_transaction(turn, current_player_id, 1, 3, cash_received=self.go_value, counter_name='land_on_start_counter')
+
+            else:
+                self.record_transaction(turn, current_player_id, 1, 3, cash_received=self.go_value)
+        return
+
+    def undo_action(self, turn):
+        # undo the most recent event that has not been undone yet by appending its inverse to the journal
+        with self.lock:
+            if not self.undo_stack:
+                return "Nothing to undo."
+
+            event = self.undo_stack.pop()
+            self.record_transaction(
+                turn,
+                event['party_player_id'],
+                event['counterparty_player_id'],
+                event['action_type_id'],
+                event['property_id'],
+                cash_received=event['cash_paid'],
+                cash_paid=event['cash_received'],
+                asset_value_received=event['asset_value_paid'],
+                asset_value_paid=event['asset_value_received'],
+                counter_name=event['counter_name'],
+                reverses_sequence=event['sequence']
+            )
+        return "Last transaction undone."
+
+    # write-behind persistence
+    def changed(self):
+        # whether anything changed since the last flush
+        return bool(self.dirty_players or self.dirty_properties or self.dirty_counters or self.dirty_city_owned or self.pending_transactions)
+
+    def take_changes(self):
+        # the rows to write for every change since the last flush, or None if nothing changed. The state counts as
+        # flushed from here on; hand the batch back to untake_changes if it could not be written.
+        with self.lock:
+            if not self.changed():
+                self.last_flush = time.monotonic()
+                return None
+
+            checkpoint = None
+            if self.checkpoint_sequence is None or self.next_sequence - 1 - self.checkpoint_sequence >= CHECKPOINT_INTERVAL:
+                snapshot = self.snapshot()
+                checkpoint = (self.game_id, snapshot['sequence'], snapshot['turn'], json.dumps(snapshot))
+
+            batch = {
+                'game_id': self.game_id,
+                # the last event the database should hold before this batch is written
+                'sequence': self.next_sequence - 1 - len(self.pending_transactions),
+                'players': set(self.dirty_players),
+                'properties': set(self.dirty_properties),
+                'counters': set(self.dirty_counters),
+                'city_owned': set(self.dirty_city_owned),
+                'checkpoint_sequence': self.checkpoint_sequence,
+                'net_worth': [(self.turn[slot], self.cash[slot], self.net_property[slot], self.improvement[slot], self.gross[slot], self.game_id, self.player_ids[slot]) for slot in self.dirty_players],
+                'property_ownership': [(self.owner[slot], self.mortgaged[slot], self.houses[slot], self.hotels[slot], self.game_id, self.property_ids[slot]) for slot in self.dirty_properties],
+                'city_ownership': [(city, owner_player_id, self.city_owned[(owner_player_id, city)], self.city_size[city]) for owner_player_id, city in self.dirty_city_owned],
+                'special_counter': [tuple([self.turn[slot]] + self.counters[slot] + [self.game_id, self.player_ids[slot]]) for slot in self.dirty_counters],
+                'transactions': self.pending_transactions,
+                'checkpoint': checkpoint,
+            }
+
+            if checkpoint is not None:
+                self.checkpoint_sequence = checkpoint[1]
+            self.dirty_players.clear()
+            self.dirty_properties.clear()
+            self.dirty_counters.clear()
+            self.dirty_city_owned.clear()
+            self.pending_transactions = []
+            self.last_flush = time.monotonic()
+            return batch
+
+    def untake_changes(self, batch):
+        # mark the changes of a batch that was not written as unflushed again, so the next flush writes them
+        with self.lock:
+            self.dirty_players.update(batch['players'])
+            self.dirty_properties.update(batch['properties'])
+            self.dirty_counters.update(batch['counters'])
+            self.dirty_city_owned.update(batch['city_owned'])
+            self.pending_transactions = batch['transactions'] + self.pending_transactions
+            if batch['checkpoint'] is not None:
+                self.checkpoint_sequence = batch['checkpoint_sequence']
+
+    def flush(self, db, commit=True):
+        # write every changed net_worth, property_ownership and special_counter row and the queued transactions in one batch
+        with self.lock:
+            batch = self.take_changes()
+            if batch is None:
+                return
+            try:
+                write_changes(db, batch)
+                if commit:
+                    db.commit()
+            except StaleGameState:
+                self.discard()
+                raise
+            except BaseException:
+                self.untake_changes(batch)
+                raise
+        return
+
+    def commit(self, config, then=None):
+        # flush through the database writer of config and wait until it has committed. then(db), if given, runs in
+        # the same transaction after the flush and its result is returned. The writer never takes the lock of a game,
+        # so this may be called with the lock held.
+        batch = self.take_changes()
+
+        def job(db):
+            if batch is not None:
+                write_changes(db, batch)
+            return None if then is None else then(db)
+
+        if batch is None and then is None:
+            return None
+        try:
+            return write(config, job)
+        except StaleGameState:
+            self.discard()
+            raise
+        except BaseException:
+            if batch is not None:
+                self.untake_changes(batch)
+            raise
+
+    def discard(self):
+        # forget a stale state, unless the registry already holds a newer one of the game
+        logger.warning("Reloading game %s, another worker changed it; its unflushed changes are lost", self.game_id)
+        with _game_states_lock:
+            if _game_states.get((self.database, self.game_id)) is self:
+                del _game_states[(self.database, self.game_id)]
+
+    def maybe_commit(self, config, interval=FLUSH_INTERVAL):
+        # timer-based flush for long turns: called after each action, only writes once interval has elapsed
+        if time.monotonic() - self.last_flush >= interval:
+            self.commit(config)
+        return
+
+def write_changes(db, batch):
+    # write a batch from GameState.take_changes. Only uses db, so it can run on the writer thread. Raises StaleGameState,
+    # before writing anything, if the game has events the state has not seen.
+    stored_sequence = db.execute(
+        "SELECT IFNULL(MAX(sequence), 0) FROM transactions WHERE game_id = ?",
+        (batch['game_id'],)
+    ).fetchone()[0]
+    if stored_sequence != batch['sequence']:
+        raise StaleGameState(batch['game_id'], batch['sequence'], stored_sequence)
+    db.executemany(
+        """
+        UPDATE net_worth
+        SET turn = ?, cash_balance = ?, net_property_value = ?, improvement_value = ?, gross_property_value = ?
+        WHERE game_id = ? AND player_id = ?
+        """,
+        batch['net_worth']
+    )
+    db.executemany(
+        """
+        UPDATE property_ownership
+        SET owner_player_id = ?, mortgaged = ?, houses = ?, hotels = ?
+        WHERE game_id = ? AND property_id = ?
+        """,
+        batch['property_ownership']
+    )
+    update_city_ownership(db, batch['game_id'], batch['city_ownership'])
+    db.executemany(
+        "UPDATE special_counter SET turn = ?, " + ", ".join(column + " = ?" for column in COUNTER_COLUMNS) + " WHERE game_id = ? AND player_id = ?",
+        batch['special_counter']
+    )
+    record_transactions(db, batch['transactions'])
+    if batch['checkpoint'] is not None:
+        db.execute("INSERT OR REPLACE INTO state_checkpoint (game_id, sequence, turn, state) VALUES (?, ?, ?, ?)", batch['checkpoint'])
+    return
+
+# registry of loaded games for this worker, keyed by (database path, game_id)
+_game_states = {}
+_game_states_lock = threading.Lock()
+
+def get_game_state(db, game_id, database=None):
+    # return the in-memory state for a game, loading it from the database the first time it is used
+    with _game_states_lock:
+        state = _game_states.get((database, game_id))
+        if state is None:
+            state = GameState.load(db, game_id, database)
+            _game_states[(database, game_id)] = state
+    return state
+
+def loaded_game_state(game_id, database=None):
+    # the in-memory state of a game if this worker has loaded it, else None; never loads it
+    with _game_states_lock:
+        return _game_states.get((database, game_id))
+
+def discard_game_state(game_id, database=None):
+    # forget a game without flushing it, e.g. when the game has been deleted
+    with _game_states_lock:
+        _game_states.pop((database, game_id), None)
+    return
+
+def reload_game_version(db, game_version_id, database=None):
+    # refresh the loaded games of a game version after its board changed, with the property rows and a freshly
+    # compiled rent table (the caller has invalidated the old one)
+    with _game_states_lock:
+        states = [state for (state_database, game_id), state in _game_states.items() if state_database == database and state.game_version_id == game_version_id]
+    if not states:
+        return
+
+    properties = {
+        row['property_id']: row
+        for row in db.execute(
+            "SELECT * FROM property WHERE game_version_id = ?",
+            (game_version_id,)
+        )
+    }
+    rent_table = get_rent_table(db, game_version_id, database)
+    for state in states:
+        state.reload_properties(properties, rent_table)
+    return
+
+@atexit.register
+def flush_all_game_states():
+    # last chance flush when the worker exits, so actions taken since the last turn boundary are not lost. The file is
+    # opened read-write without creating it: a state whose database is gone is dropped, and a failing flush is logged
+    # without stopping the flush of the other games. Games without unflushed changes are left alone.
+    with _game_states_lock:
+        states = list(_game_states.items())
+
+    for key, state in states:
+        if state.database is None or not state.changed():
+            continue
+        try:
+            db = sqlite3.connect('file:' + quote(os.path.abspath(state.database)) + '?mode=rw', uri=True)
+        except sqlite3.Error:
+            logger.warning("Dropped game %s, its database %s is gone", state.game_id, state.database)
+            with _game_states_lock:
+                _game_states.pop(key, None)
+            continue
+        try:
+            state.flush(db)
+        except Exception:
+            logger.exception("Last flush of game %s to %s failed", state.game_id, state.database)
+        finally:
+            db.close()
+    return
@@ -1,5 +1,11 @@
-from flask import (Blueprint, flash, g, redirect, render_template, request, session, url_for)
-from monopoly_companion.db import get_db, next_player, previous_player, purchase_property, get_net_worth, go, update_net_worth_turn, purchase_property, rent
+from flask import (Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for)
+from monopoly_companion.db import following_player, get_db, previous_player
+from monopoly_companion.game_state import StaleGameState, get_game_state
+from monopoly_companion.markov import get_landing_probabilities
+from monopoly_companion.projection import get_projection
+from monopoly_companion.scoreboard import publish_scoreboard
+from monopoly_companion.turn_end import end_turn
+from monopoly_companion.versions import check_revision
 
 bp = Blueprint('gameplay',__name__, static_folder='static')
 
@@ -13,29 +19,42 @@ def index():
         else:
             if not session['game_started']:
                 error = "Game not started. Please go to Game Setup to begin."
-                flash(error)     
+                flash(error)
+                return redirect(url_for("game_setup.index"))
     # RESET between sessions??????  
     db = get_db()
     error = None
+    # the session only holds the game, the current player and the turn; the page is rendered from the game state,
+    # revalued first if another process reloaded the board of its version
+    state = get_game_state(db, session['game_id'], current_app.config['DATABASE'])
+    check_revision(db, state.game_version_id, current_app.config['DATABASE'])
 
     if request.method == "POST":
+        # actions are applied to the in-memory game state and written to the database at the end of each turn
         if 'next_player' in request.form:
-            update_net_worth_turn(db)
-            current_player_order, session['current_turn'] = next_player(db, session['player_dict'][str(session['current_player_id'])][1], session['no_of_players'], session['current_turn'])
-            session['current_player_id'] = list({id for id in session['player_dict'] if session['player_dict'][id][1] == current_player_order})[0]
+            state.update_turn(session['current_turn'], session['current_player_id'])
+            # the turn is flushed before responding; the net worth log and projection are left to the turn end pipeline
+            try:
+                state.commit(current_app.config)
+            except StaleGameState:
+                return render_game(db, reloaded(db))
+            current_player_order, session['current_turn'] = following_player(state.players[str(session['current_player_id'])][1], len(state.players), session['current_turn'])
+            session['current_player_id'] = next(int(player_id) for player_id, (player_name, player_order) in state.players.items() if player_order == current_player_order)
+            end_turn(current_app.config, state, session['current_turn'], session['current_player_id'], current_player_order == 1)
+            publish_scoreboard(state, session['current_player_id'], session['current_turn'], current_app.config['DATABASE'])
 
-            return render_template("gameplay/index.html", players=session['player_dict'], current_turn=session['current_turn'], current_player_id=session['current_player_id'], net_worths=session['net_worths'], property_names=session['property_names'])
+            return render_game(db, state)
 
         elif 'pass_go' in request.form:
-            go(db)
+            state.go(session['current_player_id'], session['current_turn'])
             
         elif 'land_on_go' in request.form:
-            go(db,True)
+            state.go(session['current_player_id'], session['current_turn'], True)
 
         elif 'purchase_property' in request.form:
             try: 
                 property_name = request.form['property_name']
-                comment = purchase_property(db, session['current_player_id'], property_name, session['current_turn'])
+                comment = state.purchase_property(session['current_player_id'], property_name, session['current_turn'])
             except KeyError:
                 comment = "Please select property from dropdown."
             flash(comment)
@@ -45,19 +64,80 @@ def index():
                 property_name = request.form['property_name']
                 try:
                     dice_roll = int(request.form['dice_roll'])
-                    rent_due, comment = rent(db, session['current_player_id'], property_name, session['current_turn'], dice_roll)
+                    rent_due, comment = state.rent(session['current_player_id'], property_name, session['current_turn'], dice_roll)
                 except KeyError:
-                    rent_due, comment = rent(db, session['current_player_id'], property_name, session['current_turn'])
+                    rent_due, comment = state.rent(session['current_player_id'], property_name, session['current_turn'])
             except KeyError:
                 comment = "Please select property from dropdown."
             
             flash(comment)
+        elif 'undo' in request.form:
+            comment = state.undo_action(session['current_turn'])
+            flash(comment)
+
         else:
             pass
 
+        try:
+            state.maybe_commit(current_app.config, current_app.config['STATE_FLUSH_INTERVAL'])
+        except StaleGameState:
+            state = reloaded(db)
+        publish_scoreboard(state, session['current_player_id'], session['current_turn'], current_app.config['DATABASE'])
+
+    return render_game(db, state)
+
+
+@bp.route("/scoreboard/<int:game_id>", methods=("GET",))
+def scoreboard(game_id):
+    # read-only spectator screen, kept up to date by the scoreboard stream of the api blueprint
+    db = get_db()
+    try:
+        state = get_game_state(db, game_id, current_app.config['DATABASE'])
+    except KeyError:
+        return redirect(url_for("welcome.index"))
+    check_revision(db, state.game_version_id, current_app.config['DATABASE'])
+
+    # names of the bank and free parking as well, which can own properties
+    players = {}
+    game_player_ids = []
+    for row in db.execute(
+        "SELECT player_id, player_name, game_id FROM players WHERE game_id = ? OR game_id IS NULL ORDER BY player_order",
+        (game_id,)
+    ):
+        players[row['player_id']] = row['player_name']
+        if row['game_id'] is not None:
+            game_player_ids.append(row['player_id'])
+
+    properties = [(property_id, state.properties[slot]['property_name'], state.owner[slot]) for slot, property_id in enumerate(state.property_ids)]
+    return render_template("gameplay/scoreboard.html", game_id=game_id, players=players, game_player_ids=game_player_ids, net_worths=state.net_worths(), properties=properties)
 
+def render_game(db, state):
+    # players, net worths and property names come from the game state, so actions other than next_player leave the
+    # session unchanged and it is not written
+    return render_template("gameplay/index.html", players=state.players, current_turn=session['current_turn'], current_player_id=session['current_player_id'], net_worths=state.net_worths(), property_names=list(state.property_by_name), expected_rents=expected_rents(db, state), projection=projection())
 
-        net_worth_table, session['net_worths'] = get_net_worth(db)
+def reloaded(db):
+    # the game was changed through another worker, so the actions held here were dropped: show the game as stored
+    flash("This game was changed elsewhere and has been reloaded, your last actions were not saved.")
+    return get_game_state(db, session['game_id'], current_app.config['DATABASE'])
 
-    return render_template("gameplay/index.html", players=session['player_dict'], current_turn=session['current_turn'], current_player_id=session['current_player_id'], net_worths=session['net_worths'], property_names=session['property_names'])
+def expected_rents(db, state):
+    # expected rent per roll of every owned property, from the stored landing probabilities of the game version.
+    # Nothing is shown if the board cannot be solved (no board positions, or scipy not installed).
+    if not session.get('game_started'):
+        return []
+    try:
+        landing_probabilities = get_landing_probabilities(db, state.game_version_id, current_app.config['DATABASE'], current_app.config)
+    except (ImportError, ValueError):
+        return []
+    return sorted(state.expected_rents(landing_probabilities), key=lambda expected: expected[2], reverse=True)
 
+def projection():
+    # the latest win projection of the game, once it has finished any rollouts
+    if not session.get('game_started'):
+        return None
+    projection = get_projection(session['game_id'], current_app.config['DATABASE'])
+    if projection is None:
+        return None
+    result = projection.result()
+    return result if result['rollouts'] else None
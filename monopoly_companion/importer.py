@@ -0,0 +1,261 @@
+import csv
+import json
+import os
+import time
+import click
+from flask import current_app
+from monopoly_companion.db import create_game, get_db, get_game_template, log_net_worth, register_players
+from monopoly_companion.game_state import CHECKPOINT_INTERVAL, GameState, write_changes
+
+# this module imports games played on paper or in a spreadsheet from turn-by-turn action logs, so they can be analysed
+# like games played in the app. A log is CSV or JSON Lines with one action per row and the columns of LOG_COLUMNS;
+# the rows of a game are consecutive and share its 'game' key. The players of a game are its player names in order of
+# their first action. Each row is checked against the action_type table and replayed through GameState, the engine
+# behind gameplay, so rents, prices and go money are computed exactly as in a live game; an amount in the log must
+# match them. A game whose log is invalid is skipped and reported, and the other games are still imported.
+#
+# Games are set up from the version templates and replayed in memory. Their rows are written with the same batched
+# statements as the write-behind flush (a checkpoint every CHECKPOINT_INTERVAL events) and the net worth log of every
+# round by db.log_net_worth, as the turn end pipeline logs live games. BATCH_SIZE games are committed together, each in
+# a savepoint so a failing game is rolled back alone.
+
+LOG_COLUMNS = ['game', 'game_version', 'turn', 'player', 'action', 'property', 'dice_roll', 'amount']
+
+# games committed per transaction
+BATCH_SIZE = 200
+
+class LogError(Exception):
+    # a row of a log that cannot be imported; line is its line number in the file
+    def __init__(self, line, message):
+        super().__init__("line " + str(line) + ": " + message)
+        self.line = line
+        self.message = message
+
+# readers yield (line number, row) with empty cells as None
+def read_csv(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        yield reader.line_num, {column: (value if value != '' else None) for column, value in row.items()}
+
+def read_jsonl(f):
+    for line, text in enumerate(f, start=1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as error:
+            raise LogError(line, "Invalid JSON: " + str(error))
+        if not isinstance(row, dict):
+            raise LogError(line, "Expected a JSON object")
+        yield line, row
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+def log_games(rows):
+    # group a stream of (line, row) into (key, [(line, row), ...]) per game. Only one game is held in memory at a time,
+    # so the rows of a game have to be consecutive.
+    seen = set()
+    key = None
+    game = []
+    for line, row in rows:
+        row_key = row.get('game')
+        if row_key is None:
+            raise LogError(line, "Missing game")
+        row_key = str(row_key)
+        if row_key != key:
+            if game:
+                yield key, game
+            if row_key in seen:
+                raise LogError(line, "The rows of game " + row_key + " are not consecutive")
+            seen.add(row_key)
+            key = row_key
+            game = []
+        game.append((line, row))
+    if game:
+        yield key, game
+
+def number(line, row, column, required=False):
+    value = row.get(column)
+    if value is None:
+        if required:
+            raise LogError(line, "Missing " + column)
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise LogError(line, "Invalid " + column + " " + repr(value))
+
+def action_name(name):
+    # 'Pass go', 'pass_go' and 'PASS GO' are the same action
+    return str(name).strip().lower().replace('_', ' ')
+
+# replay of the supported action types, by action_type_id: each applies the action and returns the amount of cash
+# it moved, or raises LogError
+def purchase_property(state, line, player_id, turn, row):
+    name = property_name(state, line, row)
+    if state.owner[state.property_by_name[name]] != 1:
+        raise LogError(line, name + " is not owned by the bank")
+    state.purchase_property(player_id, name, turn)
+    return state.pending_transactions[-1]['cash_paid']
+
+def rent(state, line, player_id, turn, row):
+    rent_due, comment = state.rent(player_id, property_name(state, line, row), turn, number(line, row, 'dice_roll'))
+    if rent_due is None:
+        raise LogError(line, comment)
+    return rent_due
+
+def pass_go(state, line, player_id, turn, row):
+    state.go(player_id, turn)
+    return state.pending_transactions[-1]['cash_received']
+
+def land_on_go(state, line, player_id, turn, row):
+    state.go(player_id, turn, True)
+    return state.pending_transactions[-1]['cash_received']
+
+REPLAY = {1: purchase_property, 2: rent, 3: pass_go, 4: land_on_go}
+
+def property_name(state, line, row):
+    name = row.get('property')
+    if name not in state.property_by_name:
+        raise LogError(line, "Unknown property " + repr(name))
+    return name
+
+class Importer:
+    # imports games into one database, caching the reference data it validates against
+    __slots__ = ('db', 'database', 'versions', 'action_types', 'games', 'actions', 'errors')
+
+    def __init__(self, db, database=None):
+        self.db = db
+        self.database = database
+        self.versions = {}
+        for row in db.execute("SELECT game_version_id, game_version_name FROM game_version"):
+            self.versions[row['game_version_name']] = row['game_version_id']
+            self.versions[str(row['game_version_id'])] = row['game_version_id']
+        self.action_types = {}
+        for row in db.execute("SELECT action_type_id, action_type_name FROM action_type"):
+            self.action_types[action_name(row['action_type_name'])] = row['action_type_id']
+            self.action_types[str(row['action_type_id'])] = row['action_type_id']
+        # imported games as (key, game_id), actions replayed and skipped games as (key, LogError)
+        self.games = []
+        self.actions = 0
+        self.errors = []
+
+    def import_log(self, rows, batch_size=BATCH_SIZE):
+        # import every game of a stream of (line, row) from a reader, committing batch_size games at a time
+        db = self.db
+        pending = 0
+        try:
+            for key, game in log_games(rows):
+                if pending == 0:
+                    db.execute("BEGIN")
+                db.execute("SAVEPOINT game")
+                try:
+                    game_id, actions = self.import_game(game)
+                except LogError as error:
+                    db.execute("ROLLBACK TO game")
+                    self.errors.append((key, error))
+                else:
+                    self.games.append((key, game_id))
+                    self.actions += actions
+                db.execute("RELEASE game")
+                pending += 1
+                if pending >= batch_size:
+                    db.commit()
+                    pending = 0
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        return self
+
+    def import_game(self, game):
+        # set up and replay one game. Returns its game_id and number of actions.
+        db = self.db
+        line, first = game[0]
+        version = first.get('game_version')
+        game_version_id = self.versions.get(None if version is None else str(version))
+        if game_version_id is None:
+            raise LogError(line, "Unknown game version " + repr(version))
+
+        players = []
+        for line, row in game:
+            if row.get('player') is None:
+                raise LogError(line, "Missing player")
+            if row.get('game_version') not in (None, version):
+                raise LogError(line, "Game version " + repr(row['game_version']) + " differs from " + repr(version))
+            if str(row['player']) not in players:
+                players.append(str(row['player']))
+
+        template = get_game_template(db, game_version_id, self.database)
+        game_id = create_game(db, game_version_id, len(players), False, self.database, commit=False)
+        player_dict = register_players(db, game_id, template, players)
+        player_ids = {name: player_id for player_id, (name, order) in player_dict.items()}
+
+        state = GameState.load(db, game_id, self.database, journal=False)
+        state.checkpoint(db)
+
+        turn = None
+        for line, row in game:
+            row_turn = number(line, row, 'turn', True)
+            if turn is not None and row_turn != turn:
+                if row_turn < turn:
+                    raise LogError(line, "Turn " + str(row_turn) + " after turn " + str(turn))
+                log_net_worth(db, game_id, turn, state.balances())
+            turn = row_turn
+
+            name = row.get('action')
+            action_type_id = self.action_types.get(None if name is None else action_name(name))
+            if action_type_id is None:
+                raise LogError(line, "Unknown action " + repr(name))
+            replay = REPLAY.get(action_type_id)
+            if replay is None:
+                raise LogError(line, str(name) + " is not supported yet")
+
+            player_id = player_ids[str(row['player'])]
+            state.update_turn(turn, player_id)
+            amount = number(line, row, 'amount')
+            moved = replay(state, line, player_id, turn, row)
+            if amount is not None and amount != moved:
+                raise LogError(line, "Amount " + str(amount) + " does not match " + str(moved))
+
+            if state.next_sequence - 1 - state.checkpoint_sequence >= CHECKPOINT_INTERVAL:
+                write_changes(db, state.take_changes())
+
+        changes = state.take_changes()
+        if changes is not None:
+            write_changes(db, changes)
+        if turn is not None:
+            log_net_worth(db, game_id, turn, state.balances())
+        return game_id, len(game)
+
+def import_file(db, path, fmt=None, batch_size=BATCH_SIZE, database=None):
+    # import a CSV or JSON Lines log; the format is taken from the extension if not given
+    if fmt is None:
+        fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in READERS:
+        raise ValueError("Unknown log format " + repr(fmt))
+    with open(path, newline='') as f:
+        return Importer(db, database).import_log(READERS[fmt](f), batch_size)
+
+@click.command('import-games')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(list(READERS)), default=None, help='Log format (default: from the file extension).')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Games committed per transaction.')
+def import_games_command(paths, fmt, batch_size):
+    """Import played games from turn-by-turn action logs (CSV or JSON Lines)"""
+    db = get_db()
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            importer = import_file(db, path, fmt, batch_size, current_app.config['DATABASE'])
+        except (ValueError, LogError) as error:
+            raise click.ClickException(path + ": " + str(error))
+        elapsed = time.perf_counter() - start
+        for key, error in importer.errors:
+            click.echo(path + ": skipped game " + key + ", " + str(error), err=True)
+        click.echo("{}: imported {} games ({} actions) in {:.1f}s, {:.0f} games per minute, skipped {}".format(
+            path, len(importer.games), importer.actions, elapsed, len(importer.games) / elapsed * 60 if elapsed else 0, len(importer.errors)
+        ))
+
+def init_app(app):
+    app.cli.add_command(import_games_command)
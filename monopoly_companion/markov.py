@@ -0,0 +1,206 @@
+import threading
+from concurrent.futures import Future
+import click
+from monopoly_companion.board import BOARD_SIZE, GO_TO_JAIL, JAIL, JAIL_TURNS, Board
+from monopoly_companion.db import get_db
+from monopoly_companion.writer import write
+
+# this module solves exactly where players land on the board of a game version. Every dice throw is a step of a
+# Markov chain whose states are a square together with the doubles thrown so far in the turn, or a turn in jail.
+# The transition matrix follows the dice distribution, the three doubles and jail rules and the movement cards of
+# the board (drawn with replacement, like the simulation), and its stationary distribution is found with a sparse
+# linear solve. Results are stored in the landing_probability table per game version and board layout, so they are
+# solved once and then only read. In the app they are stored through the database writer (see writer.py), like every
+# other write. scipy is an optional dependency and only imported when a board is solved.
+
+# consecutive doubles after which the player goes to jail instead of moving
+DOUBLES_LIMIT = 3
+
+# card draws followed from one landing, as in the simulation
+CARD_DRAWS = 2
+
+DICE = [(first, second) for first in range(1, 7) for second in range(1, 7)]
+
+def square_state(square, doubles):
+    return square * DOUBLES_LIMIT + doubles
+
+def jail_state(attempts):
+    return BOARD_SIZE * DOUBLES_LIMIT + attempts
+
+STATES = BOARD_SIZE * DOUBLES_LIMIT + JAIL_TURNS
+
+def resolve_cards(card_table, square, probability=1.0, draws=CARD_DRAWS):
+    # the squares a player landing on square ends up on after drawing any cards, as (square, probability) pairs
+    deck = card_table[square]
+    if not deck or draws == 0:
+        return [(square, probability)]
+    outcomes = []
+    for destination, passes_go in deck:
+        if destination is None:
+            outcomes.append((square, probability / len(deck)))
+        else:
+            outcomes.extend(resolve_cards(card_table, destination, probability / len(deck), draws - 1))
+    return outcomes
+
+def transitions(board):
+    # (from_state, to_state, probability, dice_total) for every outcome of a throw from every state
+    card_table = board.card_table()
+    landings = [resolve_cards(card_table, square) for square in range(BOARD_SIZE)]
+
+    def move(from_state, square, doubles, probability, total):
+        for destination, card_probability in landings[(square + total) % BOARD_SIZE]:
+            if destination == GO_TO_JAIL:
+                yield from_state, jail_state(0), probability * card_probability, total
+            else:
+                yield from_state, square_state(destination, doubles), probability * card_probability, total
+
+    for square in range(BOARD_SIZE):
+        for doubles in range(DOUBLES_LIMIT):
+            for first, second in DICE:
+                if first == second and doubles + 1 == DOUBLES_LIMIT:
+                    yield square_state(square, doubles), jail_state(0), 1 / len(DICE), first + second
+                else:
+                    yield from move(square_state(square, doubles), square, doubles + 1 if first == second else 0, 1 / len(DICE), first + second)
+
+    # leaving jail, on a double or after the last attempt, ends the turn
+    for attempts in range(JAIL_TURNS):
+        for first, second in DICE:
+            if first == second or attempts + 1 == JAIL_TURNS:
+                yield from move(jail_state(attempts), JAIL, 0, 1 / len(DICE), first + second)
+            else:
+                yield jail_state(attempts), jail_state(attempts + 1), 1 / len(DICE), first + second
+
+def solve(board):
+    # probability per roll and per turn of ending a move on every square, and the mean dice roll that brought the
+    # player there. Being sent to jail counts as landing on the jail square.
+    import numpy as np
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve
+
+    from_states, to_states, probabilities, totals = zip(*transitions(board))
+    from_states = np.array(from_states)
+    to_states = np.array(to_states)
+    probabilities = np.array(probabilities)
+    matrix = sparse.csr_matrix((probabilities, (from_states, to_states)), shape=(STATES, STATES))
+
+    # stationary distribution: (P^T - I) x = 0, with the last equation replaced by sum(x) = 1
+    system = (matrix.T - sparse.identity(STATES, format='csr')).tolil()
+    system[STATES - 1, :] = np.ones(STATES)
+    rhs = np.zeros(STATES)
+    rhs[STATES - 1] = 1.0
+    stationary = spsolve(system.tocsc(), rhs)
+
+    # flow into each state weighted by the dice total of the throw
+    dice_matrix = sparse.csr_matrix((probabilities * np.array(totals), (from_states, to_states)), shape=(STATES, STATES))
+    dice_flow = dice_matrix.T @ stationary
+
+    per_roll = stationary[:BOARD_SIZE * DOUBLES_LIMIT].reshape(BOARD_SIZE, DOUBLES_LIMIT).sum(axis=1)
+    dice_mass = dice_flow[:BOARD_SIZE * DOUBLES_LIMIT].reshape(BOARD_SIZE, DOUBLES_LIMIT).sum(axis=1)
+    per_roll[JAIL] += stationary[jail_state(0)]
+    dice_mass[JAIL] += dice_flow[jail_state(0)]
+
+    # a turn starts with every throw that does not follow a double
+    turn_starts = stationary[[square_state(square, 0) for square in range(BOARD_SIZE)]].sum() + stationary[[jail_state(attempts) for attempts in range(JAIL_TURNS)]].sum()
+
+    return {
+        square: (float(per_roll[square]), float(per_roll[square] / turn_starts), float(dice_mass[square] / per_roll[square]) if per_roll[square] else None)
+        for square in range(BOARD_SIZE)
+    }
+
+# a future of the landing probabilities of each game version for this worker, keyed by (database path, game_version_id)
+_landing_probabilities = {}
+_landing_probabilities_lock = threading.Lock()
+
+def get_landing_probabilities(db, game_version_id, database=None, config=None):
+    # {board_position: (probability_per_roll, probability_per_turn, mean_dice_roll)} for a game version, read from
+    # the landing_probability table, or solved and stored there if its board layout has not been solved yet. The first
+    # caller reads or solves them outside the lock, callers for the same version wait on its future. A version that
+    # cannot be solved (ImportError without scipy, ValueError for a board without positions) is remembered too, so
+    # gameplay pages do not retry it on every render, until invalidate_landing_probabilities.
+    key = (database, game_version_id)
+    with _landing_probabilities_lock:
+        future = _landing_probabilities.get(key)
+        running = future is None
+        if running:
+            future = Future()
+            _landing_probabilities[key] = future
+
+    if running:
+        try:
+            future.set_result(load_landing_probabilities(db, game_version_id, config))
+        except (ImportError, ValueError) as error:
+            future.set_result(error)
+        except BaseException as error:
+            # not cached, so the next caller tries again
+            with _landing_probabilities_lock:
+                if _landing_probabilities.get(key) is future:
+                    del _landing_probabilities[key]
+            future.set_exception(error)
+
+    probabilities = future.result()
+    if isinstance(probabilities, Exception):
+        # raised afresh each time, so the remembered error does not collect the frames of every caller
+        raise probabilities.with_traceback(None)
+    return probabilities
+
+def load_landing_probabilities(db, game_version_id, config=None):
+    # read the probabilities of a game version, or solve and store them. With the app's config the rows are stored by
+    # its writer; without (command line tools) they are committed on db.
+    board = Board.load(db, game_version_id)
+    layout = board.layout()
+    probabilities = {
+        row['board_position']: (row['probability_per_roll'], row['probability_per_turn'], row['mean_dice_roll'])
+        for row in db.execute(
+            "SELECT * FROM landing_probability WHERE game_version_id = ? AND layout = ?",
+            (game_version_id, layout)
+        )
+    }
+
+    if len(probabilities) != BOARD_SIZE:
+        probabilities = solve(board)
+        rows = [(game_version_id, layout, square) + probabilities[square] for square in range(BOARD_SIZE)]
+        if config is not None:
+            write(config, lambda db: store_landing_probabilities(db, game_version_id, rows))
+        else:
+            store_landing_probabilities(db, game_version_id, rows)
+            db.commit()
+    return probabilities
+
+def store_landing_probabilities(db, game_version_id, rows):
+    # replace the stored probabilities of a game version, without committing
+    db.execute(
+        "DELETE FROM landing_probability WHERE game_version_id = ?",
+        (game_version_id,)
+    )
+    db.executemany(
+        "INSERT INTO landing_probability (game_version_id, layout, board_position, probability_per_roll, probability_per_turn, mean_dice_roll) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    return
+
+def invalidate_landing_probabilities(game_version_id, database=None):
+    # drop the probabilities (or the error) held for a game version so its layout is checked against the table on next
+    # use. A caller still solving it answers the callers waiting for it.
+    with _landing_probabilities_lock:
+        _landing_probabilities.pop((database, game_version_id), None)
+    return
+
+@click.command('landing-probabilities')
+@click.argument('game_version_id', type=int, default=1)
+def landing_probabilities_command(game_version_id):
+    """Solve and store the landing probability of every square of a game version"""
+    db = get_db()
+    try:
+        probabilities = get_landing_probabilities(db, game_version_id)
+    except ImportError as error:
+        raise click.ClickException("Solving the board needs an optional dependency: " + str(error))
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    board = Board.load(db, game_version_id)
+    for square in range(BOARD_SIZE):
+        per_roll, per_turn, mean_dice = probabilities[square]
+        click.echo('{:>2} {:<24} {:>6.2%} per roll {:>6.2%} per turn'.format(square, board.property_names[square] or '', per_roll, per_turn))
+
+def init_app(app):
+    app.cli.add_command(landing_probabilities_command)
@@ -0,0 +1,269 @@
+import collections
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from flask import Blueprint, current_app, g, has_request_context, jsonify, render_template, request, request_finished
+
+# this module profiles the SQL of every request when SQL_PROFILE is set. The pool then opens ProfilingConnections:
+# sqlite3's trace callback records each statement SQLite runs (including the rows of executemany, BEGIN and COMMIT),
+# and the execute, executemany, executescript and commit calls and the cursor fetches add their time and row counts to
+# those statements. Statements are grouped by shape (literals replaced by ?) and a shape run REPEAT_THRESHOLD or more
+# times in one request is flagged as a likely N+1 loop. Each request's profile is added to the response headers
+# (X-SQL-Statements, X-SQL-Time, X-SQL-Repeated and Server-Timing), logged as one JSON line on the
+# monopoly_companion.profiling logger, and kept for the /debug/profile page.
+# A profile also records the jobs its request hands to the database writer (game flushes and session saves, see
+# writer.py), so it is finished once the response is complete, after the session has been saved.
+
+# times a statement shape may run in one request before it is flagged
+REPEAT_THRESHOLD = 5
+
+# request profiles kept for /debug/profile
+HISTORY = 200
+
+logger = logging.getLogger(__name__)
+
+class Statement:
+    __slots__ = ('sql', 'duration', 'rows', 'batch')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.duration = 0.0
+        self.rows = 0
+        self.batch = False
+
+class Profile:
+    # the statements run on the connection of one request
+    __slots__ = ('statements', 'start')
+
+    def __init__(self):
+        self.statements = []
+        self.start = time.perf_counter()
+
+    def summary(self, repeat_threshold=REPEAT_THRESHOLD):
+        # totals and the shapes run at least repeat_threshold times by separate calls, slowest first
+        shapes = {}
+        for statement in self.statements:
+            key = shape(statement.sql)
+            count, calls, duration, rows = shapes.get(key, (0, 0, 0.0, 0))
+            shapes[key] = (count + 1, calls + (not statement.batch), duration + statement.duration, rows + statement.rows)
+        repeated = [
+            {'shape': sql, 'count': count, 'ms': round(duration * 1000, 3), 'rows': rows}
+            for sql, (count, calls, duration, rows) in shapes.items()
+            if calls >= repeat_threshold
+        ]
+        return {
+            'statements': len(self.statements),
+            'sql_ms': round(sum(statement.duration for statement in self.statements) * 1000, 3),
+            'rows': sum(statement.rows for statement in self.statements),
+            'shapes': len(shapes),
+            'repeated': sorted(repeated, key=lambda item: item['ms'], reverse=True),
+        }
+
+# string and blob literals, numbers, and lists of placeholders, as they appear in the expanded SQL of the trace callback
+LITERALS = re.compile(r"[xX]?'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+PLACEHOLDER_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+ROW_LISTS = re.compile(r"\([?.\s,]*\)(?:\s*,\s*\([?.\s,]*\))+")
+WHITESPACE = re.compile(r"\s+")
+
+def shape(sql):
+    # the statement with its values replaced, so the same query with other parameters has the same shape
+    sql = LITERALS.sub('?', sql)
+    sql = PLACEHOLDER_LISTS.sub('?, ...', sql)
+    sql = ROW_LISTS.sub('(...), ...', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+class ProfilingCursor(sqlite3.Cursor):
+    # adds the time and rows of each fetch to the statement that produced them
+    statement = None
+
+    def fetched(self, start, rows):
+        if self.statement is not None:
+            self.statement.duration += time.perf_counter() - start
+            self.statement.rows += rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(start, 0)
+            raise
+        self.fetched(start, 1)
+        return row
+
+class ProfilingConnection(sqlite3.Connection):
+    # records into profile while one is attached (by get_db, for the duration of a request)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = None
+        self.set_trace_callback(self.trace)
+
+    def trace(self, sql):
+        if self.profile is not None:
+            self.profile.statements.append(Statement(sql))
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def timed(self, call, *args, batch=False):
+        # run call and share its time among the statements SQLite traced while it ran. The rows of an executemany
+        # are one batch, which is not counted as repeated statements.
+        profile = self.profile
+        if profile is None:
+            return call(*args)
+        first = len(profile.statements)
+        start = time.perf_counter()
+        try:
+            result = call(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            statements = profile.statements[first:]
+            for statement in statements:
+                statement.duration += elapsed / len(statements)
+                statement.batch = batch
+        if statements and isinstance(result, ProfilingCursor):
+            # changed rows are known now, selected rows are added as they are fetched
+            if result.rowcount > 0:
+                statements[-1].rows += result.rowcount
+            result.statement = statements[-1]
+        return result
+
+    # the shortcut methods of sqlite3.Connection would open a plain cursor, so they are spelled out with a ProfilingCursor
+    def execute(self, sql, parameters=()):
+        return self.timed(self.cursor().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.timed(self.cursor().executemany, sql, parameters, batch=True)
+
+    def executescript(self, script):
+        return self.timed(self.cursor().executescript, script)
+
+    def commit(self):
+        return self.timed(super().commit)
+
+class ProfileHistory:
+    # the latest request profiles of this worker
+    __slots__ = ('profiles', 'lock')
+
+    def __init__(self, size=HISTORY):
+        self.profiles = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.profiles.append(record)
+
+    def records(self):
+        with self.lock:
+            return list(self.profiles)
+
+    def by_endpoint(self):
+        # requests, latency and statements per endpoint, and the repeated shapes with the most time across requests
+        endpoints = {}
+        repeated = {}
+        for record in self.records():
+            endpoints.setdefault(record['endpoint'], []).append(record)
+            for item in record['repeated']:
+                key = (record['endpoint'], item['shape'])
+                requests, count, ms = repeated.get(key, (0, 0, 0.0))
+                repeated[key] = (requests + 1, count + item['count'], ms + item['ms'])
+        return {
+            'endpoints': [
+                {
+                    'endpoint': endpoint,
+                    'requests': len(records),
+                    'mean_ms': round(sum(record['duration_ms'] for record in records) / len(records), 3),
+                    'max_ms': max(record['duration_ms'] for record in records),
+                    'mean_sql_ms': round(sum(record['sql_ms'] for record in records) / len(records), 3),
+                    'mean_statements': round(sum(record['statements'] for record in records) / len(records), 1),
+                    'max_statements': max(record['statements'] for record in records),
+                }
+                for endpoint, records in sorted(endpoints.items(), key=lambda item: item[0] or '')
+            ],
+            'repeated': [
+                {'endpoint': endpoint, 'shape': sql, 'requests': requests, 'count': count, 'ms': round(ms, 3)}
+                for (endpoint, sql), (requests, count, ms) in sorted(repeated.items(), key=lambda item: item[1][2], reverse=True)
+            ],
+        }
+
+def start_profile():
+    g.sql_profile = Profile()
+
+def current_profile():
+    # the profile of the request being handled on this thread, or None
+    return g.get('sql_profile') if has_request_context() else None
+
+def request_profiled(sender, response, **extra):
+    # request_finished is sent after the session is saved, and before the response goes out
+    finish_profile(response)
+
+def finish_profile(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+    if 'db' in g:
+        g.db.profile = None
+
+    summary = profile.summary(current_app.config.get('SQL_PROFILE_REPEAT_THRESHOLD', REPEAT_THRESHOLD))
+    duration_ms = round((time.perf_counter() - profile.start) * 1000, 3)
+    record = dict(
+        time=time.time(),
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        status=response.status_code,
+        duration_ms=duration_ms,
+        **summary
+    )
+
+    response.headers['X-SQL-Statements'] = str(summary['statements'])
+    response.headers['X-SQL-Time'] = '{:.3f}'.format(summary['sql_ms'])
+    response.headers['X-SQL-Repeated'] = str(len(summary['repeated']))
+    response.headers.add('Server-Timing', 'sql;dur={:.3f};desc="{} statements"'.format(summary['sql_ms'], summary['statements']))
+
+    current_app.extensions['sql_profile'].add(record)
+    if summary['repeated']:
+        logger.warning(json.dumps(record))
+    else:
+        logger.info(json.dumps(record))
+    return response
+
+bp = Blueprint('debug', __name__, url_prefix='/debug')
+
+@bp.route("/profile", methods=("GET",))
+def profile():
+    # recent requests of this worker, per endpoint, and the statement shapes repeated within requests
+    history = current_app.extensions['sql_profile']
+    report = history.by_endpoint()
+    if request.args.get('format') == 'json':
+        return jsonify(dict(report, requests=history.records()))
+    return render_template("debug/profile.html", report=report, requests=list(reversed(history.records())))
+
+def init_app(app):
+    if not app.config.get('SQL_PROFILE'):
+        return
+    app.extensions['sql_profile'] = ProfileHistory(app.config.get('SQL_PROFILE_HISTORY', HISTORY))
+    app.before_request(start_profile)
+    request_finished.connect(request_profiled, app)
+    app.register_blueprint(bp)
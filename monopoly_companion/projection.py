@@ -0,0 +1,375 @@
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from monopoly_companion.board import BOARD_SIZE, GO, GO_TO_JAIL, Board
+from monopoly_companion.markov import get_landing_probabilities
+from monopoly_companion.rent import HOTEL_LEVEL, LEVELS, MONOPOLY_LEVEL, STREET, UTILITY, get_rent_table
+from monopoly_companion.simulation import card_arrays, process_context, throw_dice
+
+# this module projects how a running game may end. The game is forked from its rows in net_worth and
+# property_ownership and played forward many times at once with NumPy (the movement rules of the simulation, GO
+# salary, buying unowned properties the player can afford, building on monopolies, and rent from the compiled rent
+# table). A player goes bankrupt when rent leaves them with less cash than their properties and buildings can be
+# mortgaged and sold for.
+# Batches of rollouts run in a shared process pool and are added to the estimate as they finish, so a Projection
+# can be read at any time; it is cancelled when a newer one is started for the game or its time budget runs out.
+# numpy is an optional dependency and only imported when a projection runs.
+
+ROLLOUTS = 2000
+TURNS = 50
+TIME_BUDGET = 10.0
+BATCH_SIZE = 250
+
+# cash a player keeps back when building in a rollout
+BUILD_RESERVE = 200
+
+# owner index of properties held by the bank in a rollout
+BANK = -1
+
+def fork_game(db, game_id, current_player_id=None, database=None, config=None):
+    # the arrays a rollout starts from, with the players rotated so the current player (or the first in order) moves first
+    import numpy as np
+
+    game = db.execute(
+        """
+        SELECT game.game_version_id, game.double_go, game_version.go_value
+        FROM game
+        JOIN game_version
+        ON game.game_version_id = game_version.game_version_id
+        WHERE game.game_id = ?
+        """,
+        (game_id,)
+    ).fetchone()
+    if game is None:
+        raise KeyError(game_id)
+
+    players = db.execute(
+        """
+        SELECT players.player_id, net_worth.cash_balance
+        FROM players
+        JOIN net_worth
+        ON net_worth.game_id = players.game_id AND net_worth.player_id = players.player_id
+        WHERE players.game_id = ?
+        ORDER BY players.player_order
+        """,
+        (game_id,)
+    ).fetchall()
+    player_ids = [row['player_id'] for row in players]
+    if current_player_id in player_ids:
+        first = player_ids.index(current_player_id)
+        players = players[first:] + players[:first]
+        player_ids = player_ids[first:] + player_ids[:first]
+    player_index = {player_id: index for index, player_id in enumerate(player_ids)}
+
+    board = Board.load(db, game['game_version_id'])
+    rent_table = get_rent_table(db, game['game_version_id'], database)
+    properties = db.execute(
+        """
+        SELECT *
+        FROM property_ownership
+        JOIN property
+        ON property_ownership.property_id = property.property_id
+        WHERE property_ownership.game_id = ?
+        ORDER BY property.board_position
+        """,
+        (game_id,)
+    ).fetchall()
+
+    cities = sorted({prop['city'] for prop in properties})
+    city = np.array([cities.index(prop['city']) for prop in properties])
+    square_slot = np.full(BOARD_SIZE, -1, dtype=np.int64)
+    for slot, prop in enumerate(properties):
+        square_slot[prop['board_position']] = slot
+
+    # tokens start spread over the board like players in a long game; evenly if the board cannot be solved
+    try:
+        landing_probabilities = get_landing_probabilities(db, game['game_version_id'], database, config)
+        start = np.array([landing_probabilities[square][0] for square in range(BOARD_SIZE)])
+    except ImportError:
+        start = np.ones(BOARD_SIZE)
+    start[GO_TO_JAIL] = 0
+    start = start / start.sum()
+
+    return {
+        'player_ids': player_ids,
+        'cash': np.array([row['cash_balance'] for row in players], dtype=np.int64),
+        'go_value': game['go_value'],
+        'double_go': bool(game['double_go']),
+        'start': start,
+        'cards': card_arrays(board),
+        'square_slot': square_slot,
+        'owner': np.array([player_index.get(prop['owner_player_id'], BANK) for prop in properties], dtype=np.int64),
+        'mortgaged': np.array([bool(prop['mortgaged']) for prop in properties]),
+        'houses': np.array([prop['houses'] for prop in properties], dtype=np.int64),
+        'hotels': np.array([prop['hotels'] for prop in properties], dtype=np.int64),
+        'price': np.array([prop['price'] for prop in properties], dtype=np.int64),
+        'house_cost': np.array([prop['house_cost'] or 0 for prop in properties], dtype=np.int64),
+        'mortgage_value': np.array([prop['mortgage_value'] for prop in properties], dtype=np.int64),
+        'kinds': np.array([rent_table.kinds[prop['property_id']] for prop in properties], dtype=np.int64),
+        'rents': np.array([[rent or 0 for rent in rent_table.rents[prop['property_id']]] for prop in properties], dtype=np.int64),
+        'city_members': city[:, None] == city[None, :],
+        'city_size': np.bincount(city)[city],
+    }
+
+def rent_due(setup, owner, houses, hotels, rows, slots, creditors, totals):
+    # rent for the landed properties of the given rollouts, with the levels of RentTable.rent_level
+    import numpy as np
+
+    number_owned = ((owner[rows] == creditors[:, None]) & setup['city_members'][slots]).sum(axis=1)
+    kinds = setup['kinds'][slots]
+    level = np.where(
+        hotels[rows, slots] == 1, HOTEL_LEVEL,
+        np.where(
+            houses[rows, slots] > 0, MONOPOLY_LEVEL + houses[rows, slots],
+            np.where(kinds == STREET, np.where(number_owned == setup['city_size'][slots], MONOPOLY_LEVEL, 0), np.maximum(number_owned - 1, 0))
+        )
+    )
+    rent = setup['rents'][slots, np.minimum(level, LEVELS - 1)]
+    return np.where(kinds == UTILITY, rent * totals, rent)
+
+def build(setup, owner, mortgaged, houses, hotels, cash, player):
+    # at the end of their turn a player with a monopoly builds one house (a hotel after four) on the least built
+    # street of it, if they can afford it and keep BUILD_RESERVE
+    import numpy as np
+
+    owned = owner == player
+    monopoly = (owned.astype(np.int64) @ setup['city_members']) == setup['city_size']
+    buildable = owned & monopoly & (setup['kinds'] == STREET) & ~mortgaged & (hotels == 0)
+    buildings = np.where(buildable, houses, np.iinfo(np.int64).max)
+    slots = buildings.argmin(axis=1)
+    rows = np.arange(len(owner))
+    building = buildable[rows, slots] & (cash[:, player] >= setup['house_cost'][slots] + BUILD_RESERVE)
+    rows = rows[building]
+    slots = slots[building]
+
+    cash[rows, player] -= setup['house_cost'][slots]
+    hotel = houses[rows, slots] == 4
+    houses[rows, slots] = np.where(hotel, 0, houses[rows, slots] + 1)
+    hotels[rows, slots] = np.where(hotel, 1, hotels[rows, slots])
+
+def rollout_batch(setup, rollouts, turns, seed):
+    # play rollouts copies of the game forward for turns turns and count, per player, the rollouts in which they went
+    # bankrupt, were the last player standing, and had the highest net worth at the end
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    players = len(setup['player_ids'])
+    rows = np.arange(rollouts)
+    price = setup['price']
+    house_cost = setup['house_cost']
+
+    cash = np.tile(setup['cash'], (rollouts, 1))
+    position = rng.choice(BOARD_SIZE, size=(rollouts, players), p=setup['start'])
+    jail_turns = np.full((rollouts, players), -1, dtype=np.int64)
+    alive = np.ones((rollouts, players), dtype=bool)
+    owner = np.tile(setup['owner'], (rollouts, 1))
+    mortgaged = np.tile(setup['mortgaged'], (rollouts, 1))
+    houses = np.tile(setup['houses'], (rollouts, 1))
+    hotels = np.tile(setup['hotels'], (rollouts, 1))
+
+    for turn in range(turns):
+        for player in range(players):
+            rolling = alive[:, player].copy()
+            for throw in range(3):
+                moved_to, jail_turns[:, player], moving, speeding, jailed, passed_go, rolling, total = throw_dice(
+                    rng, position[:, player], jail_turns[:, player], rolling, throw, *setup['cards']
+                )
+                position[:, player] = moved_to
+                cash[:, player] += setup['go_value'] * passed_go
+                if setup['double_go']:
+                    cash[:, player] += setup['go_value'] * (moving & (moved_to == GO))
+
+                slot = setup['square_slot'][moved_to]
+                landed = moving & ~jailed & (slot >= 0)
+                landed_rows = rows[landed]
+                landed_slots = slot[landed]
+                property_owner = owner[landed_rows, landed_slots]
+
+                buying = (property_owner == BANK) & (cash[landed_rows, player] >= price[landed_slots])
+                owner[landed_rows[buying], landed_slots[buying]] = player
+                cash[landed_rows[buying], player] -= price[landed_slots[buying]]
+
+                paying = (property_owner != BANK) & (property_owner != player) & ~mortgaged[landed_rows, landed_slots]
+                paying_rows = landed_rows[paying]
+                creditors = property_owner[paying]
+                rent = rent_due(setup, owner, houses, hotels, paying_rows, landed_slots[paying], creditors, total[paying_rows])
+                cash[paying_rows, player] -= rent
+                cash[paying_rows, creditors] += rent
+
+                broke = rows[alive[:, player] & (cash[:, player] < 0)]
+                if len(broke):
+                    owned = owner[broke] == player
+                    liquidation = (owned & ~mortgaged[broke]) * setup['mortgage_value'] + owned * (houses[broke] + 5 * hotels[broke]) * house_cost // 2
+                    bankrupt = broke[cash[broke, player] + liquidation.sum(axis=1) < 0]
+                    alive[bankrupt, player] = False
+                    rolling[bankrupt] = False
+                    # the properties of a bankrupt player go back to the bank, unmortgaged and without buildings
+                    returned = owner[bankrupt] == player
+                    owner[bankrupt] = np.where(returned, BANK, owner[bankrupt])
+                    mortgaged[bankrupt] = mortgaged[bankrupt] & ~returned
+                    houses[bankrupt] = np.where(returned, 0, houses[bankrupt])
+                    hotels[bankrupt] = np.where(returned, 0, hotels[bankrupt])
+
+                if not rolling.any():
+                    break
+
+            if alive[:, player].any():
+                build(setup, owner, mortgaged, houses, hotels, cash, player)
+
+        if (alive.sum(axis=1) <= 1).all():
+            break
+
+    # net worth as GameState values it: cash, property at price (mortgage value when mortgaged) and buildings at cost
+    owned = owner[:, None, :] == np.arange(players)[None, :, None]
+    property_value = np.where(mortgaged, setup['mortgage_value'], price) + (houses + 5 * hotels) * house_cost
+    net_worth = cash + (owned * property_value[:, None, :]).sum(axis=2)
+    leader = np.where(alive, net_worth, np.iinfo(np.int64).min).argmax(axis=1)
+    winners = alive.sum(axis=1) == 1
+
+    return (
+        (~alive).sum(axis=0).tolist(),
+        np.bincount(leader[winners], minlength=players).tolist(),
+        np.bincount(leader, minlength=players).tolist(),
+    )
+
+class Projection:
+    __slots__ = (
+        'game_id', 'sequence', 'player_ids', 'requested', 'turns', 'started', 'time_budget',
+        'rollouts', 'bankrupt', 'wins', 'leading', 'futures', 'cancelled', 'timer', 'lock',
+    )
+
+    def __init__(self, game_id, sequence, player_ids, requested, turns, time_budget):
+        self.game_id = game_id
+        self.sequence = sequence
+        self.player_ids = player_ids
+        self.requested = requested
+        self.turns = turns
+        self.started = time.monotonic()
+        self.time_budget = time_budget
+        self.rollouts = 0
+        self.bankrupt = [0] * len(player_ids)
+        self.wins = [0] * len(player_ids)
+        self.leading = [0] * len(player_ids)
+        self.futures = []
+        self.cancelled = False
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def start(self, executor, setup, batch_size, seed=None):
+        # queue every batch on the pool; each finished batch is added to the estimate by add_batch
+        import numpy as np
+
+        batches = [min(batch_size, self.requested - first) for first in range(0, self.requested, batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(batches))
+        for rollouts, batch_seed in zip(batches, seeds):
+            future = executor.submit(rollout_batch, setup, rollouts, self.turns, batch_seed)
+            future.add_done_callback(lambda future, rollouts=rollouts: self.add_batch(future, rollouts))
+            self.futures.append(future)
+
+        self.timer = threading.Timer(self.time_budget, self.cancel)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def add_batch(self, future, rollouts):
+        # a cancelled or failed batch leaves the estimate as it is
+        if future.cancelled() or future.exception() is not None:
+            return
+        bankrupt, wins, leading = future.result()
+        with self.lock:
+            self.rollouts += rollouts
+            for index in range(len(self.player_ids)):
+                self.bankrupt[index] += bankrupt[index]
+                self.wins[index] += wins[index]
+                self.leading[index] += leading[index]
+        if self.complete() and self.timer is not None:
+            self.timer.cancel()
+
+    def cancel(self):
+        # stop batches that have not started; batches already running still add to the estimate when they finish
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def complete(self):
+        return all(future.done() for future in self.futures)
+
+    def result(self):
+        # the estimate so far: per player the probability of bankruptcy, of winning (last player standing) within
+        # the projected turns, and of leading on net worth at the end
+        with self.lock:
+            players = {}
+            for index, player_id in enumerate(self.player_ids):
+                if self.rollouts:
+                    players[str(player_id)] = {
+                        'bankruptcy': self.bankrupt[index] / self.rollouts,
+                        'win': self.wins[index] / self.rollouts,
+                        'leading': self.leading[index] / self.rollouts,
+                    }
+                else:
+                    players[str(player_id)] = {'bankruptcy': None, 'win': None, 'leading': None}
+            return {
+                'game_id': self.game_id,
+                'sequence': self.sequence,
+                'turns': self.turns,
+                'requested': self.requested,
+                'rollouts': self.rollouts,
+                'complete': self.complete(),
+                'cancelled': self.cancelled,
+                'elapsed': time.monotonic() - self.started,
+                'players': players,
+            }
+
+# the process pool shared by every projection in this worker, and the latest projection of each game,
+# keyed by (database path, game_id)
+_executor = None
+_projections = {}
+_projections_lock = threading.Lock()
+
+def get_executor(workers=None):
+    # started from the turn end pipeline while the writer thread holds its connection, so never by forking this process
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=process_context())
+    return _executor
+
+def start_projection(db, game_id, current_player_id=None, rollouts=ROLLOUTS, turns=TURNS, time_budget=TIME_BUDGET, batch_size=BATCH_SIZE, workers=None, seed=None, database=None, config=None):
+    # fork the game as it is in the database and start projecting it, cancelling any earlier projection of the game.
+    # Flush the game state first so the database is current.
+    setup = fork_game(db, game_id, current_player_id, database, config)
+    sequence = db.execute(
+        "SELECT IFNULL(MAX(sequence), 0) FROM transactions WHERE game_id = ?",
+        (game_id,)
+    ).fetchone()[0]
+
+    projection = Projection(game_id, sequence, setup['player_ids'], rollouts, turns, time_budget)
+    with _projections_lock:
+        previous = _projections.get((database, game_id))
+        if previous is not None:
+            previous.cancel()
+        projection.start(get_executor(workers), setup, batch_size, seed)
+        _projections[(database, game_id)] = projection
+    return projection
+
+def get_projection(game_id, database=None):
+    with _projections_lock:
+        return _projections.get((database, game_id))
+
+def cancel_projection(game_id, database=None):
+    with _projections_lock:
+        projection = _projections.pop((database, game_id), None)
+    if projection is not None:
+        projection.cancel()
+    return projection
+
+@atexit.register
+def shutdown_projections():
+    with _projections_lock:
+        for projection in _projections.values():
+            projection.cancel()
+        _projections.clear()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,83 @@
+import threading
+
+# this module compiles the rent columns of the property table into one dense lookup table per game version.
+# A property's rent is then rents[property_id][level], where level encodes its ownership state (see rent_level),
+# multiplied by the dice roll for utilities. Tables are shared by every game that uses the same version.
+
+STREET = 0
+STATION = 1
+UTILITY = 2
+
+PROPERTY_KINDS = {'Street': STREET, 'Station': STATION, 'Utility': UTILITY}
+
+# levels 0-6 per kind, in the column order used to build each row of the table
+RENT_COLUMNS = {
+    STREET: ['rent_basic', 'rent_monopoly', 'rent_one_house', 'rent_two_houses', 'rent_three_houses', 'rent_four_houses', 'rent_hotel'],
+    STATION: ['rent_basic', 'rent_two_owned', 'rent_three_owned', 'rent_four_owned'],
+    UTILITY: ['rent_multiplier_one_owned', 'rent_multiplier_two_owned'],
+}
+
+LEVELS = 7
+
+MONOPOLY_LEVEL = 1
+HOTEL_LEVEL = 6
+
+class RentTable:
+    __slots__ = ('game_version_id', 'kinds', 'rents')
+
+    def __init__(self, game_version_id):
+        self.game_version_id = game_version_id
+        self.kinds = {}
+        self.rents = {}
+
+    @classmethod
+    def compile(cls, db, game_version_id):
+        # build the table from the property rows of one game version
+        table = cls(game_version_id)
+        for prop in db.execute(
+            "SELECT * FROM property WHERE game_version_id = ?",
+            (game_version_id,)
+        ):
+            kind = PROPERTY_KINDS.get(prop['property_type'], STREET)
+            row = [None] * LEVELS
+            for level, column in enumerate(RENT_COLUMNS[kind]):
+                row[level] = prop[column]
+            table.kinds[prop['property_id']] = kind
+            table.rents[prop['property_id']] = tuple(row)
+        return table
+
+    def rent_level(self, property_id, houses, hotels, monopoly, number_owned):
+        # map the ownership state of an owned, unmortgaged property onto its column in the table
+        if hotels == 1:
+            return HOTEL_LEVEL
+        if houses > 0:
+            return MONOPOLY_LEVEL + houses
+        if self.kinds[property_id] == STREET:
+            return MONOPOLY_LEVEL if monopoly else 0
+        return max(number_owned - 1, 0)
+
+    def rent(self, property_id, level, dice_roll=None):
+        # rent due at a given level. Utilities multiply by the dice roll and raise TypeError when it is missing.
+        rent_due = self.rents[property_id][level]
+        if self.kinds[property_id] == UTILITY:
+            rent_due = rent_due * dice_roll
+        return rent_due
+
+# compiled tables for this worker, keyed by (database path, game_version_id)
+_rent_tables = {}
+_rent_tables_lock = threading.Lock()
+
+def get_rent_table(db, game_version_id, database=None):
+    # return the compiled rent table for a game version, compiling it on first use
+    with _rent_tables_lock:
+        table = _rent_tables.get((database, game_version_id))
+        if table is None:
+            table = RentTable.compile(db, game_version_id)
+            _rent_tables[(database, game_version_id)] = table
+    return table
+
+def invalidate_rent_table(game_version_id, database=None):
+    # drop a compiled table so it is rebuilt from the property table on next use
+    with _rent_tables_lock:
+        _rent_tables.pop((database, game_version_id), None)
+    return
@@ -0,0 +1,60 @@
+import json
+from monopoly_companion.game_state import TRANSACTION_COLUMNS, GameState
+
+# this module rebuilds the state of a game at any point in its history. The nearest state_checkpoint at or before
+# the target is restored and only the journal events after it are replayed, so the cost of a seek is bounded by
+# the checkpoint interval rather than the length of the game.
+
+def target_sequence(db, game_id, turn=None, sequence=None):
+    # the last journaled event at or before the requested turn or sequence (the latest event if neither is given)
+    if sequence is not None:
+        row = db.execute(
+            "SELECT MAX(sequence) FROM transactions WHERE game_id = ? AND sequence <= ?",
+            (game_id, sequence)
+        ).fetchone()
+    elif turn is not None:
+        row = db.execute(
+            "SELECT MAX(sequence) FROM transactions WHERE game_id = ? AND turn <= ?",
+            (game_id, turn)
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT MAX(sequence) FROM transactions WHERE game_id = ?",
+            (game_id,)
+        ).fetchone()
+    return row[0] or 0
+
+def seek(db, game_id, turn=None, sequence=None):
+    # return a detached GameState holding the game as it was after the target event
+    target = target_sequence(db, game_id, turn, sequence)
+
+    checkpoint = db.execute(
+        """
+        SELECT sequence, state
+        FROM state_checkpoint
+        WHERE game_id = ? AND sequence <= ?
+        ORDER BY sequence DESC
+        LIMIT 1
+        """,
+        (game_id, target)
+    ).fetchone()
+
+    if checkpoint is None:
+        raise ValueError("No checkpoint at or before event " + str(target) + " of game " + str(game_id))
+
+    state = GameState.load(db, game_id, journal=False)
+    state.restore(json.loads(checkpoint['state']))
+
+    for row in db.execute(
+        """
+        SELECT *
+        FROM transactions
+        WHERE game_id = ? AND sequence > ? AND sequence <= ?
+        ORDER BY sequence
+        """,
+        (game_id, checkpoint['sequence'], target)
+    ):
+        state.apply_event({column: row[column] for column in TRANSACTION_COLUMNS})
+    state.next_sequence = target + 1
+
+    return state
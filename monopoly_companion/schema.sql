@@ -1,8 +1,19 @@
+DROP TABLE IF EXISTS game_version;
+DROP TABLE IF EXISTS property;
+DROP TABLE IF EXISTS action_type;
+DROP TABLE IF EXISTS game;
 DROP TABLE IF EXISTS players;
 DROP TABLE IF EXISTS special_counter;
 DROP TABLE IF EXISTS property_ownership;
+DROP TABLE IF EXISTS city_ownership;
 DROP TABLE IF EXISTS net_worth;
+DROP TABLE IF EXISTS net_worth_log;
 DROP TABLE IF EXISTS transactions;
+DROP TABLE IF EXISTS state_checkpoint;
+DROP TABLE IF EXISTS landing_probability;
+DROP TABLE IF EXISTS player_turn_rollup;
+DROP TABLE IF EXISTS property_turn_rollup;
+DROP TABLE IF EXISTS game_session;
 
 CREATE TABLE "game_version" (
   "game_version_id" INTEGER PRIMARY KEY,
@@ -10,7 +21,9 @@ CREATE TABLE "game_version" (
   "game_version_language" VARCHAR NOT NULL,
   "total_cash" INTEGER NOT NULL,
   "starting_cash_balance" INTEGER NOT NULL,
-  "go_value" INTEGER NOT NULL
+  "go_value" INTEGER NOT NULL,
+  /* bumped each time versions.py loads a changed board, so workers know their cached rent tables and templates are stale */
+  "revision" INTEGER NOT NULL DEFAULT 0
 );  
 
 CREATE TABLE "property" (
@@ -20,6 +33,7 @@ CREATE TABLE "property" (
   "property_type" VARCHAR NOT NULL,
   "city" VARCHAR NOT NULL,
   "board_side" INTEGER NOT NULL,
+  "board_position" INTEGER,
   "color" VARCHAR,
   "house_cost" INTEGER,
   "price" INTEGER NOT NULL,
@@ -46,15 +60,28 @@ CREATE TABLE "action_type" (
   "exchange_type" VARCHAR 
 );
 
+CREATE TABLE "game" (
+  "game_id" INTEGER PRIMARY KEY,
+  "game_time" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  "game_version_id" INTEGER NOT NULL,
+  "no_of_players" INTEGER NOT NULL,
+  "double_go" boolean NOT NULL,
+  FOREIGN KEY ("game_version_id") REFERENCES "game_version" ("game_version_id")
+);
+
+/* Bank and Free Parking are shared by all games and have a NULL game_id */
 CREATE TABLE "players" (
   "player_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER,
   "player_name" VARCHAR NOT NULL,
   "player_piece" VARCHAR,
-  "player_order" INTEGER
+  "player_order" INTEGER,
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id")
 );
 
 CREATE TABLE "special_counter" (
   "special_counter_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER NOT NULL,
   "counter_time" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   "turn" INTEGER NOT NULL,
   "player_id" INTEGER NOT NULL,
@@ -65,24 +92,39 @@ CREATE TABLE "special_counter" (
   "land_on_start_counter" INTEGER,
   "chance_counter" INTEGER,
   "community_chest_counter" INTEGER,
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
   FOREIGN KEY ("player_id") REFERENCES "players" ("player_id")
 );
 
 CREATE TABLE "property_ownership" (
-  "property_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER NOT NULL,
+  "property_id" INTEGER NOT NULL,
   "owner_player_id" INTEGER NOT NULL,
   "mortgaged" boolean NOT NULL,
   "houses" INTEGER NOT NULL,
   "hotels" INTEGER NOT NULL,
+  PRIMARY KEY ("game_id", "property_id"),
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
+  FOREIGN KEY ("property_id") REFERENCES "property" ("property_id"),
+  FOREIGN KEY ("owner_player_id") REFERENCES "players" ("player_id")
+);
+
+/* ownership index: how many properties of each city an owner holds. A change of owner updates two rows. */
+CREATE TABLE "city_ownership" (
+  "game_id" INTEGER NOT NULL,
+  "city" VARCHAR NOT NULL,
+  "owner_player_id" INTEGER NOT NULL,
   "number_owned" INTEGER NOT NULL,
   "max_number_owned" INTEGER NOT NULL,
   "monopoly" boolean AS (CASE WHEN "number_owned" = "max_number_owned" THEN TRUE ELSE FALSE END) STORED,
-  FOREIGN KEY ("property_id") REFERENCES "property" ("property_id"),
+  PRIMARY KEY ("game_id", "city", "owner_player_id"),
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
   FOREIGN KEY ("owner_player_id") REFERENCES "players" ("player_id")
 );
 
 CREATE TABLE "net_worth" (
   "net_worth_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER NOT NULL,
   "net_worth_time" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   "turn" INTEGER NOT NULL,
   "player_id" INTEGER NOT NULL,
@@ -91,11 +133,13 @@ CREATE TABLE "net_worth" (
   "improvement_value" INTEGER NOT NULL,
   "gross_property_value" INTEGER NOT NULL,
   "net_worth" INTEGER AS ("cash_balance" + "net_property_value" + "improvement_value") STORED,
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
   FOREIGN KEY ("player_id") REFERENCES "players" ("player_id")  
 );
 
 CREATE TABLE "net_worth_log" (
   "net_worth_log_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER NOT NULL,
   "net_worth_time" TIMESTAMP NOT NULL,
   "turn" INTEGER NOT NULL,
   "player_id" INTEGER NOT NULL,
@@ -104,11 +148,20 @@ CREATE TABLE "net_worth_log" (
   "improvement_value" INTEGER NOT NULL,
   "gross_property_value" INTEGER NOT NULL,
   "net_worth" INTEGER NOT NULL,
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
   FOREIGN KEY ("player_id") REFERENCES "players" ("player_id")  
 );
 
+/*
+transactions is an append-only journal of game events. Cash moves from counterparty to party (cash_received) or from party
+to counterparty (cash_paid); the property moves to the party (asset_value_received) or to the counterparty (asset_value_paid);
+counter_name is the special_counter column the event increments. An undo appends the inverse event, with the received and paid
+fields swapped and reverses_sequence pointing at the undone event.
+*/
 CREATE TABLE "transactions" (
   "transaction_id" INTEGER PRIMARY KEY,
+  "game_id" INTEGER NOT NULL,
+  "sequence" INTEGER NOT NULL,
   "transaction_time" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   "turn" INTEGER NOT NULL,
   "party_player_id" INTEGER NOT NULL,
@@ -119,12 +172,99 @@ CREATE TABLE "transactions" (
   "cash_paid" INTEGER,
   "asset_value_received" INTEGER,
   "asset_value_paid" INTEGER,
+  "counter_name" VARCHAR,
+  "reverses_sequence" INTEGER,
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
   FOREIGN KEY ("property_id") REFERENCES "property" ("property_id"),
   FOREIGN KEY ("action_type_id") REFERENCES "action_type" ("action_type_id"),
   FOREIGN KEY ("party_player_id") REFERENCES "players" ("player_id"),
   FOREIGN KEY ("counterparty_player_id") REFERENCES "players" ("player_id")
 );
 
+/* full game state (JSON from GameState.snapshot) after the event with this sequence number, used to seek without replaying the whole journal */
+CREATE TABLE "state_checkpoint" (
+  "game_id" INTEGER NOT NULL,
+  "sequence" INTEGER NOT NULL,
+  "turn" INTEGER NOT NULL,
+  "checkpoint_time" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  "state" TEXT NOT NULL,
+  PRIMARY KEY ("game_id", "sequence"),
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id")
+);
+
+/* stationary landing probabilities of every square of a game version, solved once per board layout (positions and card decks) */
+CREATE TABLE "landing_probability" (
+  "game_version_id" INTEGER NOT NULL,
+  "layout" VARCHAR NOT NULL,
+  "board_position" INTEGER NOT NULL,
+  "probability_per_roll" REAL NOT NULL,
+  "probability_per_turn" REAL NOT NULL,
+  "mean_dice_roll" REAL,
+  PRIMARY KEY ("game_version_id", "layout", "board_position"),
+  FOREIGN KEY ("game_version_id") REFERENCES "game_version" ("game_version_id")
+);
+
+/* per-turn statistics kept up to date as events are journaled and net worth is logged, so charts read a range of the primary key.
+   Event columns add up the journal (undo events subtract), the balance columns hold the values logged at the end of the turn.
+   Both tables can be regenerated from transactions and net_worth_log with the rebuild-rollups command. */
+CREATE TABLE "player_turn_rollup" (
+  "game_id" INTEGER NOT NULL,
+  "player_id" INTEGER NOT NULL,
+  "turn" INTEGER NOT NULL,
+  "events" INTEGER NOT NULL DEFAULT 0,
+  "cash_received" INTEGER NOT NULL DEFAULT 0,
+  "cash_paid" INTEGER NOT NULL DEFAULT 0,
+  "rent_received" INTEGER NOT NULL DEFAULT 0,
+  "rent_paid" INTEGER NOT NULL DEFAULT 0,
+  "go_income" INTEGER NOT NULL DEFAULT 0,
+  "chance_income" INTEGER NOT NULL DEFAULT 0,
+  "community_chest_income" INTEGER NOT NULL DEFAULT 0,
+  "tax_paid" INTEGER NOT NULL DEFAULT 0,
+  "properties_bought" INTEGER NOT NULL DEFAULT 0,
+  "jail_count" INTEGER NOT NULL DEFAULT 0,
+  "cash_balance" INTEGER,
+  "net_property_value" INTEGER,
+  "improvement_value" INTEGER,
+  "gross_property_value" INTEGER,
+  "net_worth" INTEGER,
+  PRIMARY KEY ("game_id", "player_id", "turn"),
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
+  FOREIGN KEY ("player_id") REFERENCES "players" ("player_id")
+) WITHOUT ROWID;
+
+CREATE TABLE "property_turn_rollup" (
+  "game_id" INTEGER NOT NULL,
+  "property_id" INTEGER NOT NULL,
+  "turn" INTEGER NOT NULL,
+  "landings" INTEGER NOT NULL DEFAULT 0,
+  "rent_income" INTEGER NOT NULL DEFAULT 0,
+  "ownership_changes" INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY ("game_id", "property_id", "turn"),
+  FOREIGN KEY ("game_id") REFERENCES "game" ("game_id"),
+  FOREIGN KEY ("property_id") REFERENCES "property" ("property_id")
+) WITHOUT ROWID;
+
+/* server-side session data (JSON) of each browser, which only keeps the signed token and revision in its cookie */
+CREATE TABLE "game_session" (
+  "token" VARCHAR NOT NULL PRIMARY KEY,
+  "revision" INTEGER NOT NULL,
+  "updated_time" REAL NOT NULL,
+  "data" TEXT NOT NULL
+);
+CREATE INDEX "game_session_updated_time" ON "game_session" ("updated_time");
+
+/* custom boards are loaded by name (versions.py), and a version's properties by name within the version */
+CREATE UNIQUE INDEX "game_version_name" ON "game_version" ("game_version_name");
+CREATE UNIQUE INDEX "property_version_name" ON "property" ("game_version_id", "property_name");
+
+/* every game-scoped table is indexed on game_id so creating or deleting a game only touches that game's rows */
+CREATE INDEX "players_game_id" ON "players" ("game_id");
+CREATE UNIQUE INDEX "special_counter_game_player" ON "special_counter" ("game_id", "player_id");
+CREATE UNIQUE INDEX "net_worth_game_player" ON "net_worth" ("game_id", "player_id");
+CREATE INDEX "net_worth_log_game_player" ON "net_worth_log" ("game_id", "player_id", "net_worth_log_id");
+CREATE UNIQUE INDEX "transactions_game_sequence" ON "transactions" ("game_id", "sequence");
+CREATE INDEX "transactions_game_reverses" ON "transactions" ("game_id", "reverses_sequence");
+
 /*
 These foreign keys should be reversed
 ALTER TABLE "property" ADD FOREIGN KEY ("game_version_id") REFERENCES "game_version" ("game_version_id");
@@ -0,0 +1,137 @@
+import json
+import queue
+import threading
+
+# this module pushes the live scoreboard of each game to spectator screens as Server-Sent Events. After every action
+# gameplay calls publish_scoreboard, which compares the scoreboard with the one last published for the game and
+# formats a single message holding only the fields that changed (cash, net worth, property owners, current player,
+# turn). That one message is handed to every subscriber of the game, so any number of screens costs one broadcast.
+# The Broadcaster below fans out within this worker only; a deployment with several workers would replace it with
+# one backed by a shared pub/sub channel.
+
+# seconds between keep-alive comments on an idle stream
+KEEPALIVE = 15.0
+
+# messages a subscriber may fall behind by before it is disconnected
+SUBSCRIBER_QUEUE_SIZE = 100
+
+class Subscriber:
+    __slots__ = ('messages', 'closed')
+
+    def __init__(self):
+        self.messages = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+
+class Channel:
+    __slots__ = ('scoreboard', 'message_id', 'subscribers')
+
+    def __init__(self):
+        self.scoreboard = None
+        self.message_id = 0
+        self.subscribers = []
+
+class Broadcaster:
+    # in-process fan-out of scoreboard messages, keyed by (database path, game_id)
+    __slots__ = ('channels', 'lock')
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, key):
+        # a new subscriber, which first receives the full current scoreboard (if any has been published)
+        subscriber = Subscriber()
+        with self.lock:
+            channel = self.channels.setdefault(key, Channel())
+            if channel.scoreboard is not None:
+                subscriber.messages.put(format_message(channel.message_id, 'scoreboard', channel.scoreboard))
+            channel.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, key, subscriber):
+        subscriber.closed = True
+        with self.lock:
+            channel = self.channels.get(key)
+            if channel is not None and subscriber in channel.subscribers:
+                channel.subscribers.remove(subscriber)
+
+    def publish(self, key, scoreboard):
+        # send the difference with the last published scoreboard to every subscriber. Returns the delta, or None if nothing changed.
+        with self.lock:
+            channel = self.channels.setdefault(key, Channel())
+            changes = delta(channel.scoreboard, scoreboard)
+            if not changes:
+                return None
+            channel.scoreboard = scoreboard
+            channel.message_id += 1
+            message = format_message(channel.message_id, 'delta', changes)
+            for subscriber in list(channel.subscribers):
+                try:
+                    subscriber.messages.put_nowait(message)
+                except queue.Full:
+                    subscriber.closed = True
+                    channel.subscribers.remove(subscriber)
+        return changes
+
+    def close(self, key):
+        # disconnect every subscriber of a game and forget its scoreboard
+        with self.lock:
+            channel = self.channels.pop(key, None)
+        if channel is not None:
+            for subscriber in channel.subscribers:
+                subscriber.closed = True
+
+def format_message(message_id, event, data):
+    return "id: " + str(message_id) + "\nevent: " + event + "\ndata: " + json.dumps(data, separators=(',', ':')) + "\n\n"
+
+def scoreboard(state, current_player_id, turn):
+    # the fields shown on a spectator screen, from a GameState
+    with state.lock:
+        return {
+            'turn': turn,
+            'current_player_id': int(current_player_id),
+            'players': {
+                str(player_id): {'cash': state.cash[slot], 'net_worth': state.net_worth(slot)}
+                for slot, player_id in enumerate(state.player_ids)
+            },
+            'owners': {str(property_id): state.owner[slot] for slot, property_id in enumerate(state.property_ids)},
+        }
+
+def delta(previous, current):
+    # the fields of current that differ from previous, nested the same way (everything if there is no previous)
+    if previous is None:
+        return current
+    changes = {}
+    for field, value in current.items():
+        if isinstance(value, dict):
+            changed = {}
+            for name, item in value.items():
+                if previous[field].get(name) == item:
+                    continue
+                if isinstance(item, dict) and name in previous[field]:
+                    changed[name] = {key: item[key] for key in item if previous[field][name].get(key) != item[key]}
+                else:
+                    changed[name] = item
+            if changed:
+                changes[field] = changed
+        elif previous.get(field) != value:
+            changes[field] = value
+    return changes
+
+broadcaster = Broadcaster()
+
+def publish_scoreboard(state, current_player_id, turn, database=None):
+    return broadcaster.publish((database, state.game_id), scoreboard(state, current_player_id, turn))
+
+def stream(game_id, database=None, keepalive=KEEPALIVE):
+    # generator of the Server-Sent Events of one game for a single client
+    key = (database, game_id)
+    subscriber = broadcaster.subscribe(key)
+    try:
+        while not subscriber.closed:
+            try:
+                yield subscriber.messages.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+    finally:
+        broadcaster.unsubscribe(key, subscriber)
@@ -0,0 +1,208 @@
+import copy
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+from monopoly_companion.db import get_pool
+from monopoly_companion.writer import write
+
+# this module keeps the session data of each browser on the server. Flask's default session signs and serializes the
+# whole session into the cookie on every response, and the browser uploads it again with every request. Here the
+# cookie only holds a signed token and revision. The data only identifies the game, the current player and the turn
+# (pages read everything else from the game state), lives in an in-process LRU and in the game_session table, and is
+# only serialized when a request changed it. A request whose revision matches the LRU entry is served without
+# touching the database; any other worker (or a restarted one) reads the row once.
+
+# sessions kept in memory per worker
+SESSION_CACHE_SIZE = 1024
+
+class GameSession(CallbackDict, SessionMixin):
+    # a session whose modified flag is set by any top-level assignment, like Flask's SecureCookieSession
+    def __init__(self, initial=None, token=None, revision=0):
+        def on_update(session):
+            session.modified = True
+            session.accessed = True
+
+        super().__init__(initial, on_update)
+        self.token = token
+        self.revision = revision
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+class SessionCache:
+    # least recently used session data by token, with the revision it was saved at
+    __slots__ = ('entries', 'size', 'lock')
+
+    def __init__(self, size=SESSION_CACHE_SIZE):
+        self.entries = OrderedDict()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def get(self, token, revision):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[0] != revision:
+                return None
+            self.entries.move_to_end(token)
+            return entry[1]
+
+    def put(self, token, revision, data):
+        with self.lock:
+            self.entries[token] = (revision, data)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, token):
+        with self.lock:
+            self.entries.pop(token, None)
+
+class GameSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+    salt = 'game-session'
+
+    def __init__(self, cache_size=SESSION_CACHE_SIZE):
+        self.caches = {}
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def get_cache(self, app):
+        # one cache per database file, like the connection pools
+        with self.lock:
+            cache = self.caches.get(app.config['DATABASE'])
+            if cache is None:
+                cache = self.caches[app.config['DATABASE']] = SessionCache(self.cache_size)
+        return cache
+
+    def get_signer(self, app):
+        if not app.secret_key:
+            return None
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        signer = self.get_signer(app)
+        if signer is None:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return GameSession()
+        try:
+            token, revision = signer.unsign(cookie).decode().split('.')
+            revision = int(revision)
+        except (BadSignature, ValueError):
+            return GameSession()
+
+        # deep-copy the cached data, so neither a request that fails part way nor an in-place change to a nested value
+        # (which does not mark the session modified, and so is never saved) can make the cache and the row disagree
+        data = self.get_cache(app).get(token, revision)
+        if data is not None:
+            return GameSession(copy.deepcopy(data), token, revision)
+
+        data = load_session(app, token, time.time() - app.permanent_session_lifetime.total_seconds())
+        if data is None:
+            return GameSession()
+        revision, data = data[0], self.serializer.loads(data[1])
+        self.get_cache(app).put(token, revision, data)
+        return GameSession(copy.deepcopy(data), token, revision)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # an emptied session forgets its row and cookie
+        if not session:
+            if session.modified and session.token is not None:
+                self.get_cache(app).pop(session.token)
+                delete_session(app, session.token)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+
+        if not session.modified:
+            return
+
+        # cache the data as it reads back from JSON (string keys, copied values), exactly like the next request would load it.
+        # A session that was changed and changed back, like a message flashed and shown in the same response, is not saved.
+        data = self.serializer.dumps(dict(session))
+        loaded = self.serializer.loads(data)
+        if session.token is not None and self.get_cache(app).get(session.token, session.revision) == loaded:
+            return
+
+        if session.token is None:
+            session.token = secrets.token_urlsafe(16)
+        session.revision += 1
+        save_session(app, session.token, session.revision, data, time.time() - app.permanent_session_lifetime.total_seconds())
+        self.get_cache(app).put(session.token, session.revision, loaded)
+
+        cookie = self.get_signer(app).sign(session.token + '.' + str(session.revision)).decode()
+        response.set_cookie(
+            name,
+            cookie,
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
+
+def load_session(app, token, expired_before):
+    # (revision, serialized data) of a session that has not expired, or None
+    pool = get_pool(app.config)
+    db = pool.acquire()
+    try:
+        row = db.execute(
+            "SELECT revision, data FROM game_session WHERE token = ? AND updated_time > ?",
+            (token, expired_before)
+        ).fetchone()
+    finally:
+        pool.release(db)
+    return None if row is None else (row['revision'], row['data'])
+
+def save_session(app, token, revision, data, expired_before):
+    # upsert the session through the database writer, so the request's open transaction is left alone, and clear out
+    # sessions that have not been used for the session lifetime
+    updated_time = time.time()
+
+    def upsert(db):
+        if revision == 1:
+            db.execute("DELETE FROM game_session WHERE updated_time <= ?", (expired_before,))
+        db.execute(
+            """
+            INSERT INTO game_session (token, revision, updated_time, data) VALUES (?, ?, ?, ?)
+            ON CONFLICT (token) DO UPDATE SET revision = excluded.revision, updated_time = excluded.updated_time, data = excluded.data
+            """,
+            (token, revision, updated_time, data)
+        )
+
+    write(app.config, upsert)
+    return
+
+def delete_session(app, token):
+    write(app.config, lambda db: db.execute("DELETE FROM game_session WHERE token = ?", (token,)))
+    return
+
+def init_app(app):
+    app.session_interface = GameSessionInterface(app.config.get('SESSION_CACHE_SIZE', SESSION_CACHE_SIZE))
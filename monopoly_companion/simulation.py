@@ -0,0 +1,269 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+import click
+from monopoly_companion.board import BOARD_SIZE, GO, GO_TO_JAIL, JAIL, JAIL_TURNS, Board
+from monopoly_companion.db import get_db
+from monopoly_companion.rent import RENT_COLUMNS, STREET, UTILITY, get_rent_table
+
+# this module estimates what each property of a game version earns by playing synthetic games on its board.
+# Every simulated game moves one token for a number of turns with the real movement rules (doubles, three doubles
+# to jail, up to three turns in jail, go to jail, chance and community chest movement cards). All games advance together
+# as NumPy arrays, one dice throw at a time, and batches of games run in a process pool. Landing counts are then priced
+# with the compiled rent table of the version, the same rules GameState.rent uses.
+# numpy is an optional dependency and only imported when a simulation runs.
+
+GAMES = 10000
+TURNS = 100
+PLAYERS = 4
+SEED = 1
+
+NO_MOVE = -1
+
+def card_arrays(board):
+    # the card table of a board as (BOARD_SIZE, cards) arrays of destinations (NO_MOVE to stay) and passes-go flags
+    import numpy as np
+
+    table = board.card_table()
+    cards = max(len(square) for square in table)
+    destinations = np.full((BOARD_SIZE, cards), NO_MOVE, dtype=np.int64)
+    passes_go = np.zeros((BOARD_SIZE, cards), dtype=bool)
+    for square, deck in enumerate(table):
+        for card, (destination, passes) in enumerate(deck):
+            destinations[square, card] = NO_MOVE if destination is None else destination
+            passes_go[square, card] = passes
+    has_cards = np.array([len(deck) > 0 for deck in table])
+    deck_sizes = np.array([max(len(deck), 1) for deck in table])
+    return destinations, passes_go, has_cards, deck_sizes
+
+def throw_dice(rng, position, jail_turns, rolling, throw, destinations, passes_go, has_cards, deck_sizes):
+    # one dice throw for every token still rolling this turn (throw is 0, 1 or 2). Returns the new position and
+    # jail_turns arrays (-1 when not in jail, otherwise the turns spent in jail so far), the masks of tokens that
+    # moved, were sent to jail for a third double, passed GO and still roll again, and the dice totals.
+    import numpy as np
+
+    dice = rng.integers(1, 7, size=(2, len(position)))
+    total = dice[0] + dice[1]
+    doubles = dice[0] == dice[1]
+
+    in_jail = rolling & (jail_turns >= 0)
+    jail_turns = jail_turns + in_jail
+    released = in_jail & (doubles | (jail_turns >= JAIL_TURNS))
+    speeding = rolling & ~in_jail & doubles & (throw == 2)
+    moving = (rolling & ~in_jail & ~speeding) | released
+
+    start = position
+    position = np.where(moving, (position + total) % BOARD_SIZE, position)
+    passed_go = moving & (position < start)
+
+    # a card can move the player onto another card square (back three spaces), so draw at most twice
+    drawing = moving
+    for draw in range(2):
+        drawing = drawing & has_cards[position]
+        card = rng.integers(0, deck_sizes[position])
+        destination = destinations[position, card]
+        moved = drawing & (destination != NO_MOVE)
+        passed_go |= moved & passes_go[position, card]
+        position = np.where(moved, destination, position)
+        drawing = moved
+
+    jailed = speeding | (moving & (position == GO_TO_JAIL))
+    position = np.where(jailed, JAIL, position)
+    jail_turns = np.where(jailed, 0, np.where(released, -1, jail_turns))
+
+    rolling = moving & doubles & ~released & ~jailed
+    return position, jail_turns, moving, speeding, jailed, passed_go, rolling, total
+
+def simulate_games(destinations, passes_go, has_cards, deck_sizes, games, turns, seed):
+    # play games tokens for turns turns each and return the landings and the summed dice totals per square,
+    # and how often GO was passed and landed on. Cards are drawn at random with replacement.
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    position = np.zeros(games, dtype=np.int64)
+    jail_turns = np.full(games, -1, dtype=np.int64)
+    landings = np.zeros(BOARD_SIZE, dtype=np.int64)
+    dice_totals = np.zeros(BOARD_SIZE, dtype=np.float64)
+    go_passes = 0
+    go_landings = 0
+
+    for turn in range(turns):
+        rolling = np.ones(games, dtype=bool)
+        for throw in range(3):
+            position, jail_turns, moving, speeding, jailed, passed_go, rolling, total = throw_dice(
+                rng, position, jail_turns, rolling, throw, destinations, passes_go, has_cards, deck_sizes
+            )
+
+            resting = moving | speeding
+            landings += np.bincount(position[resting], minlength=BOARD_SIZE)
+            dice_totals += np.bincount(position[resting], weights=total[resting], minlength=BOARD_SIZE)
+            go_passes += int(np.count_nonzero(passed_go))
+            go_landings += int(np.count_nonzero(moving & (position == GO)))
+
+            if not rolling.any():
+                break
+
+    return landings, dice_totals, go_passes, go_landings
+
+def process_context():
+    # worker processes come from a fork server (or are spawned where there is none) rather than being forked from this
+    # process, whose writer, turn end and event stream threads may hold locks that a forked child would inherit held
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+def run_simulation(board, games, turns, seed, workers=None):
+    # split the games over a process pool and add up the counts of every batch
+    import numpy as np
+
+    workers = max(1, min(workers or os.cpu_count() or 1, games))
+    arrays = card_arrays(board)
+    batches = [games // workers + (1 if batch < games % workers else 0) for batch in range(workers)]
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+
+    if workers == 1:
+        results = [simulate_games(*arrays, games, turns, seeds[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as executor:
+            results = list(executor.map(simulate_games, *zip(*[arrays + (batch, turns, batch_seed) for batch, batch_seed in zip(batches, seeds)])))
+
+    landings = sum(result[0] for result in results)
+    dice_totals = sum(result[1] for result in results)
+    go_passes = sum(result[2] for result in results)
+    go_landings = sum(result[3] for result in results)
+    return landings, dice_totals, go_passes, go_landings
+
+def property_report(prop, kind, rents, landing_rate, mean_dice, opponents):
+    # investment, rent and return of one property at every rent level
+    levels = []
+    for level, column in enumerate(RENT_COLUMNS[kind]):
+        rent_per_landing = rents[level]
+        if rent_per_landing is None:
+            continue
+        if kind == UTILITY:
+            rent_per_landing = rent_per_landing * mean_dice
+
+        investment = prop['price']
+        if kind == STREET and level > 1:
+            investment += (level - 1) * prop['house_cost']
+
+        expected_rent = landing_rate * rent_per_landing * opponents
+        levels.append({
+            'level': level,
+            'name': column[len('rent_'):],
+            'investment': investment,
+            'rent_per_landing': rent_per_landing,
+            'expected_rent_per_round': expected_rent,
+            'payback_rounds': investment / expected_rent if expected_rent else None,
+            'roi_per_100_rounds': 100 * expected_rent / investment if investment else None,
+        })
+    return levels
+
+def simulate(db, game_version_id, games=GAMES, turns=TURNS, players=PLAYERS, seed=SEED, workers=None, database=None):
+    # landing frequency of every square, and expected rent, payback period and ROI of every property at every
+    # rent level for a game version. A round is one turn of every player, so the owner of a property collects
+    # from players - 1 opponents each round.
+    board = Board.load(db, game_version_id)
+    rent_table = get_rent_table(db, game_version_id, database)
+    go_value = db.execute(
+        "SELECT go_value FROM game_version WHERE game_version_id = ?",
+        (game_version_id,)
+    ).fetchone()['go_value']
+
+    landings, dice_totals, go_passes, go_landings = run_simulation(board, games, turns, seed, workers)
+    player_turns = games * turns
+    opponents = players - 1
+
+    properties = []
+    for prop in db.execute(
+        "SELECT * FROM property WHERE game_version_id = ? ORDER BY board_position",
+        (game_version_id,)
+    ):
+        position = prop['board_position']
+        landing_rate = landings[position] / player_turns
+        mean_dice = dice_totals[position] / landings[position] if landings[position] else 7.0
+        properties.append({
+            'property_id': prop['property_id'],
+            'property_name': prop['property_name'],
+            'property_type': prop['property_type'],
+            'board_position': position,
+            'landing_probability': float(landing_rate),
+            'levels': property_report(prop, rent_table.kinds[prop['property_id']], rent_table.rents[prop['property_id']], float(landing_rate), float(mean_dice), opponents),
+        })
+
+    return {
+        'game_version_id': game_version_id,
+        'games': games,
+        'turns': turns,
+        'players': players,
+        'seed': seed,
+        'landing_probability': [float(count) / player_turns for count in landings],
+        # GO income per player per turn, without and with the double go rule of game_setup
+        'go_income_per_turn': {
+            'standard': go_value * go_passes / player_turns,
+            'double_go': go_value * (go_passes + go_landings) / player_turns,
+        },
+        'properties': properties,
+    }
+
+# simulations for this worker as Futures, finished or running, keyed by (database path, game_version_id, games, turns, players, seed).
+# The lock only guards the registry: a simulation runs outside it, and callers asking for one that is running wait for its Future.
+_simulations = {}
+_simulations_lock = threading.Lock()
+
+def get_simulation(db, game_version_id, games=GAMES, turns=TURNS, players=PLAYERS, seed=SEED, workers=None, database=None):
+    # return the simulation of a game version, running it on first use
+    key = (database, game_version_id, games, turns, players, seed)
+    with _simulations_lock:
+        future = _simulations.get(key)
+        running = future is None
+        if running:
+            future = Future()
+            _simulations[key] = future
+
+    if running:
+        try:
+            future.set_result(simulate(db, game_version_id, games, turns, players, seed, workers, database))
+        except BaseException as error:
+            # not cached, so the next caller tries again
+            with _simulations_lock:
+                if _simulations.get(key) is future:
+                    del _simulations[key]
+            future.set_exception(error)
+    return future.result()
+
+def invalidate_simulations(game_version_id, database=None):
+    # drop every cached simulation of a game version, e.g. after its properties change. A running one still answers
+    # the callers waiting for it, later callers run a new one.
+    with _simulations_lock:
+        for key in [key for key in _simulations if key[:2] == (database, game_version_id)]:
+            del _simulations[key]
+    return
+
+@click.command('simulate')
+@click.argument('game_version_id', type=int, default=1)
+@click.option('--games', type=int, default=GAMES, help='Number of simulated games.')
+@click.option('--turns', type=int, default=TURNS, help='Turns played in each simulated game.')
+@click.option('--players', type=int, default=PLAYERS, help='Players sharing the board, for rent per round.')
+@click.option('--seed', type=int, default=SEED, help='Random seed.')
+@click.option('--workers', type=int, help='Worker processes (defaults to the number of CPUs).')
+def simulate_command(game_version_id, games, turns, players, seed, workers):
+    """Simulate games of a game version and report the return on each property"""
+    try:
+        result = simulate(get_db(), game_version_id, games, turns, players, seed, workers)
+    except ImportError as error:
+        raise click.ClickException("Simulation needs an optional dependency: " + str(error))
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    click.echo('Simulated ' + str(games * turns) + ' turns of game version ' + str(game_version_id) + ' with ' + str(players) + ' players.')
+    click.echo('GO income per turn: {standard:.2f} (double go {double_go:.2f})'.format(**result['go_income_per_turn']))
+    for prop in result['properties']:
+        click.echo('{} ({}), landed on {:.2%} of turns'.format(prop['property_name'], prop['board_position'], prop['landing_probability']))
+        for level in prop['levels']:
+            click.echo('  {:<16} investment {:>5}  rent {:>7.1f}  per round {:>7.2f}  payback {:>7.1f} rounds'.format(
+                level['name'], level['investment'], level['rent_per_landing'], level['expected_rent_per_round'], level['payback_rounds'] or float('inf')
+            ))
+
+def init_app(app):
+    app.cli.add_command(simulate_command)
@@ -0,0 +1,234 @@
+import json
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+import pytest
+from monopoly_companion import create_app, db as db_module, game_state, markov, projection, rent, simulation, versions
+from monopoly_companion.db import close_pools, get_db, get_pool, init_db
+from monopoly_companion.turn_end import close_turn_end_pipelines, get_turn_end_pipeline
+from monopoly_companion.writer import close_writers
+
+# baseline of the gameplay benchmark, written with --update-baseline
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark-rounds', type=int, default=200, help="rounds of every scripted game")
+    group.addoption('--benchmark-seed', type=int, default=1, help="seed of the scripted games")
+    group.addoption('--benchmark-tolerance', type=float, default=3.0, help="latency may grow to this multiple of the baseline before a test fails")
+    group.addoption('--update-baseline', action='store_true', help="write the measured benchmark to baseline.json instead of comparing with it")
+
+# the module-level registries of a worker, keyed by (database path, ...), with their locks
+REGISTRIES = [
+    (game_state._game_states, game_state._game_states_lock),
+    (db_module._game_templates, db_module._game_templates_lock),
+    (rent._rent_tables, rent._rent_tables_lock),
+    (markov._landing_probabilities, markov._landing_probabilities_lock),
+    (simulation._simulations, simulation._simulations_lock),
+    (projection._projections, projection._projections_lock),
+    (versions._revisions, versions._revisions_lock),
+]
+
+def clear_registries(path):
+    # forget everything cached for a test database, so nothing leaks into the next test or the exit hooks
+    for registry, lock in REGISTRIES:
+        with lock:
+            for key in [key for key in registry if key[0] == path]:
+                del registry[key]
+
+@pytest.fixture
+def app():
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    # no projection worker processes, and no timer-based flushes so every run writes the same statements
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': path,
+        'PROJECTION_ROLLOUTS': 0,
+        'STATE_FLUSH_INTERVAL': float('inf'),
+    })
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+    close_turn_end_pipelines()
+    close_writers()
+    close_pools()
+    clear_registries(path)
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def runner(app):
+    return app.test_cli_runner()
+
+@pytest.fixture
+def game(client):
+    # a two player game of Monopoly NL set up through the blueprints: game 1, with Ann (player 3) and Bob (player 4)
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2', 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+    return 1
+
+class StatementCounter:
+    # every SQL statement run on the app's pooled connections, from sqlite3's trace callback
+    def __init__(self, app):
+        self.statements = []
+        pool = get_pool(app.config)
+        connect = pool.connect
+
+        def traced_connect():
+            db = connect()
+            db.set_trace_callback(self.statements.append)
+            return db
+
+        pool.connect = traced_connect
+        # connections opened before tracing started are not handed out again
+        pool.close()
+
+    def __len__(self):
+        return len(self.statements)
+
+    def clear(self):
+        self.statements.clear()
+
+@pytest.fixture
+def statements(app):
+    return StatementCounter(app)
+
+def percentile(values, percent):
+    # nearest-rank percentile of a list of numbers
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def database_size(app):
+    # bytes of the database pages, including those still in the WAL
+    with app.app_context():
+        db = get_db()
+        return db.execute("PRAGMA page_count").fetchone()[0] * db.execute("PRAGMA page_size").fetchone()[0]
+
+class GameBenchmark:
+    # plays scripted games through the blueprints and records the latency and SQL statements of every request by action.
+    # The latency is the time to the response, the statements include the work the request left to the turn end pipeline.
+    def __init__(self, app, client, statements, seed):
+        self.app = app
+        self.client = client
+        self.statements = statements
+        self.random = random.Random(seed)
+        self.latencies = {}
+        self.counts = {}
+
+    def request(self, action, url, data=None):
+        self.statements.clear()
+        start = time.perf_counter()
+        if data is None:
+            response = self.client.get(url)
+        else:
+            response = self.client.post(url, data=data)
+        self.latencies.setdefault(action, []).append(time.perf_counter() - start)
+        # statements of the turn end pipeline count towards the request that queued them, not the one they overlap
+        get_turn_end_pipeline(self.app.config).join()
+        self.counts.setdefault(action, []).append(len(self.statements))
+        assert response.status_code in (200, 302), (action, response.status_code)
+        return response
+
+    def setup(self, game_version, no_of_players):
+        self.request('welcome', '/welcome/', {})
+        self.request('game_setup_form', '/game-setup/')
+        self.request('create_game', '/game-setup/', {'game_version': game_version, 'no_of_players': str(no_of_players), 'double_go': 'on'})
+        self.request('player_registration', '/game-setup/player_registration/', {'player_' + str(player) + '_name': 'Player ' + str(player) for player in range(1, no_of_players + 1)})
+        with self.client.session_transaction() as session:
+            game_id = session['game_id']
+        with self.app.app_context():
+            state = game_state.get_game_state(get_db(), game_id, self.app.config['DATABASE'])
+            return state.players, list(state.property_by_name)
+
+    def play(self, rounds, game_version='Monopoly NL', no_of_players=4):
+        # each turn a player passes go about one time in six, pays rent about half of the time once properties are
+        # owned, and buys one of the remaining properties one time in five, then hands over to the next player
+        player_dict, property_names = self.setup(game_version, no_of_players)
+        players = sorted(player_dict, key=lambda player_id: player_dict[player_id][1])
+        for_sale = list(property_names)
+        owners = {}
+        start_size = database_size(self.app)
+
+        for _ in range(rounds):
+            for player_id in players:
+                if self.random.random() < 1 / 6:
+                    self.request('pass_go', '/', {'pass_go': 'Pass Go'})
+                rented = [name for name in owners if owners[name] != player_id]
+                if rented and self.random.random() < 0.5:
+                    self.request('rent', '/', {'rent': 'Pay rent', 'property_name': self.random.choice(rented), 'dice_roll': str(self.random.randint(2, 12))})
+                elif for_sale and self.random.random() < 0.2:
+                    name = for_sale.pop(self.random.randrange(len(for_sale)))
+                    owners[name] = player_id
+                    self.request('purchase_property', '/', {'purchase_property': 'Purchase Property', 'property_name': name})
+                self.request('next_player', '/', {'next_player': 'Next player'})
+
+        return database_size(self.app) - start_size
+
+    def report(self, rounds, growth):
+        return {
+            'rounds': rounds,
+            'database_growth_per_round': round(growth / rounds),
+            'actions': {
+                action: {
+                    'requests': len(self.latencies[action]),
+                    'p50_ms': round(statistics.median(self.latencies[action]) * 1000, 3),
+                    'p99_ms': round(percentile(self.latencies[action], 99) * 1000, 3),
+                    'p50_statements': statistics.median(self.counts[action]),
+                    'p99_statements': percentile(self.counts[action], 99),
+                }
+                for action in self.latencies
+            },
+        }
+
+@pytest.fixture
+def game_benchmark(app, client, statements, request):
+    return GameBenchmark(app, client, statements, request.config.getoption('--benchmark-seed'))
+
+@pytest.fixture
+def baseline(request):
+    # the stored benchmark results by test name, and a function to record the results of this run
+    try:
+        with open(BASELINE) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {}
+
+    def record(name, report):
+        request.config.benchmark_reports[name] = report
+        if request.config.getoption('--update-baseline'):
+            stored[name] = report
+            with open(BASELINE, 'w') as f:
+                json.dump(stored, f, indent=2, sort_keys=True)
+                f.write('\n')
+        return None if request.config.getoption('--update-baseline') else stored.get(name)
+
+    return record
+
+def pytest_configure(config):
+    config.benchmark_reports = {}
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not config.benchmark_reports:
+        return
+    terminalreporter.section('gameplay benchmark')
+    for name, report in config.benchmark_reports.items():
+        terminalreporter.write_line(name + ": " + str(report['rounds']) + " rounds, database grows " + str(report['database_growth_per_round']) + " bytes per round")
+        terminalreporter.write_line("  {:<20} {:>8} {:>9} {:>9} {:>9} {:>9}".format('action', 'requests', 'p50 ms', 'p99 ms', 'p50 SQL', 'p99 SQL'))
+        for action, stats in report['actions'].items():
+            terminalreporter.write_line("  {:<20} {:>8} {:>9.2f} {:>9.2f} {:>9g} {:>9g}".format(
+                action, stats['requests'], stats['p50_ms'], stats['p99_ms'], stats['p50_statements'], stats['p99_statements']
+            ))
@@ -0,0 +1,48 @@
+import queue
+import pytest
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import get_game_state
+
+def stored(db, game_id):
+    # every row of the game that an action can change
+    return {
+        table: [tuple(row) for row in db.execute("SELECT * FROM " + table + " WHERE game_id = ? ORDER BY 1", (game_id,))]
+        for table in ['net_worth', 'property_ownership', 'city_ownership', 'special_counter', 'transactions']
+    }
+
+def test_failing_action_applies_nothing(app, client, game):
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        state.commit(app.config)
+        before = (stored(db, game), state.snapshot())
+
+    response = client.post('/api/games/1/actions', json={'player_id': 3, 'turn': 1, 'actions': [{'action': 'go'}, 'oops']})
+    assert response.status_code == 400
+    assert response.get_json()['action'] == 1
+
+    with app.app_context():
+        db = get_db()
+        # nothing of the first action is left to be flushed later either
+        state.commit(app.config)
+        assert (stored(db, game), state.snapshot()) == before
+
+def test_failing_write_applies_nothing(app, client, game, monkeypatch):
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        state.commit(app.config)
+        before = (stored(db, game), state.snapshot())
+
+    def full(config, job):
+        raise queue.Full()
+
+    monkeypatch.setattr('monopoly_companion.game_state.write', full)
+    with pytest.raises(queue.Full):
+        client.post('/api/games/1/actions', json={'player_id': 3, 'turn': 1, 'actions': [{'action': 'go'}, {'action': 'purchase_property', 'property_name': 'Brink'}]})
+    monkeypatch.undo()
+
+    with app.app_context():
+        db = get_db()
+        state.commit(app.config)
+        assert (stored(db, game), state.snapshot()) == before
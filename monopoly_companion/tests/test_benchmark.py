@@ -0,0 +1,39 @@
+import pytest
+
+# scripted games played through the blueprints, compared with baseline.json. SQL statements per request and database
+# growth are deterministic for a seed and may not exceed the baseline; latency may grow to --benchmark-tolerance
+# times the baseline, to allow for slower machines. Run with --update-baseline to accept new numbers.
+
+# slack on the database growth for page allocation
+GROWTH_SLACK = 1.1
+
+# latency is only compared for actions with at least this many requests, single setup requests are too noisy
+MIN_TIMED_REQUESTS = 20
+
+@pytest.mark.parametrize('no_of_players', [4, 8])
+def test_gameplay(game_benchmark, baseline, request, no_of_players):
+    rounds = request.config.getoption('--benchmark-rounds')
+    growth = game_benchmark.play(rounds, no_of_players=no_of_players)
+    report = game_benchmark.report(rounds, growth)
+
+    stored = baseline('gameplay_' + str(no_of_players) + '_players', report)
+    if stored is None:
+        return
+    if stored['rounds'] != rounds:
+        pytest.skip("baseline was recorded with " + str(stored['rounds']) + " rounds")
+
+    tolerance = request.config.getoption('--benchmark-tolerance')
+    failures = []
+    if report['database_growth_per_round'] > stored['database_growth_per_round'] * GROWTH_SLACK:
+        failures.append("database growth per round {} > {}".format(report['database_growth_per_round'], stored['database_growth_per_round']))
+    for action, expected in stored['actions'].items():
+        measured = report['actions'].get(action)
+        if measured is None:
+            continue
+        for statistic in ['p50_statements', 'p99_statements']:
+            if measured[statistic] > expected[statistic]:
+                failures.append("{} {} {} > {}".format(action, statistic, measured[statistic], expected[statistic]))
+        if expected['requests'] >= MIN_TIMED_REQUESTS and measured['p50_ms'] > expected['p50_ms'] * tolerance:
+            failures.append("{} p50 {:.2f} ms > {} x {:.2f} ms".format(action, measured['p50_ms'], tolerance, expected['p50_ms']))
+
+    assert not failures, "slower than the baseline:\n" + "\n".join(failures)
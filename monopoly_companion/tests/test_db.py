@@ -0,0 +1,156 @@
+import csv
+import os
+import random
+from monopoly_companion import create_app
+from monopoly_companion.db import close_pools, get_db, init_db, rebuild_rollups
+from monopoly_companion.writer import close_writers
+from monopoly_companion.game_state import GameState, _game_states, flush_all_game_states
+from monopoly_companion.turn_end import get_turn_end_pipeline
+
+def test_get_close_db(app):
+    # the connection stays open in the pool between app contexts
+    with app.app_context():
+        db = get_db()
+        assert db is get_db()
+
+    with app.app_context():
+        assert get_db().execute('SELECT 1').fetchone()[0] == 1
+
+def test_init_db_command(runner, monkeypatch):
+    class Recorder:
+        called = False
+
+    def fake_init_db():
+        Recorder.called = True
+
+    monkeypatch.setattr('monopoly_companion.db.init_db', fake_init_db)
+    result = runner.invoke(args=['init-db'])
+    assert 'Initialized' in result.output
+    assert Recorder.called
+
+def test_reference_data(app):
+    # every row of the reference CSVs is loaded, with numbers as numbers and empty cells as NULL
+    with app.app_context():
+        db = get_db()
+        for table in ['action_type', 'game_version', 'players', 'property']:
+            with open(os.path.join(app.root_path, 'static', table + '.csv'), newline='') as f:
+                rows = [row for row in csv.reader(f) if row][1:]
+            assert db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0] == len(rows)
+
+        brink = db.execute("SELECT * FROM property WHERE property_name = 'Brink'").fetchone()
+        assert brink['price'] == 60
+        assert brink['rent_two_owned'] is None
+
+def test_create_and_delete_game(app, client, runner):
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2', 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'A', 'player_2_name': 'B'})
+
+    with app.app_context():
+        db = get_db()
+        properties = db.execute('SELECT COUNT(*) FROM property WHERE game_version_id = 1').fetchone()[0]
+        assert db.execute('SELECT COUNT(*) FROM property_ownership WHERE game_id = 1 AND owner_player_id = 1').fetchone()[0] == properties
+        assert db.execute('SELECT COUNT(*) FROM net_worth WHERE game_id = 1').fetchone()[0] == 4
+        assert db.execute('SELECT SUM(cash_balance) FROM net_worth WHERE game_id = 1').fetchone()[0] == db.execute('SELECT total_cash FROM game_version WHERE game_version_id = 1').fetchone()[0]
+
+    with app.app_context():
+        assert 'Deleted game 1' in runner.invoke(args=['delete-game', '1']).output
+        assert get_db().execute('SELECT COUNT(*) FROM property_ownership WHERE game_id = 1').fetchone()[0] == 0
+
+def test_sql_profile(tmp_path):
+    app = create_app({'TESTING': True, 'DATABASE': str(tmp_path / 'profile.sqlite'), 'PROJECTION_ROLLOUTS': 0, 'SQL_PROFILE': True, 'SQL_PROFILE_REPEAT_THRESHOLD': 3})
+    with app.app_context():
+        init_db()
+
+    @app.route('/loop')
+    def loop():
+        # one query per property instead of one for all of them
+        db = get_db()
+        for property_id in range(1, 5):
+            db.execute('SELECT price FROM property WHERE property_id = ?', (property_id,)).fetchone()
+        return ''
+
+    client = app.test_client()
+    response = client.get('/loop')
+    assert response.headers['X-SQL-Statements'] == '4'
+    assert response.headers['X-SQL-Repeated'] == '1'
+    assert 'sql;dur=' in response.headers['Server-Timing']
+
+    report = client.get('/debug/profile?format=json').get_json()
+    assert report['repeated'][0]['shape'] == 'SELECT price FROM property WHERE property_id = ?'
+    assert report['repeated'][0]['count'] == 4
+    assert report['requests'][0]['rows'] == 4
+    assert client.get('/debug/profile').status_code == 200
+    close_pools()
+
+def test_sql_profile_of_writer_jobs(tmp_path):
+    # the game flush and session save a gameplay request hands to the writer are in its profile
+    app = create_app({'TESTING': True, 'DATABASE': str(tmp_path / 'profile.sqlite'), 'PROJECTION_ROLLOUTS': 0, 'TURN_END_WORKERS': 0, 'SQL_PROFILE': True, 'SQL_PROFILE_REPEAT_THRESHOLD': 1})
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+    client.post('/', data={'pass_go': 'Pass Go'})
+    response = client.post('/', data={'next_player': 'Next player'})
+
+    # with a threshold of 1 every statement shape run by a separate call is listed: the flush of the turn (its batched
+    # rows are further shapes) and the session save each ran in a writer transaction of their own
+    record = client.get('/debug/profile?format=json').get_json()['requests'][-1]
+    counts = {item['shape']: item['count'] for item in record['repeated']}
+    assert record['statements'] == int(response.headers['X-SQL-Statements'])
+    assert counts['BEGIN IMMEDIATE'] == 2 and counts['COMMIT'] == 2
+    assert record['shapes'] > len(counts)
+    assert any(shape.startswith('INSERT INTO game_session') for shape in counts)
+    close_writers()
+    close_pools()
+
+def test_exit_flush_of_deleted_database(app, tmp_path):
+    # the exit flush drops a game whose database file is gone instead of creating an empty one
+    path = str(tmp_path / 'gone.sqlite')
+    _game_states[(path, 1)] = GameState(1, 1, 200, False, path)
+    _game_states[(path, 1)].pending_transactions.append((1, 1))
+    # a game without changes is not flushed at all
+    _game_states[(path, 2)] = GameState(2, 1, 200, False, path)
+    flush_all_game_states()
+    assert (path, 1) not in _game_states
+    assert (path, 2) in _game_states
+    assert not os.path.exists(path)
+    del _game_states[(path, 2)]
+
+def test_incremental_rollups_match_rebuilt(app, client, game):
+    # the rollups kept up to date as a random game is played, undos included, equal the ones rebuilt from the journal
+    rng = random.Random(7)
+    properties = ['Dorpsstraat', 'Brink', 'Kalverstraat', 'Zuid', 'West', 'Elektriciteitsbedrijf']
+    for _ in range(12):
+        for _ in range(2):
+            for _ in range(rng.randint(1, 4)):
+                roll = rng.random()
+                if roll < 0.2:
+                    client.post('/', data={'pass_go': 'Pass Go'})
+                elif roll < 0.3:
+                    client.post('/', data={'land_on_go': 'Land on Go'})
+                elif roll < 0.5:
+                    client.post('/', data={'purchase_property': 'Purchase', 'property_name': rng.choice(properties)})
+                elif roll < 0.8:
+                    client.post('/', data={'rent': 'Pay rent', 'property_name': rng.choice(properties), 'dice_roll': str(rng.randint(2, 12))})
+                else:
+                    client.post('/', data={'undo': 'Undo'})
+            client.post('/', data={'next_player': 'Next Player'})
+    get_turn_end_pipeline(app.config).join()
+
+    def rollups(db):
+        return [
+            [tuple(row) for row in db.execute("SELECT * FROM " + table + " WHERE game_id = ? ORDER BY 1, 2, 3", (game,))]
+            for table in ['player_turn_rollup', 'property_turn_rollup']
+        ]
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute("SELECT COUNT(*) FROM transactions WHERE game_id = ? AND reverses_sequence IS NOT NULL", (game,)).fetchone()[0] > 0
+        incremental = rollups(db)
+        rebuild_rollups(db, game)
+        assert rollups(db) == incremental
@@ -0,0 +1,112 @@
+import csv
+import io
+import sqlite3
+import sys
+import zipfile
+import numpy as np
+import pytest
+from monopoly_companion.db import get_db
+from monopoly_companion.export import EXPORT_COLUMNS, iter_chunks, write_export
+from monopoly_companion.game_state import _game_states, discard_game_state
+
+def test_npz_is_a_snapshot(app, client):
+    # a row written while the export streams (as by a live game) is not in it, so every array matches its header
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+
+    with app.app_context():
+        db = get_db()
+        other = sqlite3.connect(app.config['DATABASE'])
+        columns = "game_id, net_worth_time, turn, player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth"
+
+        appended = []
+
+        def append_row(statement):
+            if 'MAX(LENGTH' in statement and not appended:
+                appended.append(statement)
+                other.execute("INSERT INTO net_worth_log (" + columns + ") SELECT " + columns + " FROM net_worth_log LIMIT 1")
+                other.commit()
+
+        rows = db.execute("SELECT COUNT(*) FROM net_worth_log").fetchone()[0]
+        db.set_trace_callback(append_row)
+        f = io.BytesIO()
+        try:
+            write_export(db, 'net_worth_log', 'npz', f)
+        finally:
+            db.set_trace_callback(None)
+            other.close()
+
+        assert db.execute("SELECT COUNT(*) FROM net_worth_log").fetchone()[0] == rows + 1
+        with zipfile.ZipFile(io.BytesIO(f.getvalue())) as archive:
+            for name in archive.namelist():
+                with archive.open(name) as member:
+                    np.lib.format.read_magic(member)
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+                    assert shape == (rows,)
+                    assert len(member.read()) == rows * dtype.itemsize
+        assert not db.in_transaction
+
+def test_export_does_not_load_games(app, client, game):
+    # a game this worker holds is flushed first, any other game is read from the database without loading it
+    client.post('/', data={'pass_go': 'Pass Go'})
+    response = client.get('/api/games/1/export/transactions.csv')
+    assert len(list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))) == 1
+
+    discard_game_state(game, app.config['DATABASE'])
+    response = client.get('/api/games/1/export/transactions.csv')
+    assert len(list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))) == 1
+    assert client.get('/api/games/1/rollup/players').status_code == 200
+    assert (app.config['DATABASE'], game) not in _game_states
+    assert client.get('/api/games/2/export/transactions.csv').status_code == 404
+
+def played(client):
+    # a game with purchases and an undo, so nullable columns hold values and NULLs, and rows span several chunks
+    client.post('/', data={'pass_go': 'Pass Go'})
+    client.post('/', data={'purchase_property': 'Purchase', 'property_name': 'Brink'})
+    client.post('/', data={'land_on_go': 'Land on Go'})
+    client.post('/', data={'undo': 'Undo'})
+    client.post('/', data={'next_player': 'Next Player'})
+    client.post('/', data={'purchase_property': 'Purchase', 'property_name': 'Zuid'})
+    client.post('/', data={'rent': 'Pay rent', 'property_name': 'Brink'})
+    client.post('/', data={'next_player': 'Next Player'})
+
+def exported_rows(db, table, fmt):
+    # the rows as the database holds them, and as read back from an export written three rows at a time
+    f = io.BytesIO()
+    write_export(db, table, fmt, f, 1, chunk_size=3)
+    return [row for rows in iter_chunks(db, table, 1) for row in rows], io.BytesIO(f.getvalue())
+
+@pytest.mark.parametrize('table', list(EXPORT_COLUMNS))
+def test_csv_round_trip(app, client, game, table):
+    # CSV has no NULL, so a missing integer reads back as an empty string, as does a NULL text
+    played(client)
+    with app.app_context():
+        rows, f = exported_rows(get_db(), table, 'csv')
+    reader = csv.reader(io.TextIOWrapper(f, encoding='utf8', newline=''))
+    assert next(reader) == [name for name, kind in EXPORT_COLUMNS[table]]
+    assert rows
+    assert list(reader) == [['' if value is None else str(value) for value in row] for row in rows]
+
+@pytest.fixture
+def unload_pandas():
+    # pyarrow imports pandas whenever it is installed; unload it again so test_no_heavy_imports still sees a clean worker
+    loaded = set(sys.modules)
+    yield
+    for name in set(sys.modules) - loaded:
+        if name == 'pandas' or name.startswith('pandas.'):
+            del sys.modules[name]
+
+@pytest.mark.parametrize('table', list(EXPORT_COLUMNS))
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_arrow_round_trip(app, client, game, table, fmt, unload_pandas):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+
+    played(client)
+    with app.app_context():
+        rows, f = exported_rows(get_db(), table, fmt)
+    exported = pq.read_table(f) if fmt == 'parquet' else pa.ipc.open_file(f).read_all()
+    assert exported.column_names == [name for name, kind in EXPORT_COLUMNS[table]]
+    assert rows
+    assert [tuple(row.values()) for row in exported.to_pylist()] == rows
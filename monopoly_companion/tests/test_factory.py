@@ -0,0 +1,47 @@
+import sys
+from monopoly_companion import create_app
+
+def test_config():
+    assert not create_app().testing
+    assert create_app({'TESTING': True}).testing
+
+def test_welcome(client):
+    assert client.get('/welcome/').status_code == 200
+
+def test_session_cookie_stays_small(client):
+    # only a signed token and revision travel in the cookie, however much the session holds
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '8', 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_' + str(player) + '_name': 'Player ' + str(player) for player in range(1, 9)})
+    assert len(client.get_cookie('session').value) < 80
+
+def test_session_holds_only_identifiers(client):
+    # the gameplay page is rendered from the game state, so only next player changes (and writes) the session
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+    cookie = client.get_cookie('session').value
+    assert client.post('/', data={'pass_go': 'Pass Go'}).status_code == 200
+    assert b'Brink' in client.post('/', data={'purchase_property': 'Purchase', 'property_name': 'Brink'}).data
+    assert client.get_cookie('session').value == cookie
+    with client.session_transaction() as session:
+        assert sorted(session) == ['current_player_id', 'current_turn', 'game_id', 'game_started']
+
+    client.post('/', data={'next_player': 'Next Player'})
+    assert client.get_cookie('session').value != cookie
+
+def test_cached_session_is_copied(client):
+    # a nested value changed in place does not mark the session modified, so it must not reach the cache either
+    client.post('/welcome/')
+    with client.session_transaction() as session:
+        session['nested'] = {'values': [1]}
+    with client.session_transaction() as session:
+        session['nested']['values'].append(2)
+    with client.session_transaction() as session:
+        assert session['nested'] == {'values': [1]}
+
+def test_no_heavy_imports(client):
+    client.get('/welcome/')
+    assert 'pandas' not in sys.modules
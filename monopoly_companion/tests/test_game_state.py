@@ -0,0 +1,195 @@
+import random
+import pytest
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import COUNTER_COLUMNS, GameState, StaleGameState, _game_states, discard_game_state, get_game_state
+
+def stored(db, game_id):
+    # the rows of the game that make up its state, besides the journal. The turn columns are left out: they stamp the
+    # turn of the last change, which an undo is as well. An owner's city count of 0 is the same as no row.
+    rows = {}
+    for table in ['net_worth', 'property_ownership', 'city_ownership', 'special_counter']:
+        columns = [row['name'] for row in db.execute("SELECT name FROM pragma_table_info(?)", (table,)) if row['name'] != 'turn']
+        where = " AND number_owned > 0" if table == 'city_ownership' else ""
+        rows[table] = [tuple(row) for row in db.execute("SELECT " + ", ".join(columns) + " FROM " + table + " WHERE game_id = ?" + where + " ORDER BY 1, 2, 3", (game_id,))]
+    return rows
+
+def state_of(state):
+    # the snapshot of a state without its sequence number, which undo moves on, and the turn stamps
+    snapshot = state.snapshot()
+    del snapshot['sequence'], snapshot['turn']
+    for player in snapshot['players'].values():
+        del player['turn']
+    return snapshot
+
+def balances(db, game_id):
+    return {row['player_id']: row['cash_balance'] for row in db.execute("SELECT player_id, cash_balance FROM net_worth WHERE game_id = ?", (game_id,))}
+
+def test_stale_state_is_reloaded(app, client, game):
+    # two workers hold the game: the second flush finds the first one's events and drops its state instead of
+    # overwriting the balances, and the game goes on from what is stored
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        other = GameState.load(db, game, app.config['DATABASE'])
+        other.go(3, 1)
+        other.commit(app.config)
+        stored = balances(db, game)
+
+        state.go(4, 1)
+        with pytest.raises(StaleGameState):
+            state.commit(app.config)
+        assert (app.config['DATABASE'], game) not in _game_states
+        assert balances(db, game) == stored
+
+    response = client.post('/', data={'pass_go': 'Pass Go'})
+    assert b'your last actions were not saved' not in response.data
+    response = client.post('/', data={'next_player': 'Next Player'})
+    assert response.status_code == 200
+
+    with app.app_context():
+        db = get_db()
+        assert balances(db, game)[3] == stored[3] + 200
+
+        # the gameplay page reports a flush that lost to another worker, and shows the game as stored
+        state = get_game_state(db, game, app.config['DATABASE'])
+        other = GameState.load(db, game, app.config['DATABASE'])
+        other.go(4, 1)
+        other.commit(app.config)
+        stored = balances(db, game)
+    response = client.post('/', data={'pass_go': 'Pass Go'})
+    response = client.post('/', data={'next_player': 'Next Player'})
+    assert b'your last actions were not saved' in response.data
+    with app.app_context():
+        assert balances(get_db(), game) == stored
+        assert get_game_state(get_db(), game, app.config['DATABASE']) is not state
+
+@pytest.mark.parametrize('reload', [False, True])
+@pytest.mark.parametrize('action', ['purchase_property', 'rent', 'land_on_go'])
+def test_undo_restores_state(app, game, action, reload):
+    # undoing an action puts the state and its rows back as they were, also when the action was flushed and the game
+    # reloaded from the journal in between
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        if action == 'rent':
+            state.purchase_property(3, 'Brink', 1)
+        state.commit(app.config)
+        before = (stored(db, game), state_of(state))
+
+        if action == 'purchase_property':
+            state.purchase_property(3, 'Brink', 1)
+        elif action == 'rent':
+            assert state.rent(4, 'Brink', 1)[0] > 0
+        else:
+            state.go(3, 1, landed_on=True)
+        state.commit(app.config)
+        assert stored(db, game) != before[0]
+
+        if reload:
+            discard_game_state(game, app.config['DATABASE'])
+            state = get_game_state(db, game, app.config['DATABASE'])
+        assert state.undo_action(1) == "Last transaction undone."
+        state.commit(app.config)
+        assert (stored(db, game), state_of(state)) == before
+
+def test_nothing_to_undo(app, game):
+    with app.app_context():
+        state = get_game_state(get_db(), game, app.config['DATABASE'])
+        assert state.undo_action(1) == "Nothing to undo."
+        state.go(3, 1)
+        assert state.undo_action(1) == "Last transaction undone."
+        # an undo is not undone itself
+        assert state.undo_action(1) == "Nothing to undo."
+        assert [event['reverses_sequence'] for event in state.pending_transactions] == [None, 1]
+
+def test_flushed_rows_match_state(app, game):
+    # after each write-behind flush of a random game the stored rows are what the state holds in memory
+    rng = random.Random(2)
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        for turn in range(1, 31):
+            player_id = 3 if turn % 2 else 4
+            for _ in range(rng.randint(1, 4)):
+                roll = rng.random()
+                if roll < 0.3:
+                    state.go(player_id, turn, landed_on=roll < 0.1)
+                elif roll < 0.5:
+                    for_sale = [name for name, slot in state.property_by_name.items() if state.owner[slot] == 1]
+                    state.purchase_property(player_id, rng.choice(for_sale), turn)
+                elif roll < 0.8:
+                    state.rent(player_id, rng.choice(list(state.property_by_name)), turn, rng.randint(2, 12))
+                else:
+                    state.undo_action(turn)
+            state.commit(app.config)
+
+            assert {row['player_id']: tuple(row)[1:] for row in db.execute("SELECT player_id, cash_balance, net_property_value, improvement_value, gross_property_value, net_worth FROM net_worth WHERE game_id = ?", (game,))} == {
+                player_id: (state.cash[slot], state.net_property[slot], state.improvement[slot], state.gross[slot], state.net_worth(slot))
+                for slot, player_id in enumerate(state.player_ids)
+            }
+            assert {row['property_id']: tuple(row)[1:] for row in db.execute("SELECT property_id, owner_player_id, mortgaged, houses, hotels FROM property_ownership WHERE game_id = ?", (game,))} == {
+                property_id: (state.owner[slot], state.mortgaged[slot], state.houses[slot], state.hotels[slot])
+                for slot, property_id in enumerate(state.property_ids)
+            }
+            assert {(row['owner_player_id'], row['city']): row['number_owned'] for row in db.execute("SELECT owner_player_id, city, number_owned FROM city_ownership WHERE game_id = ? AND number_owned > 0", (game,))} == {
+                key: number_owned for key, number_owned in state.city_owned.items() if number_owned > 0
+            }
+            assert {row['player_id']: list(tuple(row)[1:]) for row in db.execute("SELECT player_id, " + ", ".join(COUNTER_COLUMNS) + " FROM special_counter WHERE game_id = ?", (game,))} == {
+                player_id: state.counters[slot] for slot, player_id in enumerate(state.player_ids)
+            }
+
+def test_city_ownership_follows_transfers(app, game):
+    # a change of owner moves one count from the old owner's city row to the new owner's, in memory and once flushed
+    def cities(db):
+        return {(row['owner_player_id'], row['city']): (row['number_owned'], row['monopoly']) for row in db.execute("SELECT owner_player_id, city, number_owned, monopoly FROM city_ownership WHERE game_id = ? AND number_owned > 0", (game,))}
+
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        assert cities(db)[(1, 'Ons Dorp')] == (2, 1)
+
+        state.purchase_property(3, 'Dorpsstraat', 1)
+        state.purchase_property(3, 'Zuid', 1)
+        state.purchase_property(4, 'West', 2)
+        state.commit(app.config)
+        assert (state.city_owned[(1, 'Ons Dorp')], state.city_owned[(3, 'Ons Dorp')]) == (1, 1)
+        assert not state.monopoly(state.property_by_name['Dorpsstraat'])
+        assert state.number_owned(state.property_by_name['Zuid']) == 1
+        stored = cities(db)
+        assert (stored[(1, 'Ons Dorp')], stored[(3, 'Ons Dorp')]) == ((1, 0), (1, 0))
+        assert (stored[(1, 'Station')], stored[(3, 'Station')], stored[(4, 'Station')]) == ((2, 0), (1, 0), (1, 0))
+
+        state.purchase_property(3, 'Brink', 3)
+        state.commit(app.config)
+        assert state.monopoly(state.property_by_name['Dorpsstraat'])
+        stored = cities(db)
+        assert (1, 'Ons Dorp') not in stored
+        assert stored[(3, 'Ons Dorp')] == (2, 1)
+
+        state.undo_action(3)
+        state.commit(app.config)
+        assert not state.monopoly(state.property_by_name['Dorpsstraat'])
+        stored = cities(db)
+        assert (stored[(1, 'Ons Dorp')], stored[(3, 'Ons Dorp')]) == ((1, 0), (1, 0))
+
+def test_valuation_cleared_on_ownership_change(app, game):
+    # the cached property values are dropped whenever a property changes hands, so they are never read stale
+    with app.app_context():
+        state = get_game_state(get_db(), game, app.config['DATABASE'])
+        assert state.property_values()[3] == [0, 0, 0, 0, 0]
+        assert state.valuation is not None
+
+        savepoint = state.savepoint()
+        state.purchase_property(3, 'Brink', 1)
+        assert state.valuation is None
+        assert state.property_values()[3] == [0, 60, 60, 60, 0]
+
+        state.undo_action(1)
+        assert state.valuation is None
+        assert state.property_values()[3] == [0, 0, 0, 0, 0]
+
+        state.purchase_property(3, 'Brink', 1)
+        assert state.property_values()[3] == [0, 60, 60, 60, 0]
+        state.rollback(savepoint)
+        assert state.valuation is None
+        assert state.property_values()[3] == [0, 0, 0, 0, 0]
@@ -0,0 +1,50 @@
+import json
+from monopoly_companion.db import get_db
+from monopoly_companion.importer import import_file
+from monopoly_companion.replay import seek
+
+LOG = """game,game_version,turn,player,action,property,dice_roll,amount
+a,Monopoly NL,1,Ann,purchase property,Brink,,60
+a,Monopoly NL,1,Bob,rent,Brink,,4
+a,Monopoly NL,2,Ann,pass go,,,200
+a,Monopoly NL,2,Bob,Pass_Go,,,
+b,Monopoly NL,1,Ann,rent,Brink,,
+b,Monopoly NL,1,Bob,build house,Brink,,
+c,Monopoly NL,1,Ann,purchase property,Brink,,70
+d,Monopoly NL,1,Cy,purchase property,Elektriciteitsbedrijf,,
+d,Monopoly NL,1,Dee,rent,Elektriciteitsbedrijf,7,
+"""
+
+def test_import_csv(app, tmp_path):
+    path = tmp_path / 'games.csv'
+    path.write_text(LOG)
+    with app.app_context():
+        db = get_db()
+        importer = import_file(db, str(path), batch_size=2, database=app.config['DATABASE'])
+
+        assert [key for key, game_id in importer.games] == ['a', 'd']
+        assert [(key, error.line, error.message) for key, error in importer.errors] == [
+            ('b', 7, 'build house is not supported yet'),
+            ('c', 8, 'Amount 70 does not match 60'),
+        ]
+        game_id = dict(importer.games)['a']
+        assert db.execute("SELECT COUNT(*) FROM transactions WHERE game_id = ?", (game_id,)).fetchone()[0] == 4
+        ann = db.execute("SELECT player_id, cash_balance, net_property_value FROM net_worth JOIN players USING (game_id, player_id) WHERE game_id = ? AND player_name = 'Ann'", (game_id,)).fetchone()
+        assert tuple(ann)[1:] == (1500 - 60 + 4 + 200, 60)
+        assert [row[0] for row in db.execute("SELECT turn FROM player_turn_rollup JOIN players USING (game_id, player_id) WHERE game_id = ? AND player_name = 'Ann' ORDER BY turn", (game_id,))] == [0, 1, 2]
+        state = seek(db, game_id, turn=1)
+        assert state.cash[state.player_slot[ann['player_id']]] == 1500 - 60 + 4
+
+        # the utility rent used the dice roll: 4 times 7 with one utility owned
+        game_id = dict(importer.games)['d']
+        assert db.execute("SELECT cash_paid FROM transactions WHERE game_id = ? AND action_type_id = 2", (game_id,)).fetchone()[0] == 28
+        # the skipped games left nothing behind
+        assert db.execute("SELECT COUNT(*) FROM game").fetchone()[0] == 2
+
+def test_import_command(app, runner, tmp_path):
+    path = tmp_path / 'games.jsonl'
+    path.write_text("\n".join(json.dumps({'game': 1, 'game_version': 'Monopoly NL', 'turn': 1, 'player': player, 'action': 'pass go'}) for player in ['Ann', 'Bob']) + "\n")
+    with app.app_context():
+        result = runner.invoke(args=['import-games', str(path)])
+        assert 'imported 1 games (2 actions)' in result.output
+        assert get_db().execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == 2
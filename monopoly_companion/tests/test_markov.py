@@ -0,0 +1,74 @@
+import threading
+import numpy as np
+import pytest
+from monopoly_companion import markov
+from monopoly_companion.board import BOARD_SIZE, JAIL, Board
+from monopoly_companion.db import get_db
+
+def test_unsolvable_board_is_remembered(app, client, game, monkeypatch):
+    # without scipy the gameplay page shows no expected rents, and does not read and try the board again on every render
+    calls = []
+
+    def no_scipy(board):
+        calls.append(board.game_version_id)
+        raise ImportError("No module named 'scipy'")
+
+    monkeypatch.setattr(markov, 'solve', no_scipy)
+    for _ in range(3):
+        assert client.get('/').status_code == 200
+    assert calls == [1]
+
+    markov.invalidate_landing_probabilities(1, app.config['DATABASE'])
+    assert client.get('/').status_code == 200
+    assert calls == [1, 1]
+
+def test_landing_probabilities_solved_outside_the_lock(monkeypatch):
+    # callers for the same version share one solve, other versions do not wait for it
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_load(db, game_version_id, config=None):
+        calls.append(game_version_id)
+        if game_version_id == 1:
+            started.set()
+            assert release.wait(5)
+        return {0: (game_version_id, 0.0, None)}
+
+    monkeypatch.setattr(markov, 'load_landing_probabilities', slow_load)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(markov.get_landing_probabilities(None, 1, 'test'))) for _ in range(2)]
+    try:
+        for thread in threads:
+            thread.start()
+        assert started.wait(5)
+        assert markov.get_landing_probabilities(None, 2, 'test') == {0: (2, 0.0, None)}
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+        markov.invalidate_landing_probabilities(1, 'test')
+        markov.invalidate_landing_probabilities(2, 'test')
+
+    assert sorted(calls) == [1, 2]
+    assert results == [{0: (1, 0.0, None)}] * 2
+
+def test_solved_probabilities(app):
+    # the sparse solve agrees with the chain run forward until it settles. Every throw either ends a move on a square
+    # or keeps the player in jail, so those add up to 1, and jail (sent there or just visiting) is the likeliest square.
+    with app.app_context():
+        board = Board.load(get_db(), 1)
+    probabilities = markov.solve(board)
+
+    matrix = np.zeros((markov.STATES, markov.STATES))
+    for from_state, to_state, probability, total in markov.transitions(board):
+        matrix[from_state, to_state] += probability
+    assert np.allclose(matrix.sum(axis=1), 1)
+    stationary = np.full(markov.STATES, 1 / markov.STATES) @ np.linalg.matrix_power(matrix, 4096)
+
+    per_roll = stationary[:BOARD_SIZE * markov.DOUBLES_LIMIT].reshape(BOARD_SIZE, markov.DOUBLES_LIMIT).sum(axis=1)
+    per_roll[JAIL] += stationary[markov.jail_state(0)]
+    assert [probabilities[square][0] for square in range(BOARD_SIZE)] == pytest.approx(per_roll.tolist())
+    assert sum(probabilities[square][0] for square in range(BOARD_SIZE)) + stationary[markov.jail_state(1):].sum() == pytest.approx(1)
+    assert max(range(BOARD_SIZE), key=lambda square: probabilities[square][0]) == JAIL
+    assert all(2 <= probabilities[square][2] <= 12 for square in range(BOARD_SIZE) if probabilities[square][0])
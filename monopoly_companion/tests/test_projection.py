@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import pytest
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import get_game_state
+from monopoly_companion.projection import Projection, fork_game
+
+def project(setup, seed):
+    # every batch of a projection run to completion, on threads rather than the process pool
+    projection = Projection(1, 0, setup['player_ids'], 500, 50, 60.0)
+    with ThreadPoolExecutor(2) as executor:
+        projection.start(executor, setup, 100, seed)
+        wait(projection.futures)
+    return projection.result()
+
+def test_projection_result(app, game):
+    # Ann owns the whole board and Bob has 100 left, so Bob goes bankrupt in nearly every rollout and Ann wins it
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        for name in state.property_by_name:
+            state.purchase_property(3, name, 1)
+        state.transfer_cash(1, 3, sum(prop['price'] for prop in state.properties))
+        state.transfer_cash(4, 1, state.cash[state.player_slot[4]] - 100)
+        state.commit(app.config)
+        setup = fork_game(db, game, current_player_id=4)
+
+    assert setup['player_ids'] == [4, 3]
+    result = project(setup, 13)
+    assert result['rollouts'] == result['requested'] == 500
+    assert result['complete'] and not result['cancelled']
+    assert set(result['players']) == {'3', '4'}
+    for player in result['players'].values():
+        assert all(0 <= player[field] <= 1 for field in ['bankruptcy', 'win', 'leading'])
+    assert sum(player['leading'] for player in result['players'].values()) == pytest.approx(1)
+    assert result['players']['3']['bankruptcy'] == 0
+    assert result['players']['4']['bankruptcy'] > 0.9
+    assert result['players']['3']['win'] == result['players']['4']['bankruptcy']
+    assert result['players']['3']['leading'] == 1
+
+    # the same seed gives the same estimate
+    again = project(setup, 13)
+    assert again['players'] == result['players']
@@ -0,0 +1,40 @@
+from monopoly_companion.db import get_db
+from monopoly_companion.rent import RentTable
+
+def chained_rent(prop, houses, hotels, monopoly, number_owned, dice_roll):
+    # the if/elif chain GameState.rent walked before the rent table was compiled
+    if hotels == 1:
+        return prop['rent_hotel']
+    elif houses > 0:
+        return prop[['rent_one_house', 'rent_two_houses', 'rent_three_houses', 'rent_four_houses'][houses - 1]]
+    elif monopoly and prop['property_type'] == "Street":
+        return prop['rent_monopoly']
+    elif prop['property_type'] == "Station" and number_owned > 1:
+        return prop[['rent_two_owned', 'rent_three_owned', 'rent_four_owned'][number_owned - 2]]
+    elif prop['property_type'] == "Utility":
+        if number_owned == 1:
+            return prop['rent_multiplier_one_owned'] * dice_roll
+        return prop['rent_multiplier_two_owned'] * dice_roll
+    return prop['rent_basic']
+
+def test_rent_table_matches_chain(app):
+    # every property of the shipped board, in every ownership state it can be in, has the rent the chain gave:
+    # streets basic, in a monopoly, with one to four houses and with a hotel, one to four stations, one or two utilities
+    with app.app_context():
+        db = get_db()
+        table = RentTable.compile(db, 1)
+        properties = db.execute("SELECT * FROM property WHERE game_version_id = 1").fetchall()
+
+    states = {
+        'Street': [(0, 0, False, 1), (0, 0, True, 3)] + [(houses, 0, True, 3) for houses in range(1, 5)] + [(0, 1, True, 3)],
+        'Station': [(0, 0, False, number_owned) for number_owned in range(1, 5)],
+        'Utility': [(0, 0, False, number_owned) for number_owned in range(1, 3)],
+    }
+    checked = set()
+    for prop in properties:
+        for houses, hotels, monopoly, number_owned in states[prop['property_type']]:
+            level = table.rent_level(prop['property_id'], houses, hotels, monopoly, number_owned)
+            for dice_roll in range(2, 13):
+                assert table.rent(prop['property_id'], level, dice_roll) == chained_rent(prop, houses, hotels, monopoly, number_owned, dice_roll)
+            checked.add((prop['property_type'], level))
+    assert len(checked) == 7 + 4 + 2
@@ -0,0 +1,44 @@
+import random
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import CHECKPOINT_INTERVAL, get_game_state
+from monopoly_companion.replay import seek
+
+def test_seek_matches_live_state(app, game):
+    # a random game is flushed now and then, which checkpoints it every CHECKPOINT_INTERVAL events. Seeking any
+    # event or turn, before the first of those checkpoints, across them or right at them, gives the state it had then.
+    rng = random.Random(8)
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        by_sequence = {0: state.snapshot()}
+        by_turn = {}
+        for turn in range(1, 81):
+            player_id = 3 if turn % 2 else 4
+            for _ in range(rng.randint(1, 4)):
+                roll = rng.random()
+                if roll < 0.2:
+                    state.go(player_id, turn)
+                elif roll < 0.3:
+                    state.go(player_id, turn, landed_on=True)
+                elif roll < 0.5:
+                    for_sale = [name for name, slot in state.property_by_name.items() if state.owner[slot] == 1]
+                    if for_sale:
+                        state.purchase_property(player_id, rng.choice(for_sale), turn)
+                elif roll < 0.8:
+                    state.rent(player_id, rng.choice(list(state.property_by_name)), turn, rng.randint(2, 12))
+                else:
+                    state.undo_action(turn)
+                by_sequence[state.next_sequence - 1] = state.snapshot()
+                if rng.random() < 0.2:
+                    state.commit(app.config)
+            by_turn[turn] = state.snapshot()
+        state.commit(app.config)
+
+        checkpoints = [row[0] for row in db.execute("SELECT sequence FROM state_checkpoint WHERE game_id = ? ORDER BY sequence", (game,))]
+        assert checkpoints[0] == 0 and len(checkpoints) >= 3
+        assert max(by_sequence) > checkpoints[-1] >= CHECKPOINT_INTERVAL
+
+        for sequence, snapshot in by_sequence.items():
+            assert seek(db, game, sequence=sequence).snapshot() == snapshot
+        for turn, snapshot in by_turn.items():
+            assert seek(db, game, turn=turn).snapshot() == snapshot
@@ -0,0 +1,54 @@
+import json
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import get_game_state
+from monopoly_companion.scoreboard import SUBSCRIBER_QUEUE_SIZE, Broadcaster, delta, scoreboard
+
+def data(message):
+    # the JSON payload of a Server-Sent Events message
+    return json.loads(message.split("\ndata: ")[1])
+
+def test_delta_holds_only_changed_fields(app, game):
+    # a purchase moves cash from the buyer to the bank, which leaves both net worths as they were, and changes the
+    # owner of one property
+    with app.app_context():
+        state = get_game_state(get_db(), game, app.config['DATABASE'])
+        before = scoreboard(state, 3, 1)
+        assert delta(None, before) == before
+        assert delta(before, before) == {}
+
+        cash = state.cash[state.player_slot[3]]
+        bank = state.cash[state.player_slot[1]]
+        state.purchase_property(3, 'Brink', 1)
+        assert delta(before, scoreboard(state, 3, 1)) == {'players': {'1': {'cash': bank + 60}, '3': {'cash': cash - 60}}, 'owners': {'2': 3}}
+        assert delta(before, scoreboard(state, 4, 2)) == {'turn': 2, 'current_player_id': 4, 'players': {'1': {'cash': bank + 60}, '3': {'cash': cash - 60}}, 'owners': {'2': 3}}
+
+def test_broadcaster_publishes_to_subscribers(app, game):
+    # every subscriber of a game gets each delta once, a late one starts from the full scoreboard, and one that
+    # falls too far behind is disconnected instead of holding up the others
+    with app.app_context():
+        state = get_game_state(get_db(), game, app.config['DATABASE'])
+        broadcaster = Broadcaster()
+        key = (app.config['DATABASE'], game)
+        first = broadcaster.subscribe(key)
+        other_game = broadcaster.subscribe((app.config['DATABASE'], game + 1))
+
+        full = scoreboard(state, 3, 1)
+        assert broadcaster.publish(key, full) == full
+        assert broadcaster.publish(key, scoreboard(state, 3, 1)) is None
+        state.purchase_property(3, 'Brink', 1)
+        changes = broadcaster.publish(key, scoreboard(state, 3, 1))
+
+        assert [data(first.messages.get_nowait()), data(first.messages.get_nowait())] == [full, changes]
+        assert first.messages.empty() and other_game.messages.empty()
+
+        late = broadcaster.subscribe(key)
+        message = late.messages.get_nowait()
+        assert message.startswith("id: 2\nevent: scoreboard\n")
+        assert data(message) == scoreboard(state, 3, 1)
+
+        broadcaster.unsubscribe(key, late)
+        for turn in range(2, SUBSCRIBER_QUEUE_SIZE + 3):
+            broadcaster.publish(key, scoreboard(state, 3, turn))
+        assert first.closed and not other_game.closed
+        assert broadcaster.channels[key].subscribers == []
+        assert late.messages.empty()
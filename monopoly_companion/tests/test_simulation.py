@@ -0,0 +1,42 @@
+import threading
+from monopoly_companion import simulation
+from monopoly_companion.board import Board
+from monopoly_companion.db import get_db
+
+def test_get_simulation_runs_outside_the_lock(monkeypatch):
+    # concurrent callers share one run, and invalidating does not wait for it
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_simulate(db, game_version_id, *args):
+        calls.append(game_version_id)
+        if game_version_id == 1:
+            started.set()
+            assert release.wait(5)
+        return {'game_version_id': game_version_id}
+
+    monkeypatch.setattr(simulation, 'simulate', slow_simulate)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(simulation.get_simulation(None, 1, database='test'))) for _ in range(2)]
+    try:
+        for thread in threads:
+            thread.start()
+        assert started.wait(5)
+        assert simulation.get_simulation(None, 2, database='test') == {'game_version_id': 2}
+        simulation.invalidate_simulations(1, 'test')
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+        simulation.invalidate_simulations(2, 'test')
+
+    assert sorted(calls) == [1, 2]
+    assert results == [{'game_version_id': 1}] * 2
+
+def test_run_simulation_in_worker_processes(app):
+    with app.app_context():
+        board = Board.load(get_db(), 1)
+    landings, dice_totals, go_passes, go_landings = simulation.run_simulation(board, 20, 10, 1, workers=2)
+    assert landings.sum() > 0
+    assert simulation.process_context().get_start_method() in ('forkserver', 'spawn')
@@ -0,0 +1,35 @@
+from monopoly_companion.db import get_db
+from monopoly_companion.game_state import get_game_state
+from monopoly_companion.turn_end import close_turn_end_pipelines, get_turn_end_pipeline, turn_end
+
+def test_rounds_logged_in_order(app, client):
+    # the net worth of every round is logged after "Next player" responds, in order, with the balances of the round end
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2', 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'A', 'player_2_name': 'B'})
+    for _ in range(3):
+        client.post('/', data={'pass_go': 'Pass Go'})
+        client.post('/', data={'next_player': 'Next player'})
+        client.post('/', data={'next_player': 'Next player'})
+    get_turn_end_pipeline(app.config).join()
+
+    with app.app_context():
+        rows = get_db().execute("SELECT turn, cash_balance FROM player_turn_rollup WHERE game_id = 1 AND player_id = 3 AND turn > 0 ORDER BY turn").fetchall()
+    assert [tuple(row) for row in rows] == [(1, 1700), (2, 1900), (3, 2100)]
+
+def test_close_processes_queued_events(app, client):
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2', 'double_go': 'on'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'A', 'player_2_name': 'B'})
+
+    with app.app_context():
+        state = get_game_state(get_db(), 1, app.config['DATABASE'])
+    pipeline = get_turn_end_pipeline(app.config)
+    for turn in range(2, 52):
+        pipeline.submit(turn_end(state, turn, 3, True))
+    close_turn_end_pipelines()
+
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(DISTINCT turn) FROM player_turn_rollup WHERE game_id = 1 AND turn > 0").fetchone()[0] == 50
@@ -0,0 +1,129 @@
+import csv
+import json
+from monopoly_companion.db import get_db, get_game_template
+from monopoly_companion.game_state import discard_game_state, get_game_state
+from monopoly_companion.rent import get_rent_table
+from monopoly_companion.versions import BOARD_COLUMNS, PROPERTY_COLUMNS, VERSION_COLUMNS, VersionLoader, _revisions
+
+def street(name, position, rent_basic, **columns):
+    prop = {
+        'property_name': name, 'property_type': 'Street', 'city': 'Oud', 'board_side': 1, 'board_position': position,
+        'house_cost': 50, 'price': 60, 'mortgage_value': 30, 'unmortgage_cost': 33, 'rent_basic': rent_basic,
+        'rent_monopoly': 2 * rent_basic, 'rent_one_house': 10, 'rent_two_houses': 30, 'rent_three_houses': 90,
+        'rent_four_houses': 160, 'rent_hotel': 250,
+    }
+    prop.update(columns)
+    return prop
+
+def board(name, properties):
+    return {'game_version_name': name, 'game_version_language': 'NL', 'total_cash': 20580, 'starting_cash_balance': 1500, 'go_value': 200, 'properties': properties}
+
+def test_load_json(app, tmp_path):
+    station = {'property_name': 'Zuid', 'property_type': 'Station', 'city': 'Station', 'board_side': 1, 'board_position': 5, 'price': 200, 'mortgage_value': 100, 'unmortgage_cost': 110, 'rent_basic': 25, 'rent_two_owned': 50, 'rent_three_owned': 100}
+    path = tmp_path / 'boards.json'
+    path.write_text(json.dumps([
+        board('Oud', [street('Dorpsstraat', 1, 2), street('Kerkstraat', 3, 4)]),
+        board('Kapot', [street('Dorpsstraat', 1, 2, rent_hotel=None)]),
+        board('Station', [station]),
+        board('Omlaag', [street('Dorpsstraat', 1, 2, rent_one_house=1)]),
+        board('Kans', [street('Dorpsstraat', 7, 2)]),
+    ]))
+    with app.app_context():
+        db = get_db()
+        loader = VersionLoader(db, app.config['DATABASE']).load_file(str(path), batch_size=2)
+
+        assert [(name, revision) for name, game_version_id, revision in loader.loaded] == [('Oud', 1)]
+        assert [(error.where, error.message) for source, error in loader.errors] == [
+            ('board 2, Dorpsstraat', 'Missing rent_hotel for a Street'),
+            ('board 3, Zuid', 'Missing rent_four_owned for a Station'),
+            ('board 4, Dorpsstraat', 'rent_one_house 1 is less than rent_monopoly 4'),
+            ('board 5, Dorpsstraat', 'board_position 7 is not a property square'),
+        ]
+        game_version_id = loader.loaded[0][1]
+        assert get_game_template(db, game_version_id, app.config['DATABASE']).property_names == ['Dorpsstraat', 'Kerkstraat']
+        rent_table = get_rent_table(db, game_version_id, app.config['DATABASE'])
+
+        # a new rent bumps the revision and recompiles the rent table; loading the same board again changes nothing
+        path.write_text(json.dumps(board('Oud', [street('Dorpsstraat', 1, 3), street('Kerkstraat', 3, 4)])))
+        loader = VersionLoader(db, app.config['DATABASE']).load_file(str(path))
+        assert loader.loaded == [('Oud', game_version_id, 2)]
+        assert get_rent_table(db, game_version_id, app.config['DATABASE']) is not rent_table
+        assert get_rent_table(db, game_version_id, app.config['DATABASE']).rents[min(rent_table.rents)][0] == 3
+        loader = VersionLoader(db, app.config['DATABASE']).load_file(str(path))
+        assert (loader.loaded, loader.unchanged) == ([], ['Oud'])
+        assert db.execute("SELECT revision FROM game_version WHERE game_version_id = ?", (game_version_id,)).fetchone()[0] == 2
+
+def test_reload_version_with_games(app, client, runner, tmp_path):
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+    with client.session_transaction() as session:
+        game_id = session['game_id']
+
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game_id, app.config['DATABASE'])
+        player_ids = sorted(int(player_id) for player_id in state.players)
+        state.purchase_property(player_ids[0], 'Brink', 1)
+        slot = state.player_slot[player_ids[0]]
+        assert state.net_property[slot] == 60
+
+        # the shipped board as a board CSV, with Brink at a new price and rent
+        rows = [{column: row[column] for column in BOARD_COLUMNS} for row in db.execute("SELECT * FROM property JOIN game_version USING (game_version_id) ORDER BY property_id")]
+        brink = next(row for row in rows if row['property_name'] == 'Brink')
+        brink.update(price=80, rent_basic=6, rent_monopoly=12)
+        directory = tmp_path / 'boards'
+        directory.mkdir()
+        with open(directory / 'nl.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, BOARD_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        (directory / 'extra.jsonl').write_text(json.dumps(board('Monopoly NL', [street('Brink', 1, 2)])) + "\n")
+
+        result = runner.invoke(args=['load-versions', str(directory)])
+        assert 'has games, so only its prices and rents can change' in result.output
+        assert 'loaded Monopoly NL (game version 1, revision 1)' in result.output
+
+        # the loaded game was revalued and charges the new rent
+        assert state.net_property[slot] == 80
+        assert state.rent(player_ids[1], 'Brink', 1)[0] == 6
+
+        # flush and forget the game, so no dirty state is left behind for the exit flush
+        state.commit(app.config)
+        assert db.execute("SELECT net_property_value FROM net_worth WHERE game_id = ? AND player_id = ?", (game_id, player_ids[0])).fetchone()[0] == 80
+        discard_game_state(game_id, app.config['DATABASE'])
+
+def shipped_board(db, **brink):
+    # the shipped Monopoly NL board as a board object, with some columns of Brink changed
+    version = db.execute("SELECT * FROM game_version WHERE game_version_name = 'Monopoly NL'").fetchone()
+    properties = [{column: row[column] for column in PROPERTY_COLUMNS} for row in db.execute("SELECT * FROM property WHERE game_version_id = ? ORDER BY property_id", (version['game_version_id'],))]
+    next(prop for prop in properties if prop['property_name'] == 'Brink').update(brink)
+    return dict({column: version[column] for column in VERSION_COLUMNS}, properties=properties)
+
+def test_reload_version_revalues_stored_games(app, client, game):
+    client.post('/', data={'purchase_property': 'Purchase', 'property_name': 'Brink'})
+
+    with app.app_context():
+        db = get_db()
+        state = get_game_state(db, game, app.config['DATABASE'])
+        state.commit(app.config)
+        discard_game_state(game, app.config['DATABASE'])
+
+        # no worker holds the game: its stored net worth is revalued with the board
+        VersionLoader(db, app.config['DATABASE']).load([('board 1', shipped_board(db, price=80))])
+        assert db.execute("SELECT net_property_value FROM net_worth WHERE game_id = ? AND player_id = 3", (game,)).fetchone()[0] == 80
+
+        # another process reloads the board while this one holds the game: the next gameplay request revalues it
+        state = get_game_state(db, game, app.config['DATABASE'])
+        VersionLoader(db).load([('board 1', shipped_board(db, price=100))])
+        assert state.net_property[state.player_slot[3]] == 80
+        assert db.execute("SELECT net_property_value FROM net_worth WHERE game_id = ? AND player_id = 3", (game,)).fetchone()[0] == 100
+
+    assert client.get('/').status_code == 200
+    with app.app_context():
+        db = get_db()
+        assert state.net_property[state.player_slot[3]] == 100
+        state.commit(app.config)
+        assert db.execute("SELECT net_property_value FROM net_worth WHERE game_id = ? AND player_id = 3", (game,)).fetchone()[0] == 100
+    # what the other process would have cached
+    _revisions.pop((None, 1), None)
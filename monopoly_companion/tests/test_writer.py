@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+import pytest
+from monopoly_companion.db import get_db, get_pool
+from monopoly_companion.markov import get_landing_probabilities
+from monopoly_companion.writer import get_writer, write
+
+def test_write(app):
+    # the result of a job is returned once it is committed, and visible to other connections
+    assert write(app.config, lambda db: db.execute("INSERT INTO game_session (token, revision, updated_time, data) VALUES ('a', 1, 0, '{}')").rowcount) == 1
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) FROM game_session").fetchone()[0] == 1
+
+def test_group_commit(app):
+    # jobs queued while the writer is busy are committed together, and a failing job only rolls back its own writes
+    writer = get_writer(app.config)
+    busy = threading.Event()
+    release = threading.Event()
+
+    def block(db):
+        busy.set()
+        release.wait()
+
+    def insert(token):
+        return lambda db: db.execute("INSERT INTO game_session (token, revision, updated_time, data) VALUES (?, 1, 0, '{}')", (token,))
+
+    first = writer.submit(block)
+    busy.wait()
+    groups = writer.groups
+    futures = [writer.submit(insert(str(token))) for token in range(10)]
+    duplicate = writer.submit(insert('0'))
+    last = writer.submit(insert('10'))
+    release.set()
+
+    first.result()
+    for future in futures + [last]:
+        future.result()
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result()
+    assert writer.groups == groups + 2
+
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) FROM game_session").fetchone()[0] == 11
+
+def test_landing_probabilities_stored_by_writer(app):
+    # solving a board while a page renders stores the result through the writer, not on the request's connection
+    pytest.importorskip('scipy')
+    with app.app_context():
+        db = get_db()
+        probabilities = get_landing_probabilities(db, 1, app.config['DATABASE'], app.config)
+        assert not db.in_transaction
+        assert get_writer(app.config).committed == 1
+        assert db.execute("SELECT COUNT(*) FROM landing_probability WHERE game_version_id = 1").fetchone()[0] == len(probabilities)
+
+def test_game_setup_written_by_writer(app, client):
+    # the new game, its players and the starting checkpoint are written on the writer thread, never by the request
+    pool = get_pool(app.config)
+    connect = pool.connect
+    writes = []
+
+    def trace(statement):
+        if statement.split()[0] in ('INSERT', 'UPDATE', 'DELETE'):
+            writes.append((threading.current_thread().name, statement))
+
+    def traced_connect():
+        db = connect()
+        db.set_trace_callback(trace)
+        return db
+
+    pool.connect = traced_connect
+    pool.close()
+    client.post('/welcome/')
+    client.get('/game-setup/')
+    client.post('/game-setup/', data={'game_version': 'Monopoly NL', 'no_of_players': '2'})
+    client.post('/game-setup/player_registration/', data={'player_1_name': 'Ann', 'player_2_name': 'Bob'})
+
+    assert writes
+    assert {thread for thread, statement in writes} == {'sqlite-writer'}
+    with app.app_context():
+        db = get_db()
+        assert db.execute("SELECT COUNT(*) FROM players WHERE game_id = 1").fetchone()[0] == 2
+        assert db.execute("SELECT COUNT(*) FROM state_checkpoint WHERE game_id = 1").fetchone()[0] == 1
@@ -0,0 +1,140 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from monopoly_companion.db import get_pool, log_net_worth
+from monopoly_companion.projection import start_projection
+from monopoly_companion.writer import write
+
+# this module does the bookkeeping of a turn end after the "Next player" request has returned. gameplay flushes the
+# turn, hands a TurnEnd to the pipeline of the database and responds; a small thread pool then writes the net worth
+# log and per-turn rollup of every round that ended (through the database writer) and starts the win projection.
+# The events of a game are processed in order by one thread at a time: events that arrive while a game is being
+# processed wait for that thread, which takes them all at once, logs each round in one writer job and only projects
+# from the latest turn. A round's balances are taken from the game state when the round ends, so the log is exact
+# however late it is written. close_turn_end_pipelines processes every queued event before the worker exits.
+
+# threads processing turn ends per database file
+WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+class TurnEnd:
+    __slots__ = ('game_id', 'turn', 'player_id', 'balances')
+
+    def __init__(self, game_id, turn, player_id, balances=None):
+        # turn and player_id are those of the player whose turn starts; balances are the end of round rows for
+        # db.log_net_worth, or None if the round goes on
+        self.game_id = game_id
+        self.turn = turn
+        self.player_id = player_id
+        self.balances = balances
+
+def turn_end(state, turn, player_id, round_ended):
+    # the event of the turn that just ended in state, with the balances of every player if it ended the round
+    return TurnEnd(state.game_id, turn, player_id, state.balances() if round_ended else None)
+
+def process(config, events):
+    # the bookkeeping of a game's events, oldest first
+    game_id = events[0].game_id
+    rounds = [event for event in events if event.balances is not None]
+    if rounds:
+        def log_rounds(db):
+            for event in rounds:
+                log_net_worth(db, game_id, event.turn - 1, event.balances)
+        write(config, log_rounds)
+
+    latest = events[-1]
+    if config.get('PROJECTION_ROLLOUTS'):
+        pool = get_pool(config)
+        db = pool.acquire()
+        try:
+            start_projection(
+                db, game_id, latest.player_id, config['PROJECTION_ROLLOUTS'], config['PROJECTION_TURNS'], config['PROJECTION_TIME_BUDGET'],
+                config['PROJECTION_BATCH_SIZE'], config['PROJECTION_WORKERS'], database=config['DATABASE'], config=config
+            )
+        except (ImportError, ValueError):
+            pass
+        finally:
+            pool.release(db)
+    return
+
+class TurnEndPipeline:
+    __slots__ = ('config', 'executor', 'pending', 'lock', 'idle', 'closed')
+
+    def __init__(self, config, workers=WORKERS):
+        self.config = config
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='turn-end')
+        # game_id -> events waiting, for every game a thread is processing (or about to)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.closed = False
+
+    def submit(self, event):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The turn end pipeline of " + self.config['DATABASE'] + " is closed")
+            events = self.pending.get(event.game_id)
+            if events is not None:
+                events.append(event)
+                return
+            self.pending[event.game_id] = [event]
+        self.executor.submit(self.run, event.game_id)
+
+    def run(self, game_id):
+        # process the events of a game until none are left; later events of the game are picked up by this same loop
+        while True:
+            with self.lock:
+                events = self.pending[game_id]
+                if not events:
+                    del self.pending[game_id]
+                    self.idle.notify_all()
+                    return
+                self.pending[game_id] = []
+            try:
+                process(self.config, events)
+            except Exception:
+                logger.exception("Turn end of game %s failed", game_id)
+
+    def join(self):
+        # wait until every event submitted so far has been processed
+        with self.lock:
+            self.idle.wait_for(lambda: not self.pending)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.join()
+        self.executor.shutdown()
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+def get_turn_end_pipeline(config):
+    # one pipeline per database file in this worker, started on first use
+    with _pipelines_lock:
+        pipeline = _pipelines.get(config['DATABASE'])
+        if pipeline is None:
+            pipeline = TurnEndPipeline(config, config.get('TURN_END_WORKERS', WORKERS))
+            _pipelines[config['DATABASE']] = pipeline
+    return pipeline
+
+def end_turn(config, state, turn, player_id, round_ended):
+    # queue the bookkeeping of the turn that just ended in state; turn and player_id are those of the next player
+    event = turn_end(state, turn, player_id, round_ended)
+    if not config.get('TURN_END_WORKERS', WORKERS):
+        process(config, [event])
+        return
+    get_turn_end_pipeline(config).submit(event)
+    return
+
+# registered after the writer's, so it runs first at exit and the writer is still there for its jobs
+@atexit.register
+def close_turn_end_pipelines():
+    with _pipelines_lock:
+        pipelines = list(_pipelines.values())
+        _pipelines.clear()
+    for pipeline in pipelines:
+        pipeline.close()
+    return
@@ -0,0 +1,375 @@
+import csv
+import json
+import os
+import threading
+import time
+import click
+from flask import current_app
+from monopoly_companion.board import BOARD_SIZE, CHANCE_SQUARES, COMMUNITY_CHEST_SQUARES, FREE_PARKING, GO, GO_TO_JAIL, JAIL, TAX_SQUARES
+from monopoly_companion.db import NULL_VALUES, get_db, invalidate_game_template, revalue_games
+from monopoly_companion.game_state import reload_game_version
+from monopoly_companion.markov import invalidate_landing_probabilities
+from monopoly_companion.rent import PROPERTY_KINDS, RENT_COLUMNS, STREET, invalidate_rent_table
+from monopoly_companion.simulation import invalidate_simulations
+
+# this module loads custom game versions (boards) besides the ones init_data reads from static/. A board is a game
+# version row and its property rows, from a CSV with one property per row and the columns of BOARD_COLUMNS (the
+# version columns are only needed on the first row of a version, whose rows are consecutive), a JSON file with one
+# board object or a list of them, or JSON Lines with one board object per line. A board object has the version
+# columns and a 'properties' list of objects with the property columns.
+#
+# Each board is validated (a rent for every level of its property_type, see rent.RENT_COLUMNS, rents that do not
+# decrease, free and distinct board positions) and upserted by name: its version with one statement and its properties
+# with one executemany. A board identical to the one in the database is left alone; otherwise the revision of the
+# version goes up. The properties and cities of a version that has games are fixed, only prices and rents can change.
+# BATCH_SIZE boards are committed together, each in a savepoint so an invalid board is skipped alone.
+#
+# The net_worth rows of the games of a repriced version are revalued in SQL, in the transaction of the board. After
+# the commit the caches compiled from a changed version (game template, rent table, landing probabilities,
+# simulations) are dropped and its loaded games revalued. Other processes notice the new revision the next time
+# game setup reads the versions, or a gameplay or API request acts on one of its games, see check_revisions.
+
+VERSION_COLUMNS = ['game_version_name', 'game_version_language', 'total_cash', 'starting_cash_balance', 'go_value']
+
+PROPERTY_COLUMNS = [
+    'property_name', 'property_type', 'city', 'board_side', 'board_position', 'color', 'house_cost', 'price', 'mortgage_value', 'unmortgage_cost',
+    'rent_basic', 'rent_one_house', 'rent_two_houses', 'rent_three_houses', 'rent_four_houses', 'rent_hotel',
+    'rent_multiplier_one_owned', 'rent_multiplier_two_owned', 'rent_two_owned', 'rent_three_owned', 'rent_four_owned', 'rent_monopoly',
+]
+
+BOARD_COLUMNS = VERSION_COLUMNS + PROPERTY_COLUMNS
+
+TEXT_COLUMNS = {'game_version_name', 'game_version_language', 'property_name', 'property_type', 'city', 'color'}
+
+# squares board.py gives a fixed meaning, which no property can take
+SPECIAL_SQUARES = {GO, JAIL, FREE_PARKING, GO_TO_JAIL} | set(CHANCE_SQUARES) | set(COMMUNITY_CHEST_SQUARES) | set(TAX_SQUARES)
+
+# boards committed per transaction
+BATCH_SIZE = 50
+
+class VersionError(Exception):
+    # a board that cannot be loaded; where is its line or board number in the file and, if known, the property
+    def __init__(self, where, message):
+        super().__init__(where + ": " + message)
+        self.where = where
+        self.message = message
+
+# readers yield (where, board) with a board object as described above
+def read_csv(f):
+    reader = csv.DictReader(f)
+    unknown = [column for column in reader.fieldnames or [] if column not in BOARD_COLUMNS]
+    if unknown:
+        raise VersionError("line 1", "Unknown columns " + ", ".join(unknown))
+    seen = set()
+    where = None
+    board = None
+    for row in reader:
+        row = {column: (value if value not in NULL_VALUES else None) for column, value in row.items() if column is not None}
+        name = row.get('game_version_name')
+        if name is None:
+            raise VersionError("line " + str(reader.line_num), "Missing game_version_name")
+        if board is None or name != board['game_version_name']:
+            if board is not None:
+                yield where, board
+            if name in seen:
+                raise VersionError("line " + str(reader.line_num), "The rows of " + name + " are not consecutive")
+            seen.add(name)
+            where = "line " + str(reader.line_num)
+            board = {column: row.get(column) for column in VERSION_COLUMNS}
+            board['properties'] = []
+        for column in VERSION_COLUMNS:
+            if board[column] is None:
+                board[column] = row.get(column)
+        board['properties'].append(row)
+    if board is not None:
+        yield where, board
+
+def read_json(f):
+    try:
+        boards = json.load(f)
+    except ValueError as error:
+        raise ValueError("Invalid JSON: " + str(error))
+    if not isinstance(boards, list):
+        boards = [boards]
+    for number, board in enumerate(boards, start=1):
+        yield "board " + str(number), board
+
+def read_jsonl(f):
+    for line, text in enumerate(f, start=1):
+        if not text.strip():
+            continue
+        try:
+            board = json.loads(text)
+        except ValueError as error:
+            raise ValueError("line " + str(line) + ": Invalid JSON: " + str(error))
+        yield "line " + str(line), board
+
+READERS = {'csv': read_csv, 'json': read_json, 'jsonl': read_jsonl}
+
+def text(where, row, column, required=True):
+    value = row.get(column)
+    if value is None or str(value).strip() in NULL_VALUES:
+        if required:
+            raise VersionError(where, "Missing " + column)
+        return None
+    return str(value).strip()
+
+def integer(where, row, column, required=True):
+    # a non-negative whole number, from a number or numeric text
+    value = row.get(column)
+    if value is None or (isinstance(value, str) and value.strip() in NULL_VALUES):
+        if required:
+            raise VersionError(where, "Missing " + column)
+        return None
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise VersionError(where, "Invalid " + column + " " + repr(value))
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise VersionError(where, "Invalid " + column + " " + repr(value))
+    if number < 0:
+        raise VersionError(where, column + " cannot be negative")
+    return number
+
+def validate_board(where, board):
+    # check a board and return its version row and property rows, as tuples in the order of VERSION_COLUMNS and
+    # PROPERTY_COLUMNS, or raise VersionError
+    if not isinstance(board, dict):
+        raise VersionError(where, "Expected a board object")
+    unknown = [column for column in board if column not in VERSION_COLUMNS and column != 'properties']
+    if unknown:
+        raise VersionError(where, "Unknown columns " + ", ".join(unknown))
+    version = tuple(text(where, board, column) if column in TEXT_COLUMNS else integer(where, board, column) for column in VERSION_COLUMNS)
+    properties = board.get('properties')
+    if not isinstance(properties, list) or not properties:
+        raise VersionError(where, version[0] + " has no properties")
+
+    rows = []
+    names = set()
+    positions = {}
+    for prop in properties:
+        if not isinstance(prop, dict):
+            raise VersionError(where, "Expected a property object")
+        name = text(where, prop, 'property_name')
+        if name in names:
+            raise VersionError(where, "Duplicate property " + name)
+        names.add(name)
+        at = where + ", " + name
+
+        unknown = [column for column in prop if column not in BOARD_COLUMNS]
+        if unknown:
+            raise VersionError(at, "Unknown columns " + ", ".join(unknown))
+        for column, value in zip(VERSION_COLUMNS, version):
+            if prop.get(column) not in (None, '') and str(prop[column]).strip() != str(value):
+                raise VersionError(at, column + " " + repr(prop[column]) + " differs from " + repr(value))
+
+        row = {column: text(at, prop, column, False) if column in TEXT_COLUMNS else integer(at, prop, column, False) for column in PROPERTY_COLUMNS}
+        kind = PROPERTY_KINDS.get(text(at, prop, 'property_type'))
+        if kind is None:
+            raise VersionError(at, "Unknown property_type " + repr(prop['property_type']) + ", expected one of " + ", ".join(PROPERTY_KINDS))
+        for column in ['city', 'board_side', 'board_position', 'price', 'mortgage_value', 'unmortgage_cost'] + (['house_cost'] if kind == STREET else []):
+            if row[column] is None:
+                raise VersionError(at, "Missing " + column)
+        if not 1 <= row['board_side'] <= 4:
+            raise VersionError(at, "board_side must be 1 to 4")
+        if row['board_position'] >= BOARD_SIZE or row['board_position'] in SPECIAL_SQUARES:
+            raise VersionError(at, "board_position " + str(row['board_position']) + " is not a property square")
+        if row['board_position'] in positions:
+            raise VersionError(at, "board_position " + str(row['board_position']) + " is taken by " + positions[row['board_position']])
+        positions[row['board_position']] = name
+
+        # every rent level of the property's kind, non-decreasing like the levels of rent.RentTable
+        previous = None
+        for column in RENT_COLUMNS[kind]:
+            if row[column] is None:
+                raise VersionError(at, "Missing " + column + " for a " + row['property_type'])
+            if previous is not None and row[column] < row[previous]:
+                raise VersionError(at, column + " " + str(row[column]) + " is less than " + previous + " " + str(row[previous]))
+            previous = column
+        rows.append(tuple(row[column] for column in PROPERTY_COLUMNS))
+    return version, rows
+
+class VersionLoader:
+    # loads boards into one database; loaded are (name, game_version_id, revision) of the versions it changed,
+    # unchanged the names of boards that were already loaded, errors (source, VersionError) of the boards it skipped
+    __slots__ = ('db', 'database', 'loaded', 'unchanged', 'errors')
+
+    def __init__(self, db, database=None):
+        self.db = db
+        self.database = database
+        self.loaded = []
+        self.unchanged = []
+        self.errors = []
+
+    def load(self, boards, batch_size=BATCH_SIZE, source=None):
+        # load every board of a stream of (where, board) from a reader, committing batch_size boards at a time
+        db = self.db
+        changed = []
+        pending = 0
+        try:
+            for where, board in boards:
+                if pending == 0:
+                    db.execute("BEGIN")
+                db.execute("SAVEPOINT board")
+                try:
+                    loaded = self.load_board(where, board)
+                except VersionError as error:
+                    db.execute("ROLLBACK TO board")
+                    self.errors.append((source, error))
+                else:
+                    if isinstance(loaded, str):
+                        self.unchanged.append(loaded)
+                    else:
+                        changed.append(loaded)
+                db.execute("RELEASE board")
+                pending += 1
+                if pending >= batch_size:
+                    db.commit()
+                    self.invalidate(changed)
+                    changed = []
+                    pending = 0
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        self.invalidate(changed)
+        return self
+
+    def load_file(self, path, batch_size=BATCH_SIZE):
+        # load a board file; the format is taken from the extension
+        fmt = os.path.splitext(path)[1].lstrip('.').lower()
+        if fmt not in READERS:
+            raise ValueError("Unknown board format " + repr(fmt))
+        with open(path, newline='') as f:
+            return self.load(READERS[fmt](f), batch_size, path)
+
+    def load_board(self, where, board):
+        # upsert one board. Returns its name if it was already loaded as it is, else (name, game_version_id, revision).
+        db = self.db
+        version, properties = validate_board(where, board)
+        name = version[0]
+
+        current = db.execute(
+            "SELECT * FROM game_version WHERE game_version_name = ?",
+            (name,)
+        ).fetchone()
+        if current is not None:
+            game_version_id = current['game_version_id']
+            existing = {
+                row['property_name']: tuple(row[column] for column in PROPERTY_COLUMNS)
+                for row in db.execute(
+                    "SELECT * FROM property WHERE game_version_id = ?",
+                    (game_version_id,)
+                )
+            }
+            if tuple(current[column] for column in VERSION_COLUMNS) == version and existing == {prop[0]: prop for prop in properties}:
+                return name
+
+            has_games = db.execute(
+                "SELECT 1 FROM game WHERE game_version_id = ? LIMIT 1",
+                (game_version_id,)
+            ).fetchone() is not None
+            if has_games and {prop[0]: prop[2] for prop in properties} != {prop[0]: prop[2] for prop in existing.values()}:
+                raise VersionError(where, name + " has games, so only its prices and rents can change, not its properties or cities")
+
+            names = {prop[0] for prop in properties}
+            db.executemany(
+                "DELETE FROM property WHERE game_version_id = ? AND property_name = ?",
+                [(game_version_id, prop_name) for prop_name in existing if prop_name not in names]
+            )
+
+        game_version_id, revision = db.execute(
+            """
+            INSERT INTO game_version (game_version_name, game_version_language, total_cash, starting_cash_balance, go_value, revision)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (game_version_name) DO UPDATE SET
+            game_version_language = excluded.game_version_language,
+            total_cash = excluded.total_cash,
+            starting_cash_balance = excluded.starting_cash_balance,
+            go_value = excluded.go_value,
+            revision = revision + 1
+            RETURNING game_version_id, revision
+            """,
+            version
+        ).fetchone()
+
+        db.executemany(
+            "INSERT INTO property (game_version_id, " + ", ".join(PROPERTY_COLUMNS) + ") VALUES (?, " + ", ".join("?" * len(PROPERTY_COLUMNS)) + ")"
+            + " ON CONFLICT (game_version_id, property_name) DO UPDATE SET " + ", ".join(column + " = excluded." + column for column in PROPERTY_COLUMNS[1:]),
+            [(game_version_id,) + prop for prop in properties]
+        )
+        if current is not None and has_games:
+            # the stored net worth of its games follows the new prices in this transaction, whichever process holds them
+            revalue_games(db, game_version_id)
+        return name, game_version_id, revision
+
+    def invalidate(self, changed):
+        # called once the changes are committed, so the caches are rebuilt from the new rows
+        for name, game_version_id, revision in changed:
+            invalidate_version(self.db, game_version_id, revision, self.database)
+            self.loaded.append((name, game_version_id, revision))
+
+def board_files(paths):
+    # the files among paths, with the board files of each directory in name order
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lstrip('.').lower() in READERS:
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+# revision of each version as last seen by this worker, keyed by (database path, game_version_id)
+_revisions = {}
+_revisions_lock = threading.Lock()
+
+def invalidate_version(db, game_version_id, revision, database=None):
+    # drop everything this worker compiled from the rows of a game version and revalue its loaded games
+    invalidate_game_template(game_version_id, database)
+    invalidate_rent_table(game_version_id, database)
+    invalidate_landing_probabilities(game_version_id, database)
+    invalidate_simulations(game_version_id, database)
+    reload_game_version(db, game_version_id, database)
+    with _revisions_lock:
+        _revisions[(database, game_version_id)] = revision
+    return
+
+def check_revisions(db, game_versions, database=None):
+    # invalidate the versions among game_versions (game_version rows) whose revision this worker has not seen, e.g.
+    # because another process loaded their boards. The first time a version is seen its caches are dropped as well.
+    for game_version in game_versions:
+        with _revisions_lock:
+            revision = _revisions.get((database, game_version['game_version_id']))
+        if revision != game_version['revision']:
+            invalidate_version(db, game_version['game_version_id'], game_version['revision'], database)
+    return
+
+def check_revision(db, game_version_id, database=None):
+    # check_revisions for the version of the game a gameplay or API request acts on
+    check_revisions(db, db.execute(
+        "SELECT game_version_id, revision FROM game_version WHERE game_version_id = ?",
+        (game_version_id,)
+    ).fetchall(), database)
+    return
+
+@click.command('load-versions')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Boards committed per transaction.')
+def load_versions_command(paths, batch_size):
+    """Load custom game versions from board files (CSV, JSON or JSON Lines) or directories of them"""
+    loader = VersionLoader(get_db(), current_app.config['DATABASE'])
+    start = time.perf_counter()
+    for path in board_files(paths):
+        try:
+            loader.load_file(path, batch_size)
+        except (ValueError, VersionError) as error:
+            raise click.ClickException(path + ": " + str(error))
+    elapsed = time.perf_counter() - start
+    for source, error in loader.errors:
+        click.echo(source + ": skipped board, " + str(error), err=True)
+    for name, game_version_id, revision in loader.loaded:
+        click.echo("loaded " + name + " (game version " + str(game_version_id) + ", revision " + str(revision) + ")")
+    click.echo("{} versions loaded, {} unchanged, {} skipped in {:.1f}s".format(len(loader.loaded), len(loader.unchanged), len(loader.errors), elapsed))
+
+def init_app(app):
+    app.cli.add_command(load_versions_command)
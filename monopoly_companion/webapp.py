@@ -1,4 +1,4 @@
-from . import app
-from . import welcome
-from . import game_setup
-from . import gameplay
\ No newline at end of file
+from monopoly_companion import create_app
+
+# the application object for WSGI servers, e.g. gunicorn monopoly_companion.webapp:app
+app = create_app()
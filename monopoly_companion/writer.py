@@ -0,0 +1,180 @@
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+from monopoly_companion.db import get_pool
+from monopoly_companion.profiling import Profile, current_profile
+
+# this module funnels the writes of every game in this worker through one writer thread per database file, so
+# concurrent games do not each wait for SQLite's write lock and commit separately. Request handlers submit a job
+# (a function of a connection that writes without committing) and get back a Future. The writer takes every job
+# that is queued when it is free, opens one IMMEDIATE transaction, runs each job in its own savepoint (a failing job
+# is rolled back alone and its future gets the exception) and commits the group once. Futures are resolved after the
+# commit, so a result means the rows are in the database. Jobs run in the order they were submitted, so the writes
+# of a game stay in order. Under load, jobs queue up while a group commits and the next group takes them all;
+# a single job is committed straight away.
+# With SQL_PROFILE a job carries the profile of the request that submitted it: the writer's connection records the
+# job's statements into it, and the BEGIN and COMMIT the job shared with its group.
+
+# jobs that may wait before submit blocks, and the most jobs committed together
+QUEUE_SIZE = 1000
+GROUP_SIZE = 100
+
+class Writer:
+    __slots__ = ('database', 'jobs', 'group_size', 'timeout', 'thread', 'closed', 'lock', 'groups', 'committed')
+
+    def __init__(self, config, queue_size=QUEUE_SIZE, group_size=GROUP_SIZE):
+        self.database = config['DATABASE']
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.group_size = group_size
+        self.timeout = config.get('DATABASE_TIMEOUT', 5.0)
+        self.closed = False
+        self.lock = threading.Lock()
+        # number of group commits and of jobs they committed, for monitoring
+        self.groups = 0
+        self.committed = 0
+        # a connection of its own, in autocommit mode so the writer controls the transactions
+        db = get_pool(config).connect()
+        db.isolation_level = None
+        self.thread = threading.Thread(target=self.run, args=(db,), name='sqlite-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, job, profile=None):
+        # queue job(db) and return the Future of its result. Blocks while the queue is full, up to the database timeout.
+        # The statements of the job are recorded in profile, if given.
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The writer of " + self.database + " is closed")
+            self.jobs.put((job, future, profile), timeout=self.timeout)
+        return future
+
+    def run(self, db):
+        closing = False
+        try:
+            while not closing:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                group = [job]
+                while len(group) < self.group_size:
+                    try:
+                        job = self.jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        closing = True
+                        break
+                    group.append(job)
+                self.commit(db, [(job, future, profile) for job, future, profile in group if future.set_running_or_notify_cancel()])
+        finally:
+            db.close()
+
+    def commit(self, db, group):
+        if not group:
+            return
+        # statements of the group as a whole, added to the profile of every job
+        shared = Profile() if any(profile is not None for job, future, profile in group) else None
+        try:
+            profiled(db, shared, db.execute, "BEGIN IMMEDIATE")
+        except BaseException as error:
+            for job, future, profile in group:
+                future.set_exception(error)
+            return
+
+        if len(group) == 1:
+            # nothing else to keep, so a failing job rolls back the whole transaction without a savepoint
+            job, future, profile = group[0]
+            try:
+                result = profiled(db, profile, job, db)
+            except BaseException as error:
+                if db.in_transaction:
+                    profiled(db, profile, db.execute, "ROLLBACK")
+                future.set_exception(error)
+                return
+            results = [(future, True, result)]
+        else:
+            results = []
+            for job, future, profile in group:
+                profiled(db, profile, db.execute, "SAVEPOINT job")
+                try:
+                    result = profiled(db, profile, job, db)
+                except BaseException as error:
+                    if not db.in_transaction:
+                        # SQLite rolled back the whole transaction (e.g. the disk is full), taking the group with it
+                        for job, future, profile in group:
+                            future.set_exception(error)
+                        return
+                    profiled(db, profile, db.execute, "ROLLBACK TO job")
+                    profiled(db, profile, db.execute, "RELEASE job")
+                    results.append((future, False, error))
+                else:
+                    profiled(db, profile, db.execute, "RELEASE job")
+                    results.append((future, True, result))
+
+        try:
+            profiled(db, shared, db.execute, "COMMIT")
+        except BaseException as error:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            for job, future, profile in group:
+                future.set_exception(error)
+            return
+
+        self.groups += 1
+        self.committed += len(group)
+        if shared is not None:
+            for job, future, profile in group:
+                if profile is not None:
+                    profile.statements.extend(shared.statements)
+        for future, succeeded, result in results:
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def close(self):
+        # write every job queued so far, then stop the thread
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.jobs.put(None)
+        self.thread.join()
+
+def profiled(db, profile, call, *args):
+    # call(*args) with the statements it runs on db recorded in profile, if there is one and db is profiled (SQL_PROFILE)
+    if profile is None or not hasattr(db, 'profile'):
+        return call(*args)
+    db.profile = profile
+    try:
+        return call(*args)
+    finally:
+        db.profile = None
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(config):
+    # one writer per database file in this worker, started on first use
+    with _writers_lock:
+        writer = _writers.get(config['DATABASE'])
+        if writer is None:
+            writer = Writer(config, config.get('WRITER_QUEUE_SIZE', QUEUE_SIZE), config.get('WRITER_GROUP_SIZE', GROUP_SIZE))
+            _writers[config['DATABASE']] = writer
+    return writer
+
+def write(config, job):
+    # run job(db) on the writer and wait until it is committed. Returns its result or raises its exception.
+    # Its statements count towards the profile of the request that submitted it.
+    return get_writer(config).submit(job, current_profile()).result()
+
+@atexit.register
+def close_writers():
+    # commit whatever is still queued before the worker exits
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+    return